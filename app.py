@@ -1,43 +1,149 @@
 import os
 import base64
 from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, jsonify, url_for
+from flask import Flask, Request, Response, g, render_template, request, jsonify, send_file, url_for
 import requests
-import markdown
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import HtmlFormatter
+import http_client
+import metrics
+from context_window import context_to_messages, input_token_budget, trim_messages
+from response_cache import create_response_cache, make_cache_key, should_cache
+from semantic_cache import create_semantic_cache
+from single_flight import SingleFlight, request_key
+from conversation_store import create_conversation_store
+from file_store import SNIFF_BYTES, FileStore, HashingTempFile, content_matches
+from chunked_uploads import UploadConflict, UploadError, create_chunked_upload_store
+from file_catalog import create_file_catalog
+from image_processing import ImagePreprocessor
+from interaction_logger import create_interaction_logger
+from rate_limiter import SchedulerRejected, create_upstream_scheduler, estimate_tokens
+from provider_batch import ProviderBatchClient
+from image_jobs import create_image_job_store
+from markdown_renderer import StreamRender, create_markdown_renderer
+from model_router import ModelUnavailable, create_model_router
+from document_index import DOCUMENT_EXTENSIONS, DocumentIndexStore, UnsupportedDocument
 from dotenv import load_dotenv
 import json
+import mimetypes
+import io
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-import shutil
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Get API key from environment variable
 API_KEY = os.getenv("OPENAI_API_KEY")
-API_URL = "https://api.openai.com/v1/chat/completions"
+# Point OPENAI_API_BASE at a compatible server (e.g. bench/mock_openai.py) to run offline
+API_BASE_URL = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
+API_URL = f"{API_BASE_URL}/chat/completions"
+IMAGES_API_URL = f"{API_BASE_URL}/images/generations"
+
+# Enabled models (DEFAULT_MODEL / AVAILABLE_MODELS), their capabilities and per-model health
+model_router = create_model_router()
 
 # Add configuration for file uploads
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-STATIC_UPLOAD_PATH = 'static/uploads'
+UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'pdf', 'txt', 'doc', 'docx', 'xlsx', 'csv', 'md', 'json'}
-MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB limit
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB limit per request; larger files use /upload/chunked
+
+# Uploads are stored once by content hash; images are referenced by ID from /generate
+file_store = FileStore(os.path.join(UPLOAD_FOLDER, 'objects'))
+
+# Large or resumable uploads arrive in chunks that are appended to disk as they stream in
+chunked_uploads = create_chunked_upload_store(UPLOAD_FOLDER, MAX_CONTENT_LENGTH)
+
+# Documents are chunked and indexed once at upload; /generate sends only the relevant chunks
+document_indexes = DocumentIndexStore(
+    os.path.join(UPLOAD_FOLDER, 'indexes'),
+    chunk_tokens=int(os.getenv("DOCUMENT_CHUNK_TOKENS", 200)),
+    overlap_tokens=int(os.getenv("DOCUMENT_CHUNK_OVERLAP", 40))
+)
+DOCUMENT_TOKEN_BUDGET = int(os.getenv("DOCUMENT_TOKEN_BUDGET", 2000))
+DOCUMENT_TOP_K = int(os.getenv("DOCUMENT_TOP_K", 8))
+
+# Upload metadata index behind /files
+file_catalog = create_file_catalog()
+
+class UploadRequest(Request):
+    """Request that parses multipart file parts straight into the file store"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Hashing while the parser writes means a finished upload only needs a rename
+        return file_store.open_temp()
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+# Let a front-end server (Apache/lighttpd) send file bodies via X-Sendfile
+app.config['USE_X_SENDFILE'] = os.getenv("USE_X_SENDFILE", "0") == "1"
+# nginx: internal location that maps onto the file store root, e.g. /protected-uploads/
+UPLOAD_ACCEL_REDIRECT_PREFIX = os.getenv("UPLOAD_ACCEL_REDIRECT_PREFIX")
+
+# Images are downscaled/recompressed for the vision model; variants are cached by content hash
+image_preprocessor = ImagePreprocessor(
+    os.path.join(UPLOAD_FOLDER, 'processed'),
+    jpeg_quality=int(os.getenv("IMAGE_JPEG_QUALITY", 85)),
+    webp_quality=int(os.getenv("IMAGE_WEBP_QUALITY", 80))
+)
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "high")  # "low" or "high" vision detail
+
+# Exact-match cache for deterministic completions (None when RESPONSE_CACHE_BACKEND=off)
+response_cache = create_response_cache()
+
+# Concurrent identical upstream requests wait on one in-flight call
+inflight_requests = SingleFlight()
+
+# Caps concurrent upstream calls and queues bursts fairly within the account's rate limits
+upstream_scheduler = create_upstream_scheduler()
+
+# /generate/batch: items run on a shared pool, each batch with its own in-flight limit
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+# "mode": "provider" batches run offline at the provider, which accepts up to 50,000 requests per batch
+BATCH_PROVIDER_MAX_ITEMS = int(os.getenv("BATCH_PROVIDER_MAX_ITEMS", 50000))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_WORKERS", 32)), thread_name_prefix="batch")
+provider_batches = ProviderBatchClient(API_BASE_URL, API_KEY)
+
+# Optional server-side Markdown rendering ("render": true on /generate, and /render)
+markdown_renderer = create_markdown_renderer()
+
+# /generate-image: jobs are recorded in SQLite and run on a small worker pool
+image_jobs = create_image_job_store()
+image_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_JOB_WORKERS", 4)), thread_name_prefix="image-job")
+
+# Interaction log: requests enqueue, a background thread batches writes and rotates the file
+interaction_logger = create_interaction_logger(os.getenv("LOG_DIR") or os.path.join(os.path.dirname(__file__), 'logs'))
 
-# Ensure upload directories exist
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-    print(f"Created upload directory: {UPLOAD_FOLDER}")
+# Optional cache of replies to reworded single-turn prompts (SEMANTIC_CACHE=1), per model,
+# warmed from the interaction log
+semantic_cache = create_semantic_cache(interaction_logger.path, model_router.default_model)
 
-static_upload_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_UPLOAD_PATH)
-if not os.path.exists(static_upload_dir):
-    os.makedirs(static_upload_dir)
-    print(f"Created static upload directory: {static_upload_dir}")
+# Server-side chat history, so clients send a conversation_id instead of every prior message
+conversation_store = create_conversation_store()
+CONVERSATION_HISTORY_LIMIT = 100  # Newest messages loaded before token-budget trimming
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Count the request and its latency (to response headers) under its route pattern"""
+    started = g.get('request_started')
+    if started is not None:
+        metrics.record_request(
+            request.url_rule.rule if request.url_rule else 'unmatched',
+            request.method,
+            response.status_code,
+            time.perf_counter() - started,
+            request.content_length,
+            None if response.is_streamed else response.calculate_content_length()
+        )
+    return response
 
 @app.route('/')
 def home():
@@ -48,6 +154,36 @@ def allowed_file(filename):
     """Check if the file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def stored_upload_result(file_id, original_filename, file_type, file_size, created, extension):
+    """Catalog a file that is now in the store and build the upload response for it"""
+    file_catalog.add(file_id, original_filename, file_type, file_size)
+    
+    # Generate URL for the file
+    file_url = url_for('serve_upload', file_id=file_id, _external=True)
+    
+    print(f"File {'uploaded' if created else 'already stored'}: {file_id}, URL: {file_url}")
+    
+    result = {
+        'filename': file_id,
+        'original_filename': original_filename,
+        'filepath': file_store.path_for(file_id),
+        'url': file_url,
+        'size': file_size,
+        'type': file_type,
+        'duplicate': not created,
+        'timestamp': datetime.now().isoformat()
+    }
+    # Images can be referenced by ID from /generate
+    if extension in IMAGE_EXTENSIONS:
+        result['image_id'] = file_id
+    # Documents are indexed now so prompts about them only pay for retrieval
+    elif extension in DOCUMENT_EXTENSIONS:
+        try:
+            result['document'] = document_indexes.ingest(file_id, file_store.path_for(file_id), extension)
+        except UnsupportedDocument as e:
+            result['document_error'] = str(e)
+    return result
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file uploads with improved error handling and metadata"""
@@ -61,282 +197,975 @@ def upload_file():
         
     try:
         if file and allowed_file(file.filename):
-            # Create a unique filename with timestamp
             original_filename = secure_filename(file.filename)
-            base, extension = os.path.splitext(original_filename)
-            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            safe_filename = f"{base}_{timestamp}{extension}"
-            
-            # Save to uploads directory
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], safe_filename)
-            file.save(filepath)
-            
-            # Copy to static folder for URL access
-            static_filepath = os.path.join(static_upload_dir, safe_filename)
-            try:
-                shutil.copy2(filepath, static_filepath)
-                print(f"File copied to static directory: {static_filepath}")
-            except Exception as e:
-                print(f"Warning: Could not copy file to static directory: {e}")
-            
-            # Get file info
-            file_size = os.path.getsize(filepath)
-            file_type = file.content_type or 'application/octet-stream'
+            extension = file.filename.rsplit('.', 1)[1].lower()
             
-            # Generate URL for the file
-            file_url = url_for('static', filename=f'uploads/{safe_filename}', _external=True)
+            # Trust the file's first bytes, not its name
+            head = file.stream.read(SNIFF_BYTES)
+            file.stream.seek(0)
+            if not content_matches(head, extension):
+                return jsonify({'error': f'File content does not match its .{extension} extension'}), 400
             
-            print(f"File uploaded successfully: {safe_filename}, URL: {file_url}")
+            # The parser already wrote (and hashed) the body into the store; commit it by
+            # renaming, or fall back to copying if the stream came from elsewhere
+            if isinstance(file.stream, HashingTempFile):
+                file_id, file_size, created = file_store.commit_temp(file.stream, extension)
+            else:
+                file_id, file_size, created = file_store.save_stream(file.stream, extension)
             
-            return jsonify({
-                'filename': safe_filename,
-                'original_filename': original_filename,
-                'filepath': filepath,
-                'url': file_url,
-                'size': file_size,
-                'type': file_type,
-                'timestamp': datetime.now().isoformat()
-            })
+            file_type = file.content_type or mimetypes.guess_type(file_id)[0] or 'application/octet-stream'
+            return jsonify(stored_upload_result(file_id, original_filename, file_type, file_size, created, extension))
         else:
             return jsonify({'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
     except Exception as e:
         print(f"Upload error: {str(e)}")
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
-@app.route('/generate', methods=['POST'])
-def generate_text():
-    """Generate text based on the input prompt using an external API"""
-    data = request.json
+def chunked_upload_status(upload):
+    return {
+        'upload_id': upload['upload_id'],
+        'filename': upload['filename'],
+        'size': upload['size'],
+        'received': upload['received'],
+        'chunk_size': chunked_uploads.chunk_size,
+        'upload_url': url_for('append_chunked_upload', upload_id=upload['upload_id']),
+        'complete_url': url_for('complete_chunked_upload', upload_id=upload['upload_id'])
+    }
+
+@app.route('/upload/chunked', methods=['POST'])
+def start_chunked_upload():
+    """Start a resumable upload from {"filename": ..., "size": ...}"""
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename') or ''
+    size = data.get('size')
+    if not allowed_file(filename):
+        return jsonify({'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({'error': 'size must be the file size in bytes'}), 400
+    try:
+        upload = chunked_uploads.create(
+            secure_filename(filename) or 'upload', filename.rsplit('.', 1)[1].lower(), size, data.get('type')
+        )
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(chunked_upload_status(upload)), 201
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_progress(upload_id):
+    """How many bytes of an upload have arrived, i.e. the offset to resume from"""
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(chunked_upload_status(upload))
+
+@app.route('/upload/chunked/<upload_id>', methods=['PUT'])
+def append_chunked_upload(upload_id):
+    """Append the raw request body at the offset given by the Upload-Offset header"""
+    offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+    if offset is None or not offset.isdigit():
+        return jsonify({'error': 'Upload-Offset header with the byte offset of this chunk is required'}), 400
+    if request.content_length is None:
+        return jsonify({'error': 'Content-Length is required'}), 411
+    if request.content_length > chunked_uploads.chunk_size:
+        return jsonify({'error': f'Chunks may be at most {chunked_uploads.chunk_size} bytes'}), 413
+    try:
+        # request.stream reads the body from the socket as it is copied, never buffering it whole
+        received = chunked_uploads.append(upload_id, int(offset), request.stream, request.content_length)
+    except UploadConflict as e:
+        return jsonify({'error': str(e), 'received': e.received}), 409
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'upload_id': upload_id, 'received': received})
+
+@app.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Move a fully received upload into the store; responds like /upload"""
+    try:
+        upload, (file_id, file_size, created) = chunked_uploads.complete(upload_id, file_store.commit_file)
+    except UploadConflict as e:
+        return jsonify({'error': str(e), 'received': e.received}), 409
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    file_type = upload['content_type'] or mimetypes.guess_type(file_id)[0] or 'application/octet-stream'
+    return jsonify(stored_upload_result(file_id, upload['filename'], file_type, file_size, created, upload['extension']))
+
+@app.route('/upload/chunked/<upload_id>', methods=['DELETE'])
+def cancel_chunked_upload(upload_id):
+    """Abandon an upload and delete what was received"""
+    if chunked_uploads.get(upload_id) is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    chunked_uploads.discard(upload_id)
+    return jsonify({'upload_id': upload_id, 'deleted': True})
+
+@app.route('/uploads/<file_id>', methods=['GET'])
+def serve_upload(file_id):
+    """Serve a file from the content-addressed store"""
+    path = file_store.path_for(file_id)
+    if not path or not os.path.isfile(path):
+        return jsonify({'error': 'File not found'}), 404
+    
+    if UPLOAD_ACCEL_REDIRECT_PREFIX:
+        # Hand the body off to nginx; it handles Range and conditional requests itself
+        response = Response(mimetype=mimetypes.guess_type(file_id)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{UPLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{file_id[:2]}/{file_id}"
+    else:
+        # ETag, If-None-Match and Range are handled by send_file
+        response = send_file(path, conditional=True, etag=file_id.split('.', 1)[0], max_age=31536000)
+    
+    # Content never changes for a given ID, so clients may cache it indefinitely
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+def image_data_url(image_id, detail=IMAGE_DETAIL):
+    """Encode a stored image as a data URL for the upstream API, only when a request needs it"""
+    path = file_store.path_for(image_id)
+    if not path or not os.path.isfile(path):
+        raise FileNotFoundError(image_id)
+    mime_type = mimetypes.guess_type(image_id)[0] or 'application/octet-stream'
+    digest = image_id.split('.', 1)[0]
+    return image_preprocessor.data_url_for_file(path, digest, mime_type, detail)
+
+def api_headers():
+    """Headers for authenticated calls to the OpenAI API"""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {API_KEY}"
+    }
+
+def attached_file_id(attachment):
+    """File ID of a /generate 'file' attachment: its id, or the name in its path or url"""
+    if not isinstance(attachment, dict):
+        return None
+    file_id = attachment.get('id') or os.path.basename(attachment.get('path') or attachment.get('url') or '')
+    return file_id if file_store.exists(file_id) else None
+
+def document_excerpts(attachment, query, budget):
+    """Prompt text with the parts of an attached document most relevant to query, or None"""
+    file_id = attached_file_id(attachment)
+    if not file_id:
+        return None
+    index = document_indexes.load(file_id)
+    if index is None:
+        # Uploaded before indexing existed (or the index was removed): build it now, once
+        extension = file_id.rsplit('.', 1)[-1]
+        if extension not in DOCUMENT_EXTENSIONS:
+            return None
+        try:
+            document_indexes.ingest(file_id, file_store.path_for(file_id), extension)
+        except UnsupportedDocument as e:
+            print(f"Document indexing failed for {file_id}: {str(e)}")
+            return None
+        index = document_indexes.load(file_id)
+    
+    chunks = index.retrieve(query, budget, DOCUMENT_TOP_K)
+    if not chunks:
+        return None
+    name = attachment.get('name') or file_id
+    excerpts = "\n\n".join(f"[{i + 1}] {chunk}" for i, chunk in enumerate(chunks))
+    return f"Relevant excerpts from the attached file \"{name}\":\n\n{excerpts}"
+
+class InvalidParameter(ValueError):
+    """A request parameter that can't be used; reported to the client as a 400"""
+
+def build_chat_payload(data, stream=False):
+    """Build the upstream chat completion payload for a /generate request body"""
     prompt = data.get('prompt', '')
             
     # Default parameters
-    max_length = data.get('max_length', 150)
+    max_length, error = positive_int(data.get('max_length', 150), 'max_length')
+    if error:
+        raise InvalidParameter(error)
     temperature = data.get('temperature', 0.7)
     context = data.get('context', [])
             
-    # Get the selected model - use gpt-4o-mini or o1-mini as default
-    model = data.get('model', 'gpt-4o-mini')
-                
-    # Check if there's an image attached
+    # Check if there's an image attached, inline or by ID from /upload
+    image_detail = 'low' if data.get('image_detail') == 'low' else IMAGE_DETAIL
     image_data = data.get('image')
+    if image_data:
+        image_data = image_preprocessor.process_data_url(image_data, image_detail)
+    elif data.get('image_id'):
+        image_data = image_data_url(data['image_id'], image_detail)
                 
-    # Format the complete prompt with context if provided
-    complete_prompt = ""
-    
-    if context:
-        # Build conversation history
-        for message in context:
-            if message['sender'] == 'user':
-                complete_prompt += f"User: {message['text']}\n"
-            else:
-                complete_prompt += f"AI: {message['text']}\n"
-        
-        # Add the current prompt
-        complete_prompt += f"User: {prompt}\nAI:"
+    # Get the selected model, falling back to DEFAULT_MODEL if it is not enabled or can't take images
+    model = model_router.resolve(data.get('model'), vision=bool(image_data))
+    
+    # Attached documents contribute their best-matching chunks, within at most half the prompt budget
+    if data.get('file'):
+        document_budget = min(DOCUMENT_TOKEN_BUDGET, input_token_budget(max_length) // 2)
+        excerpts = document_excerpts(data['file'], prompt, document_budget)
+        if excerpts:
+            prompt = f"{excerpts}\n\n{prompt}"
+    
+    # Send the conversation as role-tagged messages, ending with the current prompt
+    messages = context_to_messages(context)
+    
+    if image_data:
+        messages.append({
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_data,
+                        "detail": image_detail
+                    }
+                }
+            ]
+        })
     else:
-        complete_prompt = prompt
+        messages.append({"role": "user", "content": prompt})
+    
+    # Drop (and summarize) the oldest turns so the prompt fits the token budget
+    summary_role = "system" if model_router.capabilities(model)["system_messages"] else "user"
+    messages = trim_messages(messages, input_token_budget(max_length), summary_role)
+    
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_length,
+        "temperature": temperature,
+        "top_p": 1,
+        "n": 1,
+        "stream": stream
+    }
+    if stream:
+        payload["stream_options"] = {"include_usage": True}  # Token usage arrives in a final chunk
+    # Rename or drop parameters the model doesn't accept (e.g. temperature for o1-mini)
+    return model_router.adapt_payload(payload, model)
+
+def build_image_payload(data):
+    """Build the upstream DALL-E payload for a /generate-image request body"""
+    # Fixed payload: Use proper model name "dall-e-2" instead of "gpt-4o-mini"
+    return {
+        "model": "dall-e-2",  # Correct model name for DALL-E 2
+        "prompt": data.get('prompt', ''),
+        "n": 1,
+        "size": data.get('size', '512x512')
+    }
+
+def api_error_response(error_msg, status_code, error_json=None, check_rate_limit=True):
+    """Translate an upstream API error into the (body, status) returned to the client"""
+    try:
+        if error_json and 'error' in error_json:
+            error_msg = error_json['error'].get('message', error_msg)
+            
+            # Handle specific OpenAI API errors
+            if 'billing' in error_msg.lower() and 'limit' in error_msg.lower():
+                error_msg = "OpenAI API billing limit reached. Please check your API key's usage limits in your OpenAI account dashboard."
+                metrics.ERRORS.inc(status=402, kind='billing')
+                return {
+                    'error': error_msg,
+                    'details': "This usually means you've used all your API credits or reached a spending cap.",
+                    'resolution': "Visit https://platform.openai.com/usage to check your usage and billing status."
+                }, 402  # 402 Payment Required
+                
+            elif check_rate_limit and 'rate' in error_msg.lower() and 'limit' in error_msg.lower():
+                metrics.ERRORS.inc(status=429, kind='rate_limit')
+                return {
+                    'error': "Rate limit exceeded. Please try again in a moment.",
+                    'details': error_msg
+                }, 429  # 429 Too Many Requests
+    except:
+        pass
+    
+    metrics.ERRORS.inc(status=status_code, kind='timeout' if status_code == 504 else 'upstream')
+    return {'error': f"API Error: {error_msg}"}, status_code
+
+def request_error_response(e, check_rate_limit=True):
+    """Translate a requests exception from an upstream call into (body, status)"""
+    # A stuck upstream surfaces as a timeout rather than pinning the worker
+    status_code = 504 if isinstance(e, requests.exceptions.Timeout) else 500
+    error_json = None
+    try:
+        if hasattr(e, 'response') and e.response is not None:
+            status_code = e.response.status_code
+            error_json = e.response.json()
+    except:
+        pass
+    
+    return api_error_response(str(e), status_code, error_json, check_rate_limit)
+
+def client_id():
+    """Key for fair upstream queueing: an X-User-Id header, else the client address"""
+    return request.headers.get('X-User-Id') or request.remote_addr or 'anonymous'
+
+def scheduler_rejected_response(e):
+    """JSON error for a request the upstream scheduler shed, with a Retry-After hint"""
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.status_code = e.status_code
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def parse_stream_line(line):
+    """Parse one upstream SSE line into (finished, delta text or None, usage or None)"""
+    if not line or not line.startswith('data:'):
+        return False, None, None
+    chunk = line[len('data:'):].strip()
+    if chunk == '[DONE]':
+        return True, None, None
+    data = json.loads(chunk)
+    choices = data.get('choices') or []
+    return False, choices[0].get('delta', {}).get('content') if choices else None, data.get('usage')
+
+@app.route('/generate', methods=['POST'])
+def generate_text():
+    """Generate text based on the input prompt using an external API"""
+    data = request.json
+    prompt = data.get('prompt', '')
+    
+    # Clients opt into token streaming with "stream": true or an SSE Accept header
+    stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+    render = wants_render(data)
+    
+    if data.get('image_id') and not file_store.exists(data['image_id']):
+        return jsonify({'error': 'Unknown image_id. Upload the image again.'}), 400
+    
+    conversation_id = data.get('conversation_id')
+    if conversation_id:
+        error = load_conversation_context(data)
+        if error:
+            return jsonify(error[0]), error[1]
     
     # Generate text using API
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
+        payload = build_chat_payload(data, stream)
         
-        # For image inputs, use gpt-4o-mini which can handle images
-        if image_data:
-            payload = {
-                "model": "gpt-4o-mini",  # Use gpt-4o-mini for image analysis
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": complete_prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": image_data
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": max_length,
-                "temperature": temperature
-            }
+        # Serve repeated deterministic requests without an upstream call
+        cache_key = make_cache_key(payload) if response_cache and should_cache(data) else None
+        cached_text = response_cache.get(cache_key) if cache_key else None
+        if cached_text is not None:
+            save_conversation_turn(conversation_id, prompt, cached_text)
+            if stream:
+                return sse_response(stream_cached(cached_text, render, model=payload['model']))
+            return jsonify(with_html({'response': cached_text, 'cached': True, 'model': payload['model']}, render))
+        
+        # Then a near-duplicate of an earlier prompt
+        semantic = semantic_cacheable(data, payload)
+        similar = semantic_cache.lookup(prompt, payload['model'], semantic) if semantic and semantic_cache else None
+        if similar:
+            cached_text, similarity = similar
+            save_conversation_turn(conversation_id, prompt, cached_text)
+            if stream:
+                return sse_response(stream_cached(cached_text, render, similarity, payload['model']))
+            return jsonify(with_html({'response': cached_text, 'cached': True, 'similarity': round(similarity, 4),
+                                      'model': payload['model']}, render))
+        
+        if stream:
+            user = client_id()
             
-            try:
-                response = requests.post(API_URL, headers=headers, json=payload)
-                response.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                # No need for fallback since we're only using allowed models
-                # Just re-raise the exception
-                raise
-        else:
-            # Regular text-only payload with the selected model (gpt-4o-mini or o1-mini)
-            payload = {
-                "model": model,
-                "messages": [
-                    {"role": "user", "content": complete_prompt}
-                ],
-                "max_tokens": max_length,
-                "temperature": temperature,
-                "top_p": 1,
-                "n": 1,
-                "stream": False
-            }
+            def open_stream(attempt_payload):
+                # The upstream slot is held until the stream is closed
+                model = attempt_payload['model']
+                ticket = upstream_scheduler.acquire(user, model, estimate_tokens(attempt_payload))
+                try:
+                    response = http_client.post(API_URL, headers=api_headers(), json=attempt_payload, stream=True)
+                    upstream_scheduler.update(model, response.headers)
+                    response.raise_for_status()
+                except BaseException:
+                    upstream_scheduler.release(ticket)
+                    raise
+                return response, ticket, model
             
-            response = requests.post(API_URL, headers=headers, json=payload)
-            response.raise_for_status()
-        
-        result = response.json()
-        generated_text = result['choices'][0]['message']['content']
+            # Failing over is only possible until the first byte has been relayed
+            response, ticket, model = model_router.call(payload, open_stream, should_fail_over, timed=False)
+            
+            # Relay deltas as Server-Sent Events; errors before this point still get JSON
+            result = sse_response(stream_completion(response, prompt, cache_key, conversation_id, model, render, semantic))
+            result.call_on_close(lambda: upstream_scheduler.release(ticket))
+            return result
         
-        # Log the interaction (optional)
-        try:
-            log_interaction(prompt, generated_text)
-        except Exception as e:
-            print(f"Logging error: {str(e)}")
-                
-        return jsonify({'response': generated_text})
+        # Identical concurrent requests share one upstream call and its result or error
+        user = client_id()
+        generated_text, model = inflight_requests.do(
+            request_key('chat', payload),
+            lambda: fetch_completion(payload, prompt, cache_key, user, semantic)
+        )
+        save_conversation_turn(conversation_id, prompt, generated_text)
+        return jsonify(with_html({'response': generated_text, 'model': model}, render))
     
+    except (ModelUnavailable, InvalidParameter) as e:
+        return jsonify({'error': str(e)}), 400
+    except SchedulerRejected as e:
+        return scheduler_rejected_response(e)
     except requests.exceptions.RequestException as e:
-        error_msg = str(e)
-        status_code = 500
-        try:
-            if hasattr(e, 'response') and e.response is not None:
-                error_json = e.response.json()
-                status_code = e.response.status_code
-                
-                if 'error' in error_json:
-                    error_msg = error_json['error'].get('message', str(e))
-                    
-                    # Handle specific OpenAI API errors
-                    if 'billing' in error_msg.lower() and 'limit' in error_msg.lower():
-                        error_msg = "OpenAI API billing limit reached. Please check your API key's usage limits in your OpenAI account dashboard."
-                        return jsonify({
-                            'error': error_msg,
-                            'details': "This usually means you've used all your API credits or reached a spending cap.",
-                            'resolution': "Visit https://platform.openai.com/usage to check your usage and billing status."
-                        }), 402  # 402 Payment Required
-                        
-                    elif 'rate' in error_msg.lower() and 'limit' in error_msg.lower():
-                        return jsonify({
-                            'error': "Rate limit exceeded. Please try again in a moment.",
-                            'details': error_msg
-                        }), 429  # 429 Too Many Requests
-        except:
-            pass
+        body, status_code = request_error_response(e)
+        return jsonify(body), status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def load_conversation_context(data):
+    """Fill data['context'] from the stored conversation; returns (body, status) on error"""
+    conversation_id = data.get('conversation_id')
+    if not conversation_store.get_conversation(conversation_id):
+        return {'error': 'Conversation not found', 'conversation_id': conversation_id}, 404
+    
+    # An explicit context (e.g. continuing from an earlier message) takes precedence
+    if not data.get('context'):
+        data['context'] = conversation_store.get_context(conversation_id, limit=CONVERSATION_HISTORY_LIMIT)
+    return None
+
+def save_conversation_turn(conversation_id, prompt, reply):
+    """Append a prompt/reply pair to a stored conversation, if the request named one"""
+    if not conversation_id:
+        return
+    try:
+        conversation_store.add_message(conversation_id, 'user', prompt)
+        conversation_store.add_message(conversation_id, 'assistant', reply)
+    except Exception as e:
+        print(f"Conversation store error: {str(e)}")
+
+def semantic_cacheable(data, payload):
+    """
+    The settings a reply is scoped by in the semantic cache (output limit and temperature),
+    or None if it may not come from or go into it: only a lone text prompt qualifies, since
+    with history, images or documents the same words can ask something else.
+    Decided even with the cache off, so the log records which replies could warm it later.
+    """
+    if data.get('cache') is False:
+        return None
+    prompt = data.get('prompt', '')
+    if not prompt.strip() or payload['messages'] != [{"role": "user", "content": prompt}]:
+        return None
+    return {
+        'max_tokens': payload.get('max_tokens') or payload.get('max_completion_tokens'),
+        'temperature': payload.get('temperature')
+    }
+
+def remember_completion(prompt, generated_text, model, cache_key=None, semantic=None, latency=None, usage=None):
+    """
+    Cache a finished completion and log it. semantic is semantic_cacheable()'s settings;
+    the reply is cached semantically under them and the model that wrote it.
+    """
+    if cache_key:
+        response_cache.set(cache_key, generated_text)
+    if semantic and semantic_cache:
+        semantic_cache.add(prompt, model, generated_text, latency, settings=semantic)
+    
+    # Log the interaction (optional)
+    try:
+        log_interaction(prompt, generated_text, model=model, latency=latency, usage=usage, semantic=semantic)
+    except Exception as e:
+        print(f"Logging error: {str(e)}")
+
+def should_fail_over(e):
+    """Timeouts, connection failures and 5xx are worth retrying on another model"""
+    if isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    response = getattr(e, 'response', None)
+    return response is not None and response.status_code >= 500
+
+def fetch_completion(payload, prompt, cache_key=None, user=None, semantic=None):
+    """Call the chat completions API, cache and log the generated text; returns (text, model that wrote it)"""
+    def send(attempt_payload):
+        model = attempt_payload['model']
+        with upstream_scheduler.slot(user, model, estimate_tokens(attempt_payload)):
+            response = http_client.post(API_URL, headers=api_headers(), json=attempt_payload)
+            upstream_scheduler.update(model, response.headers)
+        response.raise_for_status()
+        return response, model
+    
+    # Fails over to another enabled model if this one times out or returns 5xx
+    started = time.perf_counter()
+    response, model = model_router.call(payload, send, should_fail_over)
+    
+    result = response.json()
+    generated_text = result['choices'][0]['message']['content']
+    metrics.observe_usage(model, result.get('usage'))
+    
+    remember_completion(prompt, generated_text, model, cache_key, semantic, time.perf_counter() - started, result.get('usage'))
+    return generated_text, model
+
+def sse_event(data, event=None):
+    """Format a single Server-Sent Event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    """Wrap an SSE generator in an unbuffered streaming response"""
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def wants_render(data):
+    """Clients opt into server-rendered HTML with "render": true"""
+    return bool(data.get('render')) and markdown_renderer is not None
+
+def with_html(body, render):
+    """Add the rendered HTML of body['response'] when the client asked for it"""
+    if render:
+        body['html'] = markdown_renderer.render(body['response'])
+    return body
+
+def stream_cached(text, render=False, similarity=None, model=None):
+    """Replay a cached completion using the same SSE events as a live stream"""
+    yield sse_event({'delta': text})
+    done = {'response': text, 'cached': True, 'model': model}
+    if similarity is not None:
+        done['similarity'] = round(similarity, 4)
+    yield sse_event(with_html(done, render), event='done')
+
+def stream_completion(response, prompt, cache_key=None, conversation_id=None, model=None, render=False, semantic=None):
+    """Yield upstream chat completion deltas as SSE and log the full text once finished"""
+    started = time.perf_counter()
+    parts = []
+    text = ''
+    # Rendered deltas carry newly completed blocks plus the re-rendered trailing block
+    stream_render = StreamRender(markdown_renderer) if render else None
+    final_usage = None
+    try:
+        for line in response.iter_lines(decode_unicode=True):
+            finished, delta, usage = parse_stream_line(line)
+            if finished:
+                break
+            final_usage = usage or final_usage
+            if delta:
+                parts.append(delta)
+                event = {'delta': delta}
+                if stream_render:
+                    text += delta
+                    event.update(stream_render.update(text, delta))
+                yield sse_event(event)
+            metrics.observe_usage(model, usage)
+    except Exception as e:
+        print(f"Streaming error: {str(e)}")
+        yield sse_event({'error': f"Streaming interrupted: {str(e)}"}, event='error')
+        return
+    finally:
+        response.close()
+        http_client.finish_stream(response)
+    
+    generated_text = ''.join(parts)
+    
+    save_conversation_turn(conversation_id, prompt, generated_text)
+    remember_completion(prompt, generated_text, model, cache_key, semantic, time.perf_counter() - started, final_usage)
+    
+    yield sse_event(with_html({'response': generated_text, 'model': model}, render), event='done')
+
+def positive_int(value, name):
+    """Parse a client-supplied count; returns (value, error message)"""
+    error = f"'{name}' must be a positive integer"
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        return None, error
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None, error
+    return (number, None) if number >= 1 else (None, error)
+
+def batch_items(data, max_items=BATCH_MAX_ITEMS):
+    """Merge shared settings into each batch item; returns (items, error message)"""
+    raw_items = data.get('items')
+    if raw_items is None:
+        raw_items = data.get('prompts')
+    if not isinstance(raw_items, list) or not raw_items:
+        return None, "Provide a non-empty 'items' (or 'prompts') list"
+    if len(raw_items) > max_items:
+        return None, f"A batch can hold at most {max_items} items"
+    
+    shared = {key: data[key] for key in ('model', 'temperature', 'max_length', 'cache') if key in data}
+    items = []
+    for index, item in enumerate(raw_items):
+        if isinstance(item, str):
+            item = {'prompt': item}
+        if not isinstance(item, dict) or not item.get('prompt'):
+            return None, f"Item {index} needs a prompt"
+        item = {**shared, **item}
+        if 'max_length' in item:
+            item['max_length'], error = positive_int(item['max_length'], 'max_length')
+            if error:
+                return None, f"Item {index}: {error}"
+        if 'temperature' in item and (isinstance(item['temperature'], bool) or not isinstance(item['temperature'], (int, float))):
+            return None, f"Item {index}: 'temperature' must be a number"
+        items.append(item)
+    return items, None
+
+def generate_batch_item(index, data, user):
+    """Run one batch item like a non-streaming /generate; failures are returned, not raised"""
+    result = {'index': index}
+    if 'id' in data:
+        result['id'] = data['id']
+    try:
+        if data.get('image_id') and not file_store.exists(data['image_id']):
+            return {**result, 'status': 400, 'error': 'Unknown image_id. Upload the image again.'}
+        payload = build_chat_payload(data)
         
-        return jsonify({'error': f"API Error: {error_msg}"}), status_code
+        cache_key = make_cache_key(payload) if response_cache and should_cache(data) else None
+        cached_text = response_cache.get(cache_key) if cache_key else None
+        if cached_text is not None:
+            return {**result, 'status': 200, 'response': cached_text, 'cached': True, 'model': payload['model']}
+        semantic = semantic_cacheable(data, payload)
+        similar = semantic_cache.lookup(data['prompt'], payload['model'], semantic) if semantic and semantic_cache else None
+        if similar:
+            return {**result, 'status': 200, 'response': similar[0], 'cached': True, 'similarity': round(similar[1], 4),
+                    'model': payload['model']}
+        
+        generated_text, model = inflight_requests.do(
+            request_key('chat', payload),
+            lambda: fetch_completion(payload, data['prompt'], cache_key, user, semantic)
+        )
+        return {**result, 'status': 200, 'response': generated_text, 'model': model}
+    
+    except (ModelUnavailable, InvalidParameter) as e:
+        return {**result, 'status': 400, 'error': str(e)}
+    except SchedulerRejected as e:
+        return {**result, 'status': e.status_code, 'error': str(e), 'retry_after': e.retry_after}
+    except requests.exceptions.RequestException as e:
+        body, status_code = request_error_response(e)
+        return {**result, 'status': status_code, **body}
+    except Exception as e:
+        return {**result, 'status': 500, 'error': str(e)}
+
+def run_batch(items, user, concurrency):
+    """Yield item results as they complete, keeping at most concurrency items in flight"""
+    remaining = iter(enumerate(items))
+    pending = {
+        batch_executor.submit(generate_batch_item, index, data, user)
+        for index, data in itertools.islice(remaining, concurrency)
+    }
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+            for index, data in itertools.islice(remaining, 1):
+                pending.add(batch_executor.submit(generate_batch_item, index, data, user))
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """Generate many prompts in one request, as one JSON result list or NDJSON as each completes"""
+    data = request.get_json(silent=True) or {}
+    provider = data.get('mode') == 'provider'
+    items, error = batch_items(data, BATCH_PROVIDER_MAX_ITEMS if provider else BATCH_MAX_ITEMS)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    if provider:
+        return submit_provider_batch(items)
+    
+    concurrency, error = positive_int(data.get('concurrency', BATCH_CONCURRENCY), 'concurrency')
+    if error:
+        return jsonify({'error': error}), 400
+    concurrency = min(concurrency, BATCH_CONCURRENCY)
+    results = run_batch(items, client_id(), concurrency)
+    
+    if data.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return Response(
+            (json.dumps(result) + '\n' for result in results),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    
+    results = sorted(results, key=lambda result: result['index'])
+    succeeded = sum(1 for result in results if result['status'] == 200)
+    return jsonify({'results': results, 'succeeded': succeeded, 'failed': len(results) - succeeded})
+
+def provider_batch_summary(batch):
+    return {
+        'batch_id': batch['id'],
+        'status': batch['status'],
+        'request_counts': batch.get('request_counts'),
+        'created_at': batch.get('created_at'),
+        'completed_at': batch.get('completed_at'),
+        'status_url': url_for('get_provider_batch', batch_id=batch['id'])
+    }
+
+def submit_provider_batch(items):
+    """Hand a batch to the provider's asynchronous Batch API; poll status_url for results"""
+    try:
+        payloads = [build_chat_payload(data) for data in items]
+        batch = provider_batches.submit(payloads, metadata={'source': 'generate_batch'})
+    except (ModelUnavailable, InvalidParameter) as e:
+        return jsonify({'error': str(e)}), 400
+    except requests.exceptions.RequestException as e:
+        body, status_code = request_error_response(e)
+        return jsonify(body), status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    
+    response = jsonify(provider_batch_summary(batch))
+    response.status_code = 202
+    response.headers['Location'] = url_for('get_provider_batch', batch_id=batch['id'])
+    return response
+
+@app.route('/generate/batch/<batch_id>', methods=['GET'])
+def get_provider_batch(batch_id):
+    """Status of a provider batch, with per-item results once it has completed"""
+    try:
+        batch = provider_batches.status(batch_id)
+        body = provider_batch_summary(batch)
+        if batch['status'] == 'completed':
+            body['results'] = provider_batches.results_for(batch)
+        return jsonify(body)
+    except requests.exceptions.RequestException as e:
+        body, status_code = request_error_response(e)
+        return jsonify(body), status_code
 
 @app.route('/generate-image', methods=['POST'])
 def generate_image():
-    """Generate an image using DALL-E based on the prompt"""
+    """Start a DALL-E image job, or reuse a stored or in-progress one for the same request"""
     data = request.json
     prompt = data.get('prompt', '')
-    size = data.get('size', '512x512')
     
     if not prompt:
         return jsonify({'error': 'Prompt is required'}), 400
     
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY}"
-        }
+        payload = build_image_payload(data)
+        job = image_jobs.find_reusable(payload)
+        if job and job['status'] == 'succeeded' and not file_store.exists(job['file_id']):
+            image_jobs.mark_failed(job['id'], 'Stored image is no longer available', 410)
+            job = None
         
-        # Fixed payload: Use proper model name "dall-e-2" instead of "gpt-4o-mini"
-        payload = {
-            "model": "dall-e-2",  # Correct model name for DALL-E 2
-            "prompt": prompt,
-            "n": 1,
-            "size": size
-        }
+        cached = job is not None
+        if job is None:
+            # Concurrent identical requests all land on the one job that wins the insert
+            job, created = image_jobs.create(payload)
+            cached = not created
+            if created:
+                image_executor.submit(run_image_job, job['id'], payload, client_id())
         
-        # DALL-E API endpoint is different
-        response = requests.post(
-            "https://api.openai.com/v1/images/generations",
-            headers=headers,
+        return image_job_response(job, cached)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-image/<job_id>', methods=['GET'])
+def get_image_job(job_id):
+    """Status of an image job; includes the stored image URL once it has succeeded"""
+    job = image_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Image job not found'}), 404
+    return image_job_response(job)
+
+def image_job_response(job, cached=False):
+    """202 while a job is pending, 200 with image_url once stored, the upstream's status on failure"""
+    body = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': url_for('get_image_job', job_id=job['id']),
+        'cached': cached
+    }
+    if job['status'] == 'succeeded':
+        body['image_url'] = url_for('serve_upload', file_id=job['file_id'], _external=True)
+        body['file_id'] = job['file_id']
+        return jsonify(body), 200
+    if job['status'] == 'failed':
+        body['error'] = job['error']
+        return jsonify(body), job['error_status'] or 500
+    return jsonify(body), 202
+
+def run_image_job(job_id, payload, user):
+    """Worker: generate the image, copy it into the file store and record the outcome"""
+    if not image_jobs.mark_running(job_id):
+        return
+    try:
+        image_url = fetch_image(payload, payload['prompt'], user)
+        file_id = store_generated_image(image_url, payload['prompt'])
+        image_jobs.mark_succeeded(job_id, file_id)
+    except SchedulerRejected as e:
+        image_jobs.mark_failed(job_id, str(e), e.status_code)
+    except requests.exceptions.RequestException as e:
+        # Rate-limit messages are passed through as-is for image generation
+        body, status_code = request_error_response(e, check_rate_limit=False)
+        image_jobs.mark_failed(job_id, body['error'], status_code)
+    except Exception as e:
+        print(f"Image job {job_id} failed: {str(e)}")
+        image_jobs.mark_failed(job_id, str(e), 500)
+
+def store_generated_image(image_url, prompt):
+    """Download an upstream image URL (they expire) into the file store; returns its file ID"""
+    response = http_client.get(image_url)
+    response.raise_for_status()
+    
+    mime_type = response.headers.get('Content-Type', 'image/png').split(';')[0].strip()
+    extension = (mimetypes.guess_extension(mime_type) or '.png').lstrip('.')
+    if extension not in IMAGE_EXTENSIONS:
+        extension, mime_type = 'png', 'image/png'
+    
+    file_id, file_size, _ = file_store.save_stream(io.BytesIO(response.content), extension)
+    name = secure_filename(prompt[:40]) or 'image'
+    file_catalog.add(file_id, f"dalle-{name}.{extension}", mime_type, file_size)
+    return file_id
+
+def fetch_image(payload, prompt, user=None):
+    """Call the DALL-E API and log the generated image URL"""
+    # DALL-E API endpoint is different; image requests count against the request budget only
+    with upstream_scheduler.slot(user, payload['model'], 0):
+        response = http_client.post(
+            IMAGES_API_URL,
+            headers=api_headers(),
             json=payload
         )
-        
-        response.raise_for_status()
-        result = response.json()
-        image_url = result['data'][0]['url']
-        
-        # Log the interaction (optional)
-        try:
-            log_interaction(f"Image generation: {prompt}", f"Generated image: {image_url}")
-        except Exception as e:
-            print(f"Logging error: {str(e)}")
-        
-        return jsonify({'image_url': image_url})
+        upstream_scheduler.update(payload['model'], response.headers)
     
-    except requests.exceptions.RequestException as e:
-        error_msg = str(e)
-        status_code = 500
-        try:
-            if hasattr(e, 'response') and e.response is not None:
-                error_json = e.response.json()
-                status_code = e.response.status_code
-                
-                if 'error' in error_json:
-                    error_msg = error_json['error'].get('message', str(e))
-                    
-                    # Handle specific OpenAI API errors for image generation
-                    if 'billing' in error_msg.lower() and 'limit' in error_msg.lower():
-                        error_msg = "OpenAI API billing limit reached. Please check your API key's usage limits in your OpenAI account dashboard."
-                        return jsonify({
-                            'error': error_msg,
-                            'details': "This usually means you've used all your API credits or reached a spending cap.",
-                            'resolution': "Visit https://platform.openai.com/usage to check your usage and billing status."
-                        }), 402  # 402 Payment Required
-        except:
-            pass
-            
-        return jsonify({'error': f"API Error: {error_msg}"}), status_code
+    response.raise_for_status()
+    result = response.json()
+    image_url = result['data'][0]['url']
+    
+    # Log the interaction (optional)
+    try:
+        log_interaction(f"Image generation: {prompt}", f"Generated image: {image_url}", model=payload['model'], kind='image')
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        print(f"Logging error: {str(e)}")
+    
+    return image_url
+
+@app.route('/render', methods=['POST'])
+def render_markdown():
+    """Render Markdown to sanitized HTML: {"text": ...} or {"texts": [...]} for a whole chat history"""
+    if markdown_renderer is None:
+        return jsonify({'error': 'Server-side rendering is not available'}), 501
+    
+    data = request.get_json(silent=True) or {}
+    if isinstance(data.get('texts'), list):
+        if not all(isinstance(text, str) for text in data['texts']):
+            return jsonify({'error': "'texts' must be a list of strings"}), 400
+        return jsonify({'html': [markdown_renderer.render(text) for text in data['texts']]})
+    if not isinstance(data.get('text'), str):
+        return jsonify({'error': "Provide 'text' or 'texts'"}), 400
+    return jsonify({'html': markdown_renderer.render(data['text'])})
+
+@app.route('/render/highlight.css', methods=['GET'])
+def render_stylesheet():
+    """Pygments colors for server-rendered code blocks"""
+    if markdown_renderer is None:
+        return Response('', mimetype='text/css')
+    response = Response(markdown_renderer.stylesheet(), mimetype='text/css')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Enabled models with their capabilities and rolling latency / error stats"""
+    return jsonify({'default': model_router.default_model, 'models': model_router.stats()})
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Report response cache hit/miss counters and size"""
+    semantic = semantic_cache.stats() if semantic_cache else {'enabled': False}
+    if not response_cache:
+        return jsonify({'enabled': False, 'semantic': semantic})
+    return jsonify({'enabled': True, **response_cache.stats(), 'semantic': semantic})
+
+@app.route('/conversations', methods=['GET'])
+def list_conversations():
+    """List stored conversations, most recently updated first, one page at a time"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    try:
+        conversations, next_cursor = conversation_store.list_conversations(limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'conversations': conversations, 'next_cursor': next_cursor})
+
+@app.route('/conversations', methods=['POST'])
+def create_conversation():
+    """Create an empty conversation"""
+    data = request.get_json(silent=True) or {}
+    conversation = conversation_store.create_conversation(data.get('title') or 'New Chat')
+    return jsonify(conversation), 201
+
+@app.route('/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """Return a conversation with a page of its messages (pass before=<message id> for older ones)"""
+    conversation = conversation_store.get_conversation(conversation_id)
+    if not conversation:
+        return jsonify({'error': 'Conversation not found'}), 404
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    messages = conversation_store.get_messages(conversation_id, limit, request.args.get('before', type=int))
+    return jsonify({**conversation, 'messages': messages})
+
+@app.route('/conversations/<conversation_id>', methods=['PATCH'])
+def rename_conversation(conversation_id):
+    """Update a conversation's title"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('title'):
+        return jsonify({'error': 'Title is required'}), 400
+    if not conversation_store.update_title(conversation_id, data['title']):
+        return jsonify({'error': 'Conversation not found'}), 404
+    return jsonify(conversation_store.get_conversation(conversation_id))
+
+@app.route('/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    """Delete a conversation and its messages"""
+    if not conversation_store.delete_conversation(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    return jsonify({'deleted': conversation_id})
+
+def parse_timestamp(value):
+    """Parse an epoch number or ISO 8601 string from a query parameter"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
 # Add a route to list all files
 @app.route('/files', methods=['GET'])
 def list_files():
-    """List all uploaded files"""
-    files = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.isfile(filepath):
-            file_url = url_for('static', filename=f'uploads/{filename}', _external=True)
-            files.append({
-                'filename': filename,
-                'url': file_url,
-                'size': os.path.getsize(filepath),
-                'modified': os.path.getmtime(filepath)
-            })
-    
-    return jsonify(files)
-
-def log_interaction(prompt, response):
-    """Log each interaction to a file (optional)"""
-    log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-    
-    # Create logs directory if it doesn't exist
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
-    log_file = os.path.join(log_dir, 'interactions.jsonl')
-    
-    # Append the interaction to the log file
-    with open(log_file, 'a') as f:
-        interaction = {
-            'prompt': prompt,
-            'response': response,
-            'timestamp': datetime.now().isoformat()
-        }
-        f.write(json.dumps(interaction) + '\n')
+    """
+    List uploaded files from the metadata catalog, one page at a time.
+    Query parameters: limit, cursor, sort (uploaded_at|size|name), order (asc|desc),
+    type (e.g. image or image/png), ext, since and until (epoch or ISO 8601).
+    """
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    try:
+        files, next_cursor = file_catalog.list(
+            limit=limit,
+            cursor=request.args.get('cursor'),
+            sort=request.args.get('sort', 'uploaded_at'),
+            order=request.args.get('order', 'desc').lower(),
+            mime_type=request.args.get('type'),
+            extension=request.args.get('ext'),
+            since=parse_timestamp(request.args.get('since')),
+            until=parse_timestamp(request.args.get('until'))
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Build URLs from one prefix instead of a url_for call per file
+    url_prefix = url_for('serve_upload', file_id='_', _external=True)[:-1]
+    return jsonify({
+        'files': [
+            {
+                'filename': entry['file_id'],
+                'original_filename': entry['original_name'],
+                'url': url_prefix + entry['file_id'],
+                'size': entry['size'],
+                'type': entry['mime_type'],
+                'hash': entry['sha256'],
+                'modified': entry['uploaded_at']
+            }
+            for entry in files
+        ],
+        'next_cursor': next_cursor
+    })
+
+def log_interaction(prompt, response, model=None, latency=None, kind='chat', usage=None, semantic=None):
+    """
+    Queue an interaction for the background log writer (never blocks on disk I/O).
+    semantic is the settings of a reply to a lone prompt, the only kind the semantic cache warms from.
+    """
+    record = {
+        'prompt': prompt,
+        'response': response,
+        'timestamp': datetime.now().isoformat(),
+        'kind': kind
+    }
+    if model:
+        record['model'] = model
+    if latency is not None:
+        record['latency_ms'] = round(latency * 1000, 1)
+    if usage:
+        record['usage'] = {key: usage[key] for key in ('prompt_tokens', 'completion_tokens', 'total_tokens') if key in usage}
+    if semantic:
+        record['semantic'] = semantic
+    interaction_logger.log(record)
 
 @app.errorhandler(404)
 def not_found(e):
@@ -345,8 +1174,89 @@ def not_found(e):
 
 @app.route('/health')
 def health_check():
-    """Simple health check endpoint to verify server is running"""
-    return jsonify({"status": "ok", "timestamp": datetime.now().isoformat()}), 200
+    """Readiness check: 200 when storage is usable and the API key is set, 503 otherwise"""
+    def check_upload_folder():
+        file_store.ensure_dirs()
+        if not os.access(file_store.tmp_dir, os.W_OK):
+            raise OSError(f"{file_store.tmp_dir} is not writable")
+    
+    checks = {}
+    for name, check in (
+        ('conversation_store', lambda: conversation_store.list_conversations(limit=1)),
+        ('file_catalog', file_catalog.is_empty),
+        ('image_jobs', image_jobs.stats),
+        ('upload_folder', check_upload_folder)
+    ):
+        try:
+            check()
+            checks[name] = 'ok'
+        except Exception as e:
+            checks[name] = f"error: {str(e)}"
+    checks['api_key'] = 'ok' if API_KEY else 'missing'
+    
+    ready = all(value == 'ok' for value in checks.values())
+    return jsonify({
+        "status": "ok" if ready else "unavailable",
+        "timestamp": datetime.now().isoformat(),
+        "uptime_seconds": round(time.time() - metrics.START_TIME, 1),
+        "checks": checks,
+        "interaction_log": interaction_logger.stats(),
+        "response_cache": response_cache.stats() if response_cache else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "upstream_scheduler": upstream_scheduler.stats(),
+        "image_jobs": image_jobs.stats(),
+        "partial_uploads": chunked_uploads.count(),
+        "models": model_router.stats(),
+        "markdown_renderer": markdown_renderer.stats() if markdown_renderer else None
+    }), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def collect_app_metrics():
+    """Gauges and counters read from other components at scrape time"""
+    values = [
+        ('upstream_active', 'gauge', 'Upstream calls holding a scheduler slot', upstream_scheduler.active),
+        ('upstream_queued', 'gauge', 'Requests waiting for an upstream slot', upstream_scheduler.queued),
+        ('singleflight_coalesced_total', 'counter', 'Requests served by waiting on an identical in-flight call', inflight_requests.coalesced),
+        ('interaction_log_queued', 'gauge', 'Interaction records waiting to be written', interaction_logger.stats()['queued']),
+        ('interaction_log_written_total', 'counter', 'Interaction records written', interaction_logger.written),
+        ('interaction_log_dropped_total', 'counter', 'Interaction records dropped because the queue was full', interaction_logger.dropped)
+    ]
+    job_counts = image_jobs.stats()
+    values += [
+        ('image_jobs_queued', 'gauge', 'Image jobs waiting for a worker', job_counts['queued']),
+        ('image_jobs_running', 'gauge', 'Image jobs generating or downloading', job_counts['running'])
+    ]
+    if markdown_renderer:
+        stats = markdown_renderer.stats()
+        values += [
+            ('render_cache_hits_total', 'counter', 'Rendered Markdown blocks served from cache', stats['hits']),
+            ('render_cache_misses_total', 'counter', 'Markdown blocks rendered', stats['misses']),
+            ('render_cache_entries', 'gauge', 'Rendered blocks held in cache', stats['entries'])
+        ]
+    if semantic_cache:
+        stats = semantic_cache.stats()
+        values += [
+            ('semantic_cache_hits_total', 'counter', 'Replies served for a near-duplicate prompt', stats['hits']),
+            ('semantic_cache_misses_total', 'counter', 'Semantic cache lookups without a close enough prompt', stats['misses']),
+            ('semantic_cache_saved_seconds_total', 'counter', 'Generation time of the replies served from the semantic cache', stats['saved_seconds']),
+            ('semantic_cache_entries', 'gauge', 'Prompts in the semantic cache', stats['entries'])
+        ]
+    if response_cache:
+        stats = response_cache.stats()
+        values += [
+            ('response_cache_hits_total', 'counter', 'Response cache hits', stats['hits']),
+            ('response_cache_misses_total', 'counter', 'Response cache misses', stats['misses']),
+            ('response_cache_hit_ratio', 'gauge', 'Response cache hits / lookups', stats['hit_rate']),
+            ('response_cache_entries', 'gauge', 'Entries in the response cache', stats['entries']),
+            ('response_cache_bytes', 'gauge', 'Bytes held by the response cache', stats['size_bytes'])
+        ]
+    return values
+
+metrics.register_collector(collect_app_metrics)
 
 @app.route('/upload-test')
 def upload_test_page():
@@ -357,11 +1267,10 @@ def upload_test_page():
             'exists': os.path.exists(app.config['UPLOAD_FOLDER']),
             'writable': os.access(app.config['UPLOAD_FOLDER'], os.W_OK) if os.path.exists(app.config['UPLOAD_FOLDER']) else False
         },
-        'STATIC_UPLOADS': {
-            'path': os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_UPLOAD_PATH),
-            'exists': os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_UPLOAD_PATH)),
-            'writable': os.access(os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_UPLOAD_PATH), os.W_OK) 
-                      if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_UPLOAD_PATH)) else False
+        'FILE_STORE': {
+            'path': file_store.root,
+            'exists': os.path.exists(file_store.root),
+            'writable': os.access(file_store.root, os.W_OK) if os.path.exists(file_store.root) else False
         }
     }
     
@@ -473,27 +1382,48 @@ def upload_test_page():
     
     return html
 
-if __name__ == '__main__':
+def create_app():
+    """Prepare storage and return the Flask app; used by wsgi.py, asgi.py and the dev server"""
     if not API_KEY:
         print("Warning: OPENAI_API_KEY environment variable not set")
         print("Please set your OpenAI API key in the .env file")
-    
-    # Try to run the app on port 5001 or find another available port
-    port = 5001
+
+    # Ensure upload directories exist
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+        print(f"Created upload directory: {UPLOAD_FOLDER}")
+    file_store.ensure_dirs()
+
+    # Files stored before the catalog existed are indexed once
+    guess_mime_type = lambda name: mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if file_catalog.is_empty():
+        file_catalog.backfill(file_store.iter_files(), guess_mime_type)
+    # Uploads saved flat in UPLOAD_FOLDER by older versions move into the store, listed under their old names
+    for file_id, name, size, modified in file_store.adopt_legacy_files(UPLOAD_FOLDER, allowed_file):
+        file_catalog.add(file_id, name, guess_mime_type(name), size, modified)
+        print(f"Moved legacy upload {name} into the file store as {file_id}")
+    return app
+
+if __name__ == '__main__':
+    # Development server only; production runs gunicorn with wsgi.py (see start.sh)
+    create_app()
+    debug = os.getenv("FLASK_DEBUG", "1") == "1"
+
+    # Try to run the app on PORT or find another available port
+    port = int(os.getenv("PORT", 5001))
     max_port_attempts = 10
     
     for attempt in range(max_port_attempts):
         try:
             print(f"Trying to start server on port {port}...")
             # Bind to 0.0.0.0 instead of the default 127.0.0.1 to allow external connections
-            # Increased threaded workers and improved timeout settings
             app.run(
-                debug=True, 
+                debug=debug, 
                 port=port, 
                 host='0.0.0.0',
                 threaded=True,
-                use_reloader=True,
-                use_debugger=True
+                use_reloader=debug,
+                use_debugger=debug
             )
             break  # If successful, break out of the loop
         except OSError as e:
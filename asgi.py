@@ -0,0 +1,326 @@
+"""
+ASGI entry point for the GPT Clone app
+
+/generate is served by an async view that awaits the upstream API on a shared
+connection pool, so an in-flight generation costs a coroutine instead of an OS
+thread. Every other route, including /generate-image (which only enqueues a
+background job), is served by the Flask app.
+
+Run with: uvicorn asgi:application --host 0.0.0.0 --port 5001
+"""
+import time
+from contextlib import asynccontextmanager
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import http_client
+import metrics
+from single_flight import AsyncSingleFlight, request_key
+from rate_limiter import SchedulerRejected, estimate_tokens
+from model_router import ModelUnavailable
+from markdown_renderer import StreamRender
+from app import (
+    create_app,
+    API_URL,
+    api_headers,
+    load_conversation_context,
+    save_conversation_turn,
+    api_error_response,
+    build_chat_payload,
+    InvalidParameter,
+    file_store,
+    make_cache_key,
+    markdown_renderer,
+    model_router,
+    parse_stream_line,
+    remember_completion,
+    response_cache,
+    semantic_cache,
+    semantic_cacheable,
+    should_cache,
+    sse_event,
+    stream_cached,
+    upstream_scheduler,
+    wants_render,
+    with_html
+)
+
+flask_app = create_app()
+
+# Concurrent identical upstream requests await one in-flight call
+inflight_requests = AsyncSingleFlight()
+metrics.register_collector(lambda: [(
+    'async_singleflight_coalesced_total', 'counter',
+    'Async requests served by awaiting an identical in-flight call', inflight_requests.coalesced
+)])
+
+class UpstreamError(Exception):
+    """A failed upstream response, read up front so coalesced callers can share it"""
+
+    def __init__(self, status_code, message, error_json=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_json = error_json
+
+async def raise_for_upstream(response):
+    """Raise UpstreamError for a 4xx/5xx upstream response"""
+    if response.status_code < 400:
+        return
+    error_json = None
+    try:
+        await response.aread()
+        error_json = response.json()
+    except Exception:
+        pass
+    finally:
+        await response.aclose()
+    raise UpstreamError(response.status_code, f"{response.status_code} Error for url: {response.url}", error_json)
+
+def upstream_error_response(e, check_rate_limit=True):
+    """Translate an UpstreamError into a JSON error response"""
+    body, status_code = api_error_response(str(e), e.status_code, e.error_json, check_rate_limit)
+    return JSONResponse(body, status_code=status_code)
+
+def transport_error_response(e):
+    """Translate an httpx transport error (timeout, connection failure) into a JSON error response"""
+    status_code = 504 if isinstance(e, httpx.TimeoutException) else 500
+    body, status_code = api_error_response(str(e) or type(e).__name__, status_code)
+    return JSONResponse(body, status_code=status_code)
+
+def should_fail_over(e):
+    """Timeouts, connection failures and 5xx are worth retrying on another model"""
+    if isinstance(e, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    return isinstance(e, UpstreamError) and e.status_code >= 500
+
+async def safe_remember_completion(prompt, generated_text, model, cache_key=None, semantic=None, latency=None, usage=None):
+    """Cache and log a finished completion without stalling the event loop"""
+    # The SQLite cache write, the semantic embedding and (with back-pressure) the log enqueue all block
+    await run_in_threadpool(remember_completion, prompt, generated_text, model, cache_key, semantic, latency, usage)
+
+async def render_html(body, render):
+    """with_html off the event loop: Markdown and Pygments rendering is CPU-bound"""
+    if not render:
+        return body
+    return await run_in_threadpool(with_html, body, render)
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that runs on_close however the response ends, client disconnects included"""
+
+    def __init__(self, *args, on_close=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.on_close:
+                self.on_close()
+
+def sse_response(events, on_close=None):
+    """Wrap an SSE generator in an unbuffered streaming response"""
+    return ClosingStreamingResponse(
+        events,
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        on_close=on_close
+    )
+
+def client_id(request):
+    """Key for fair upstream queueing: an X-User-Id header, else the client address"""
+    return request.headers.get('x-user-id') or (request.client.host if request.client else 'anonymous')
+
+def scheduler_rejected_response(e):
+    """JSON error for a request the upstream scheduler shed, with a Retry-After hint"""
+    return JSONResponse(
+        {'error': str(e), 'retry_after': e.retry_after},
+        status_code=e.status_code,
+        headers={'Retry-After': str(e.retry_after)}
+    )
+
+async def stream_completion(response, prompt, cache_key=None, conversation_id=None, model=None, render=False, semantic=None):
+    """Async twin of app.stream_completion: relay deltas as SSE, then log the full text"""
+    started = time.perf_counter()
+    parts = []
+    text = ''
+    stream_render = StreamRender(markdown_renderer) if render else None
+    final_usage = None
+    try:
+        async for line in response.aiter_lines():
+            finished, delta, usage = parse_stream_line(line)
+            if finished:
+                break
+            final_usage = usage or final_usage
+            if delta:
+                parts.append(delta)
+                event = {'delta': delta}
+                if stream_render:
+                    text += delta
+                    event.update(await run_in_threadpool(stream_render.update, text, delta))
+                yield sse_event(event)
+            metrics.observe_usage(model, usage)
+    except Exception as e:
+        print(f"Streaming error: {str(e)}")
+        yield sse_event({'error': f"Streaming interrupted: {str(e)}"}, event='error')
+        return
+    finally:
+        await response.aclose()
+        http_client.finish_stream(response)
+    
+    generated_text = ''.join(parts)
+    await run_in_threadpool(save_conversation_turn, conversation_id, prompt, generated_text)
+    await safe_remember_completion(prompt, generated_text, model, cache_key, semantic, time.perf_counter() - started, final_usage)
+    yield sse_event(await render_html({'response': generated_text, 'model': model}, render), event='done')
+
+async def fetch_completion(payload, prompt, cache_key=None, user=None, semantic=None):
+    """Await the chat completions API, cache and log the generated text; returns (text, model that wrote it)"""
+    async def send(attempt_payload):
+        model = attempt_payload['model']
+        async with upstream_scheduler.async_slot(user, model, estimate_tokens(attempt_payload)):
+            response = await http_client.async_post(API_URL, headers=api_headers(), json=attempt_payload)
+            upstream_scheduler.update(model, response.headers)
+        await raise_for_upstream(response)
+        return response, model
+    
+    started = time.perf_counter()
+    response, model = await model_router.call_async(payload, send, should_fail_over)
+    result = response.json()
+    generated_text = result['choices'][0]['message']['content']
+    metrics.observe_usage(model, result.get('usage'))
+    await safe_remember_completion(prompt, generated_text, model, cache_key, semantic, time.perf_counter() - started,
+                                   result.get('usage'))
+    return generated_text, model
+
+def prepare_generation(data, stream):
+    """
+    Blocking first half of /generate: build the payload, then check the exact and semantic
+    caches. Returns (payload, cache_key, cached_text, semantic, similar).
+    """
+    payload = build_chat_payload(data, stream)
+    cache_key = make_cache_key(payload) if response_cache and should_cache(data) else None
+    cached_text = response_cache.get(cache_key) if cache_key else None
+    semantic = semantic_cacheable(data, payload)
+    similar = None
+    if cached_text is None and semantic and semantic_cache:
+        similar = semantic_cache.lookup(data.get('prompt', ''), payload['model'], semantic)
+    return payload, cache_key, cached_text, semantic, similar
+
+async def generate_text(request):
+    """Async /generate with the same JSON and SSE contracts as the Flask view"""
+    try:
+        data = await request.json()
+    except Exception:
+        return JSONResponse({'error': 'Invalid JSON body'}, status_code=400)
+    prompt = data.get('prompt', '')
+    stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('accept', '')
+    render = wants_render(data)
+    
+    if data.get('image_id') and not file_store.exists(data['image_id']):
+        return JSONResponse({'error': 'Unknown image_id. Upload the image again.'}, status_code=400)
+    
+    conversation_id = data.get('conversation_id')
+    if conversation_id:
+        error = await run_in_threadpool(load_conversation_context, data)
+        if error:
+            return JSONResponse(error[0], status_code=error[1])
+    
+    try:
+        # Building the payload (token counting, image processing, document retrieval) and the
+        # cache lookups (SQLite, the semantic index) block, so they all run off the event loop
+        payload, cache_key, cached_text, semantic, similar = await run_in_threadpool(prepare_generation, data, stream)
+        if cached_text is not None:
+            await run_in_threadpool(save_conversation_turn, conversation_id, prompt, cached_text)
+            if stream:
+                return sse_response(stream_cached(cached_text, render, model=payload['model']))
+            return JSONResponse(await render_html({'response': cached_text, 'cached': True, 'model': payload['model']}, render))
+        
+        # Then a near-duplicate of an earlier prompt
+        if similar:
+            cached_text, similarity = similar
+            await run_in_threadpool(save_conversation_turn, conversation_id, prompt, cached_text)
+            if stream:
+                return sse_response(stream_cached(cached_text, render, similarity, payload['model']))
+            return JSONResponse(await render_html({'response': cached_text, 'cached': True, 'similarity': round(similarity, 4),
+                                                  'model': payload['model']}, render))
+        
+        if stream:
+            user = client_id(request)
+            
+            async def open_stream(attempt_payload):
+                # The upstream slot is held until the stream is closed
+                model = attempt_payload['model']
+                ticket = await upstream_scheduler.acquire_async(user, model, estimate_tokens(attempt_payload))
+                try:
+                    response = await http_client.async_post(API_URL, headers=api_headers(), json=attempt_payload, stream=True)
+                    upstream_scheduler.update(model, response.headers)
+                    await raise_for_upstream(response)
+                except BaseException:
+                    upstream_scheduler.release(ticket)
+                    raise
+                return response, ticket, model
+            
+            response, ticket, model = await model_router.call_async(payload, open_stream, should_fail_over, timed=False)
+            return sse_response(
+                stream_completion(response, prompt, cache_key, conversation_id, model, render, semantic),
+                on_close=lambda: upstream_scheduler.release(ticket)
+            )
+        
+        user = client_id(request)
+        generated_text, model = await inflight_requests.do(
+            request_key('chat', payload),
+            lambda: fetch_completion(payload, prompt, cache_key, user, semantic)
+        )
+        await run_in_threadpool(save_conversation_turn, conversation_id, prompt, generated_text)
+        return JSONResponse(await render_html({'response': generated_text, 'model': model}, render))
+    
+    except (ModelUnavailable, InvalidParameter) as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except SchedulerRejected as e:
+        return scheduler_rejected_response(e)
+    except UpstreamError as e:
+        return upstream_error_response(e)
+    except httpx.HTTPError as e:
+        return transport_error_response(e)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+def instrumented(route, view):
+    """Record request metrics for a native async view, as app.record_request_metrics does for Flask"""
+    async def endpoint(request):
+        started = time.perf_counter()
+        status_code = 500
+        response = None
+        try:
+            response = await view(request)
+            status_code = response.status_code
+            return response
+        finally:
+            body = getattr(response, 'body', None)
+            metrics.record_request(
+                route,
+                request.method,
+                status_code,
+                time.perf_counter() - started,
+                int(request.headers.get('content-length') or 0),
+                len(body) if body is not None else None
+            )
+    return endpoint
+
+@asynccontextmanager
+async def lifespan(app):
+    """Open the shared upstream client lazily and close it on shutdown"""
+    yield
+    await http_client.close_async_client()
+
+application = Starlette(
+    routes=[
+        Route('/generate', instrumented('/generate', generate_text), methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark: how long importing each entry point takes
+
+Imports app, asgi and check_models in fresh interpreters with
+python -X importtime, several times each, and reports the median import time
+and the slowest modules each one pulls in. Every import runs with the upload,
+log and database paths pointed at an empty temp directory, and fails if
+importing app or check_models created anything there: storage is prepared by
+create_app(), which only the server entry points (asgi, wsgi) call at import.
+
+    python bench/import_time.py --runs 7 --json import_times.json
+    python bench/import_time.py --baseline import_times.json --max-regression 0.2
+
+With --baseline the exit status is 1 when any module's median import time
+regresses by more than --max-regression, so it can gate changes.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("app", "asgi", "check_models")
+# Entry points that call create_app() when imported, so they are expected to create storage
+SERVER_ENTRY_POINTS = {"asgi", "wsgi"}
+
+def isolated_env(workdir):
+    """Environment that points every on-disk store at workdir"""
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": REPO_ROOT,
+        "PYTHONDONTWRITEBYTECODE": "1",
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "LOG_DIR": os.path.join(workdir, "logs"),
+        "CONVERSATION_DB_PATH": os.path.join(workdir, "data", "conversations.sqlite3"),
+        "FILE_CATALOG_DB_PATH": os.path.join(workdir, "data", "files.sqlite3"),
+        "IMAGE_JOB_DB_PATH": os.path.join(workdir, "data", "image_jobs.sqlite3"),
+        "RESPONSE_CACHE_PATH": os.path.join(workdir, "cache", "responses.sqlite3"),
+        "MODELS_CACHE_PATH": os.path.join(workdir, "cache", "models.json"),
+        "LOG_ANALYTICS_DB_PATH": os.path.join(workdir, "logs", "analytics.sqlite3")
+    })
+    return env
+
+def parse_importtime(stderr, module):
+    """(module's cumulative microseconds, {direct import: cumulative microseconds}) from -X importtime output"""
+    total = None
+    children = {}
+    block = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = line.split("|")
+            cumulative = int(cumulative)
+        except ValueError:
+            continue  # The header line
+        indent = len(name) - len(name.lstrip()) - 1
+        name = name.strip()
+        # Imports are printed after everything they import, so a top-level line closes its block
+        if indent == 0:
+            if name == module:
+                total = cumulative
+                children = block
+            block = {}
+        elif indent == 2:
+            block[name] = cumulative
+    return total, children
+
+def measure(module, env, workdir):
+    """One cold import: (wall seconds, import seconds, {direct import: seconds})"""
+    for entry in os.listdir(workdir):
+        shutil.rmtree(os.path.join(workdir, entry), ignore_errors=True)
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=workdir, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    total, children = parse_importtime(result.stderr, module)
+    if total is None:
+        raise RuntimeError(f"No importtime line for {module}")
+    created = sorted(os.listdir(workdir))
+    if created and module not in SERVER_ENTRY_POINTS:
+        raise RuntimeError(f"import {module} created {', '.join(created)} (storage should be set up by create_app())")
+    return wall, total / 1e6, {name: us / 1e6 for name, us in children.items()}
+
+def benchmark(module, runs, top):
+    workdir = tempfile.mkdtemp(prefix="gpt-clone-import-")
+    try:
+        env = isolated_env(workdir)
+        # The first run warms the OS file cache, so every counted run starts alike
+        measure(module, env, workdir)
+        walls, totals, children = [], [], {}
+        for _ in range(runs):
+            wall, total, direct = measure(module, env, workdir)
+            walls.append(wall)
+            totals.append(total)
+            for name, seconds in direct.items():
+                children.setdefault(name, []).append(seconds)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    slowest = sorted(((statistics.median(values), name) for name, values in children.items()), reverse=True)[:top]
+    return {
+        "import_ms": round(statistics.median(totals) * 1000, 1),
+        "import_min_ms": round(min(totals) * 1000, 1),
+        "process_ms": round(statistics.median(walls) * 1000, 1),
+        "slowest_imports": {name: round(seconds * 1000, 1) for seconds, name in slowest}
+    }
+
+def compare(results, baseline, max_regression):
+    """Regression messages for modules present in both runs"""
+    failures = []
+    for module, current in results["modules"].items():
+        previous = baseline.get("modules", {}).get(module)
+        if not previous:
+            continue
+        if current["import_ms"] > previous["import_ms"] * (1 + max_regression):
+            failures.append(f"{module}: import {current['import_ms']}ms vs baseline {previous['import_ms']}ms")
+    return failures
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Import-time benchmark for the GPT Clone entry points")
+    parser.add_argument("--modules", default=",".join(MODULES), help=f"Comma-separated modules to import (default: {', '.join(MODULES)})")
+    parser.add_argument("--runs", type=int, default=5, help="Cold imports per module; the median is reported")
+    parser.add_argument("--top", type=int, default=8, help="Slowest direct imports listed per module")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed fractional regression vs the baseline")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    modules = [name.strip() for name in options.modules.split(",") if name.strip()]
+
+    results = {"python": sys.version.split()[0], "runs": options.runs, "modules": {}}
+    for module in modules:
+        try:
+            report = benchmark(module, options.runs, options.top)
+        except RuntimeError as e:
+            print(f"FAILED {e}")
+            return 1
+        results["modules"][module] = report
+        print(f"{module:<14} import {report['import_ms']:>7.1f}ms (min {report['import_min_ms']:.1f}ms)  "
+              f"process {report['process_ms']:>7.1f}ms")
+        for name, ms in report["slowest_imports"].items():
+            print(f"    {name:<28} {ms:>7.1f}ms")
+
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            failures = compare(results, json.load(f), options.max_regression)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the OpenAI API used by the benchmark suite
+
+Serves /v1/chat/completions (JSON and streaming), /v1/images/generations,
+/v1/models, the generated image files and a minimal Batch API (/v1/files,
+/v1/batches; batches complete as soon as they are created), with
+configurable latency and error / 429 injection. Point the app at it with
+OPENAI_API_BASE=http://127.0.0.1:<port>/v1.
+"""
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "the quick brown fox jumps over the lazy dog while benchmarks measure every request".split()
+
+def solid_png(width=64, height=64, rgb=(90, 120, 200)):
+    """A small valid PNG, built without Pillow"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+IMAGE_BYTES = solid_png()
+
+class RequestWindow:
+    """Sliding one-minute counters used to emit x-ratelimit-* headers"""
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, tokens):
+        """Record a request; returns (remaining requests, remaining tokens, allowed)"""
+        now = time.monotonic()
+        with self.lock:
+            self.events = [(at, count) for at, count in self.events if now - at < 60]
+            used_requests = len(self.events)
+            used_tokens = sum(count for _, count in self.events)
+            allowed = (not self.rpm or used_requests < self.rpm) and (not self.tpm or used_tokens + tokens <= self.tpm)
+            if allowed:
+                self.events.append((now, tokens))
+                used_requests += 1
+                used_tokens += tokens
+            return max(self.rpm - used_requests, 0), max(self.tpm - used_tokens, 0), allowed
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def options(self):
+        return self.server.options
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        """Write one piece of a chunked (keep-alive friendly) streaming body"""
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def simulate_latency(self):
+        delay = self.options.latency + random.uniform(0, self.options.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def injected_failure(self, tokens):
+        """Return (status, body, headers) for an injected or budget-driven failure, or None"""
+        remaining_requests, remaining_tokens, allowed = self.server.window.record(tokens)
+        headers = {}
+        if self.options.rpm:
+            headers["x-ratelimit-limit-requests"] = str(self.options.rpm)
+            headers["x-ratelimit-remaining-requests"] = str(remaining_requests)
+        if self.options.tpm:
+            headers["x-ratelimit-limit-tokens"] = str(self.options.tpm)
+            headers["x-ratelimit-remaining-tokens"] = str(remaining_tokens)
+        self.ratelimit_headers = headers
+
+        if not allowed or random.random() < self.options.rate_limit_rate:
+            return 429, {"error": {"message": "Rate limit reached for requests", "type": "requests"}}, {**headers, "Retry-After": "1"}
+        if random.random() < self.options.error_rate:
+            return 500, {"error": {"message": "The server had an error while processing your request.", "type": "server_error"}}, headers
+        return None
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            models = [{"id": model_id, "object": "model", "created": 1700000000 + i} for i, model_id in enumerate(("gpt-4o-mini", "o1-mini", "dall-e-2"))]
+            self.send_json(200, {"object": "list", "data": models})
+        elif self.path.startswith("/v1/batches/"):
+            batch = self.server.batches.get(self.path.rsplit("/", 1)[-1])
+            if batch is None:
+                self.send_json(404, {"error": {"message": "No such batch"}})
+            else:
+                self.send_json(200, batch)
+        elif self.path.startswith("/v1/files/") and self.path.endswith("/content"):
+            content = self.server.files.get(self.path.split("/")[3])
+            if content is None:
+                self.send_json(404, {"error": {"message": "No such file"}})
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/jsonl")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+        elif self.path.startswith("/images/"):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(IMAGE_BYTES)))
+            self.end_headers()
+            self.wfile.write(IMAGE_BYTES)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.rstrip("/") == "/v1/files":
+            self.upload_file(body)
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Invalid JSON body"}})
+            return
+
+        if self.path.rstrip("/") == "/v1/chat/completions":
+            self.chat_completion(payload)
+        elif self.path.rstrip("/") == "/v1/images/generations":
+            self.image_generation(payload)
+        elif self.path.rstrip("/") == "/v1/batches":
+            self.create_batch(payload)
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def chat_completion(self, payload):
+        completion_tokens = min(payload.get("max_tokens") or payload.get("max_completion_tokens") or self.options.completion_tokens, self.options.completion_tokens)
+        prompt_tokens = sum(len(json.dumps(message.get("content", ""))) // 4 + 4 for message in payload.get("messages", []))
+        failure = self.injected_failure(prompt_tokens + completion_tokens)
+        if payload.get("model") in self.options.failing_models.split(","):
+            failure = 500, {"error": {"message": f"The model {payload['model']} is overloaded.", "type": "server_error"}}, {}
+        self.simulate_latency()
+        if failure:
+            self.send_json(*failure)
+            return
+
+        words = [WORDS[i % len(WORDS)] for i in range(completion_tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        model = payload.get("model", "gpt-4o-mini")
+
+        if not payload.get("stream"):
+            self.send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage
+            }, self.ratelimit_headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in self.ratelimit_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        for i, word in enumerate(words):
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.options.token_delay:
+                time.sleep(self.options.token_delay)
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            self.write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def image_generation(self, payload):
+        failure = self.injected_failure(0)
+        self.simulate_latency()
+        if failure:
+            self.send_json(*failure)
+            return
+        host, port = self.server.server_address[:2]
+        image_id = self.server.next_image_id()
+        self.send_json(200, {
+            "created": int(time.time()),
+            "data": [{"url": f"http://{host}:{port}/images/{image_id}.png"} for _ in range(payload.get("n", 1))]
+        }, self.ratelimit_headers)
+
+    def upload_file(self, body):
+        """Accept a multipart upload and keep the file part in memory"""
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode() + body
+        )
+        content = next((part.get_payload(decode=True) for part in message.iter_parts() if part.get_filename()), None)
+        if content is None:
+            self.send_json(400, {"error": {"message": "Missing file part"}})
+            return
+        file_id = self.server.store_file(content)
+        self.send_json(200, {"id": file_id, "object": "file", "bytes": len(content), "purpose": "batch"})
+
+    def create_batch(self, payload):
+        """Run every request of the input file right away and publish the output file"""
+        content = self.server.files.get(payload.get("input_file_id"))
+        if content is None:
+            self.send_json(404, {"error": {"message": "No such input file"}})
+            return
+        lines = []
+        for line in content.decode().splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            words = [WORDS[i % len(WORDS)] for i in range(min(item["body"].get("max_tokens") or item["body"].get("max_completion_tokens") or self.options.completion_tokens, self.options.completion_tokens))]
+            lines.append(json.dumps({
+                "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "body": {
+                    "object": "chat.completion",
+                    "model": item["body"].get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)}
+                }},
+                "error": None
+            }))
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "object": "batch",
+            "endpoint": payload.get("endpoint"),
+            "input_file_id": payload["input_file_id"],
+            "output_file_id": self.server.store_file(("\n".join(lines) + "\n").encode()),
+            "error_file_id": None,
+            "status": "completed",
+            "created_at": now,
+            "completed_at": now,
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+            "metadata": payload.get("metadata") or {}
+        }
+        self.server.batches[batch["id"]] = batch
+        self.send_json(200, batch)
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, MockHandler)
+        self.options = options
+        self.window = RequestWindow(options.rpm, options.tpm)
+        self.image_counter = 0
+        self.image_lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections is expected, not worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def store_file(self, content):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = content
+        return file_id
+
+    def next_image_id(self):
+        with self.image_lock:
+            self.image_counter += 1
+            return self.image_counter
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Mock OpenAI API for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Base seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random seconds (uniform 0..jitter)")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="Seconds between streamed tokens")
+    parser.add_argument("--completion-tokens", type=int, default=40, help="Words per completion (capped by max_tokens)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests per minute before 429s (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens per minute before 429s (0 = unlimited)")
+    parser.add_argument("--failing-models", default="", help="Comma-separated chat models that always answer 500")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    server = MockServer((options.host, options.port), options)
+    print(f"Mock OpenAI API on http://{options.host}:{options.port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
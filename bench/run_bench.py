@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the GPT Clone app
+
+Starts bench/mock_openai.py and the app (gunicorn, ASGI or the dev server)
+on free ports, drives /generate, /generate-image, /upload and /files at a
+fixed concurrency, and reports throughput, p50/p95/p99 latency, errors and
+server memory. Pass --url to benchmark an already running server instead.
+
+    python bench/run_bench.py --concurrency 16 --requests 200 --json results.json
+    python bench/run_bench.py --baseline results.json --max-regression 0.15
+
+With --baseline the exit status is 1 when any scenario's p95 latency or
+throughput regresses by more than --max-regression, so it can gate changes.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("generate", "generate-stream", "generate-image", "upload", "files")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and its descendants (Linux /proc), or None"""
+    if not os.path.isdir("/proc"):
+        return None
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            children.setdefault(parent, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+class MemorySampler(threading.Thread):
+    """Tracks peak RSS of the server process tree while the benchmark runs"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        rss = process_tree_rss(self.pid)
+        if rss is not None:
+            self.peak = max(self.peak or 0, rss)
+        return rss
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.sample()
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def start_servers(options, workdir):
+    """Start the mock API and the app; returns (base_url, app process, processes to stop)"""
+    mock_port = free_port()
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "bench", "mock_openai.py"), "--port", str(mock_port)] + options.mock_args.split(),
+        stdout=subprocess.DEVNULL
+    )
+    wait_for(f"http://127.0.0.1:{mock_port}/v1/models")
+
+    app_port = free_port()
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="bench",
+        OPENAI_API_BASE=f"http://127.0.0.1:{mock_port}/v1",
+        PORT=str(app_port),
+        FLASK_DEBUG="0",
+        UPLOAD_FOLDER=os.path.join(workdir, "uploads"),
+        LOG_DIR=os.path.join(workdir, "logs"),
+        CONVERSATION_DB_PATH=os.path.join(workdir, "conversations.sqlite3"),
+        FILE_CATALOG_DB_PATH=os.path.join(workdir, "files.sqlite3"),
+        RESPONSE_CACHE_PATH=os.path.join(workdir, "responses.sqlite3"),
+        IMAGE_JOB_DB_PATH=os.path.join(workdir, "image_jobs.sqlite3")
+    )
+    if options.workers:
+        # Rather than --workers, so each worker knows its share of the UPSTREAM_* limits
+        env["WEB_CONCURRENCY"] = str(options.workers)
+    if options.server == "gunicorn":
+        command = ["gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", "/dev/null", "wsgi:application"]
+    elif options.server == "asgi":
+        command = ["uvicorn", "asgi:application", "--host", "127.0.0.1", "--port", str(app_port), "--no-access-log"]
+    else:
+        command = [sys.executable, "app.py"]
+    app = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{app_port}"
+    wait_for(f"{base_url}/health")
+    return base_url, app, [app, mock]
+
+_sessions = threading.local()
+
+def session():
+    """One keep-alive session per benchmark thread"""
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+def run_request(scenario, base_url, i, options):
+    """Issue one request; returns (status code or error name, seconds, time to first byte)"""
+    started = time.perf_counter()
+    try:
+        if scenario == "generate":
+            response = session().post(f"{base_url}/generate", json={"prompt": f"bench prompt {i}", "max_length": 40})
+        elif scenario == "generate-stream":
+            response = session().post(f"{base_url}/generate", json={"prompt": f"bench stream {i}", "max_length": 40, "stream": True}, stream=True)
+            first_byte = None
+            for chunk in response.iter_content(chunk_size=None):
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter() - started
+            response.close()
+            return response.status_code, time.perf_counter() - started, first_byte
+        elif scenario == "generate-image":
+            # Latency runs until the background job has stored the image
+            response = session().post(f"{base_url}/generate-image", json={"prompt": f"bench image {i}"})
+            while response.status_code == 202:
+                time.sleep(0.05)
+                response = session().get(base_url + response.json()["status_url"])
+        elif scenario == "upload":
+            content = f"bench upload {i} {time.time_ns()}\n".encode() * max(1, options.upload_size // 32)
+            response = session().post(f"{base_url}/upload", files={"file": (f"bench-{i}.txt", content, "text/plain")})
+        elif scenario == "files":
+            response = session().get(f"{base_url}/files", params={"limit": 50})
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+        response.content  # Latency includes reading the whole body
+        return response.status_code, time.perf_counter() - started, None
+    except requests.RequestException as e:
+        return type(e).__name__, time.perf_counter() - started, None
+
+def run_scenario(scenario, base_url, options):
+    results = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        for result in pool.map(lambda i: run_request(scenario, base_url, i, options), range(options.requests)):
+            results.append(result)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds for _, seconds, _ in results)
+    first_bytes = sorted(ttfb for _, _, ttfb in results if ttfb is not None)
+    errors = {}
+    for status, _, _ in results:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    report = {
+        "requests": len(results),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "error_rate": round(sum(errors.values()) / len(results), 4),
+        "errors": errors
+    }
+    if first_bytes:
+        report["ttfb_p50_ms"] = round(percentile(first_bytes, 0.50) * 1000, 1)
+        report["ttfb_p95_ms"] = round(percentile(first_bytes, 0.95) * 1000, 1)
+    return report
+
+def compare(results, baseline, max_regression):
+    """Regression messages for scenarios present in both runs"""
+    failures = []
+    for scenario, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if not previous:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            failures.append(f"{scenario}: p95 {current['p95_ms']}ms vs baseline {previous['p95_ms']}ms")
+        if current["throughput_rps"] < previous["throughput_rps"] * (1 - max_regression):
+            failures.append(f"{scenario}: throughput {current['throughput_rps']}/s vs baseline {previous['throughput_rps']}/s")
+        if current["error_rate"] > previous["error_rate"] + 0.01:
+            failures.append(f"{scenario}: error rate {current['error_rate']} vs baseline {previous['error_rate']}")
+    return failures
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the GPT Clone app")
+    parser.add_argument("--url", help="Benchmark a running server instead of starting one")
+    parser.add_argument("--server", choices=("gunicorn", "asgi", "dev"), default="gunicorn")
+    parser.add_argument("--workers", type=int, help="Server worker processes (defaults to the server's own setting)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="Approximate bytes per uploaded file")
+    parser.add_argument("--mock-args", default="", help='Extra mock_openai.py flags, e.g. "--latency 0.2 --rate-limit-rate 0.05"')
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed fractional regression vs the baseline")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    scenarios = [name.strip() for name in options.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    processes = []
+    workdir = tempfile.mkdtemp(prefix="gpt-clone-bench-")
+    try:
+        if options.url:
+            base_url, sampler = options.url.rstrip("/"), None
+        else:
+            base_url, app, processes = start_servers(options, workdir)
+            sampler = MemorySampler(app.pid)
+            sampler.sample()
+            idle_rss = sampler.peak
+            sampler.start()
+
+        results = {"server": options.url or options.server, "concurrency": options.concurrency, "scenarios": {}}
+        for scenario in scenarios:
+            report = run_scenario(scenario, base_url, options)
+            results["scenarios"][scenario] = report
+            extra = f"  ttfb p50 {report['ttfb_p50_ms']}ms" if "ttfb_p50_ms" in report else ""
+            print(
+                f"{scenario:<16} {report['throughput_rps']:>8.1f} req/s  "
+                f"p50 {report['p50_ms']:>7.1f}ms  p95 {report['p95_ms']:>7.1f}ms  p99 {report['p99_ms']:>7.1f}ms  "
+                f"errors {report['error_rate']:.1%}{extra}"
+            )
+
+        if sampler:
+            final_rss = sampler.stop()
+            results["memory"] = {"idle_rss_mb": round(idle_rss / 2**20, 1) if idle_rss else None,
+                                 "peak_rss_mb": round(sampler.peak / 2**20, 1) if sampler.peak else None,
+                                 "final_rss_mb": round(final_rss / 2**20, 1) if final_rss else None}
+            print(f"server memory: idle {results['memory']['idle_rss_mb']} MB, peak {results['memory']['peak_rss_mb']} MB, "
+                  f"final {results['memory']['final_rss_mb']} MB")
+
+        if options.json:
+            with open(options.json, "w") as f:
+                json.dump(results, f, indent=2)
+
+        if options.baseline:
+            with open(options.baseline) as f:
+                failures = compare(results, json.load(f), options.max_regression)
+            for failure in failures:
+                print(f"REGRESSION {failure}")
+            if failures:
+                return 1
+        return 0
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,91 +1,129 @@
 #!/usr/bin/env python3
 """
 Simple utility to check available OpenAI models for your API key
+
+The enabled models are probed concurrently over the shared connection pool, and
+the /models listing is cached for MODELS_CACHE_TTL seconds (--refresh skips it).
+
+    python check_models.py
+    python check_models.py --sequential
+    python check_models.py --refresh --concurrency 2
 """
+import argparse
+import hashlib
 import os
-import requests
+import http_client
 from dotenv import load_dotenv
 import json
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from model_router import create_model_router
 
 # Load API key from .env file
 load_dotenv()
 API_KEY = os.getenv("OPENAI_API_KEY")
+API_BASE_URL = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1").rstrip("/")
 
-if not API_KEY:
-    print("Error: OPENAI_API_KEY not found. Create a .env file with your API key.")
-    exit(1)
+# /models listing cached per API base and key
+MODELS_CACHE_PATH = os.getenv("MODELS_CACHE_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "models.json")
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", 3600))
 
-# Models we're allowed to use
-ALLOWED_MODELS = ["gpt-4o-mini", "o1-mini", "dall-e-2"]
+# Models we're allowed to use: DEFAULT_MODEL plus AVAILABLE_MODELS, as the app sees them
+model_router = create_model_router()
+ALLOWED_MODELS = model_router.models
 
-def check_available_models():
-    """Check which models are available with your API key"""
-    headers = {
+def api_headers():
+    return {
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
     }
-    
+
+def cache_key():
+    # The key itself is never written to disk, only a hash of it
+    return f"{API_BASE_URL} {hashlib.sha256(API_KEY.encode()).hexdigest()[:16]}"
+
+def load_cached_models():
+    """Model IDs from a fresh cache entry for this API base and key, or None"""
     try:
-        response = requests.get(
-            "https://api.openai.com/v1/models",
-            headers=headers
-        )
-        
-        if response.status_code == 200:
-            models = response.json()["data"]
-            
-            # Filter and sort by created date (newest first)
-            models.sort(key=lambda x: x["created"], reverse=True)
-            
-            allowed_available = []
-            not_available = []
-            
-            print("\n=== AVAILABLE MODELS ===\n")
-            
-            # Check which of our allowed models are available
-            for allowed_model in ALLOWED_MODELS:
-                available = any(model["id"] == allowed_model for model in models)
-                if available:
-                    allowed_available.append(allowed_model)
-                else:
-                    not_available.append(allowed_model)
-            
-            # Print available models
-            print("Available allowed models:")
-            if allowed_available:
-                for model_id in allowed_available:
-                    print(f"• {model_id}")
-            else:
-                print("None of the models we need are available with your API key.")
-            
-            # Print unavailable models
-            if not_available:
-                print("\nUnavailable models:")
-                for model_id in not_available:
-                    print(f"• {model_id} (not available with your API key)")
-            
-            if not_available:
-                print("\nThere might be an issue with your API key's model access.")
-                print("Please check your OpenAI account to ensure you have access to the required models.")
-            
-        else:
-            print(f"Error checking models: {response.status_code}")
-            print(response.text)
-    
+        with open(MODELS_CACHE_PATH) as f:
+            entry = json.load(f).get(cache_key())
+    except (FileNotFoundError, ValueError):
+        return None
+    if not entry or time.time() - entry["fetched_at"] > MODELS_CACHE_TTL:
+        return None
+    return entry["models"]
+
+def save_cached_models(model_ids):
+    try:
+        with open(MODELS_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    cache[cache_key()] = {"fetched_at": time.time(), "models": model_ids}
+    os.makedirs(os.path.dirname(MODELS_CACHE_PATH) or ".", exist_ok=True)
+    tmp_path = f"{MODELS_CACHE_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, MODELS_CACHE_PATH)
+
+def list_models(refresh=False):
+    """IDs of the models the API key can see, newest first; None if the request failed"""
+    if not refresh:
+        cached = load_cached_models()
+        if cached is not None:
+            print(f"(model list cached in {MODELS_CACHE_PATH}; --refresh to fetch it again)")
+            return cached
+
+    try:
+        response = http_client.get(f"{API_BASE_URL}/models", headers=api_headers())
     except Exception as e:
         print(f"Error checking models: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error checking models: {response.status_code}")
+        print(response.text)
+        return None
 
-def test_specific_model(model_name):
-    """Test if a specific model is working"""
-    print(f"\nTesting {model_name} access...")
-    
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    test_payload = {
+    # Sort by created date (newest first)
+    models = sorted(response.json()["data"], key=lambda x: x["created"], reverse=True)
+    model_ids = [model["id"] for model in models]
+    save_cached_models(model_ids)
+    return model_ids
+
+def check_available_models(refresh=False):
+    """Check which models are available with your API key"""
+    model_ids = list_models(refresh)
+    if model_ids is None:
+        return
+
+    print("\n=== AVAILABLE MODELS ===\n")
+
+    # Check which of our allowed models are available
+    available = set(model_ids)
+    allowed_available = [model for model in ALLOWED_MODELS if model in available]
+    not_available = [model for model in ALLOWED_MODELS if model not in available]
+
+    # Print available models
+    print("Available allowed models:")
+    if allowed_available:
+        for model_id in allowed_available:
+            print(f"• {model_id}")
+    else:
+        print("None of the models we need are available with your API key.")
+
+    # Print unavailable models
+    if not_available:
+        print("\nUnavailable models:")
+        for model_id in not_available:
+            print(f"• {model_id} (not available with your API key)")
+
+        print("\nThere might be an issue with your API key's model access.")
+        print("Please check your OpenAI account to ensure you have access to the required models.")
+
+def probe_model(model_name):
+    """Send a tiny chat completion to a model; returns (ok, elapsed seconds, error message)"""
+    # Use the parameter names this model accepts (e.g. max_completion_tokens for o1-mini)
+    test_payload = model_router.adapt_payload({
         "model": model_name,
         "messages": [
             {
@@ -94,30 +132,65 @@ def test_specific_model(model_name):
             }
         ],
         "max_tokens": 10
-    }
-    
+    }, model_name)
+
+    started = time.perf_counter()
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
+        response = http_client.post(
+            f"{API_BASE_URL}/chat/completions",
+            headers=api_headers(),
             json=test_payload
         )
-        
-        if response.status_code == 200:
-            print(f"✅ {model_name} test successful!")
-            return True
-        else:
-            print(f"❌ {model_name} test failed with status {response.status_code}")
-            print(response.text)
-            return False
     except Exception as e:
-        print(f"❌ Error testing {model_name}: {e}")
-        return False
+        return False, time.perf_counter() - started, str(e)
+    elapsed = time.perf_counter() - started
+    if response.status_code == 200:
+        return True, elapsed, None
+    return False, elapsed, f"status {response.status_code}: {response.text}"
 
-if __name__ == "__main__":
+def test_specific_model(model_name):
+    """Test if a specific model is working"""
+    print(f"\nTesting {model_name} access...")
+    ok, elapsed, error = probe_model(model_name)
+    report_probe(model_name, ok, elapsed, error)
+    return ok
+
+def report_probe(model_name, ok, elapsed, error):
+    if ok:
+        print(f"✅ {model_name} test successful! ({elapsed:.2f}s)")
+    else:
+        print(f"❌ {model_name} test failed ({elapsed:.2f}s): {error}")
+
+def test_models(models, concurrency):
+    """Probe every model at once (up to concurrency in flight) and report in the configured order"""
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(probe_model, models))
+    for model_name, (ok, elapsed, error) in zip(models, results):
+        report_probe(model_name, ok, elapsed, error)
+    return all(ok for ok, _, _ in results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check which enabled models your API key can use")
+    parser.add_argument("--concurrency", type=int, default=8, help="models probed at once (default: 8)")
+    parser.add_argument("--sequential", action="store_true", help="probe one model at a time")
+    parser.add_argument("--refresh", action="store_true", help="ignore the cached /models listing")
+    args = parser.parse_args()
+
+    if not API_KEY:
+        print("Error: OPENAI_API_KEY not found. Create a .env file with your API key.")
+        exit(1)
+
+    started = time.perf_counter()
     print(f"Checking models available with API key: {API_KEY[:5]}...{API_KEY[-4:]}")
-    check_available_models()
-    
+    check_available_models(args.refresh)
+
     print("\n=== TESTING ALLOWED MODELS ===")
-    for model in ["gpt-4o-mini", "o1-mini"]:
-        test_specific_model(model)
+    if args.sequential:
+        ok = all([test_specific_model(model) for model in model_router.chat_models()])
+    else:
+        ok = test_models(model_router.chat_models(), args.concurrency)
+    print(f"\nChecked in {time.perf_counter() - started:.2f}s")
+    exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
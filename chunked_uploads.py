@@ -0,0 +1,183 @@
+"""
+Resumable chunked uploads
+
+A client starts an upload with the file's name and size, then sends the body
+in pieces, each tagged with the byte offset it starts at. Every piece is
+copied from the request stream to disk in small buffers, so memory per upload
+stays fixed however large the file is. If a connection drops, the client asks
+how many bytes arrived and continues from there. Completing the upload moves
+the assembled file into the content-addressed store without copying it.
+"""
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from file_store import CHUNK_SIZE, SNIFF_BYTES, content_matches
+
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+class UploadError(Exception):
+    """Raised for an upload request that can never succeed; status is the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class UploadConflict(Exception):
+    """Raised when a chunk doesn't start where the upload currently ends (or another chunk is being written)"""
+
+    def __init__(self, message, received):
+        super().__init__(message)
+        self.received = received
+
+class ChunkedUploadStore:
+    """Partial uploads as <root>/<upload_id>/meta.json plus the bytes received so far in <root>/<upload_id>/data"""
+
+    def __init__(self, root, max_size, chunk_size, ttl=86400):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        # Partial uploads not written to for this long are deleted
+        self.ttl = ttl
+
+    def _dir(self, upload_id):
+        if not UPLOAD_ID_PATTERN.match(upload_id or ""):
+            return None
+        return os.path.join(self.root, upload_id)
+
+    def create(self, filename, extension, size, content_type=None):
+        """Start an upload; returns its status"""
+        if size > self.max_size:
+            raise UploadError(f"File is too large. Maximum size is {self.max_size} bytes.", status=413)
+        self.cleanup()
+        upload_id = uuid.uuid4().hex
+        directory = os.path.join(self.root, upload_id)
+        os.makedirs(directory)
+        meta = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "extension": extension,
+            "content_type": content_type,
+            "size": size,
+            "created_at": time.time()
+        }
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        open(os.path.join(directory, "data"), "wb").close()
+        return {**meta, "received": 0}
+
+    def get(self, upload_id):
+        """Status of an upload including bytes received, or None if unknown or expired"""
+        directory = self._dir(upload_id)
+        if directory is None:
+            return None
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                meta = json.load(f)
+            received = os.path.getsize(os.path.join(directory, "data"))
+        except (FileNotFoundError, ValueError):
+            return None
+        return {**meta, "received": received}
+
+    def _locked_data(self, upload_id):
+        """Open an upload's data file for appending with an exclusive lock, so one writer at a time"""
+        upload = self.get(upload_id)
+        if upload is None:
+            raise UploadError("Upload not found", status=404)
+        f = open(os.path.join(self._dir(upload_id), "data"), "ab")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            raise UploadConflict("Another chunk of this upload is still being written", upload["received"])
+        return upload, f
+
+    def append(self, upload_id, offset, stream, length):
+        """
+        Write length bytes from stream at offset, which must equal the bytes received so
+        far. Returns the new received count; bytes written before a dropped connection
+        are kept, so the client resumes from wherever the status says the upload ends.
+        """
+        upload, f = self._locked_data(upload_id)
+        with f:
+            received = os.fstat(f.fileno()).st_size
+            if offset != received:
+                raise UploadConflict(f"Upload is at offset {received}, not {offset}", received)
+            if received + length > upload["size"]:
+                raise UploadError(f"Chunk would exceed the declared size of {upload['size']} bytes")
+            remaining = length
+            while remaining:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.flush()
+            received = os.fstat(f.fileno()).st_size
+
+        # Reject a mismatched file as soon as its first bytes are in, not after the whole upload
+        if offset < SNIFF_BYTES <= received or (offset == 0 and received == upload["size"]):
+            self._check_type(upload)
+        return received
+
+    def _check_type(self, upload):
+        with open(os.path.join(self._dir(upload["upload_id"]), "data"), "rb") as f:
+            head = f.read(SNIFF_BYTES)
+        if not content_matches(head, upload["extension"]):
+            self.discard(upload["upload_id"])
+            raise UploadError(f"File content does not match its .{upload['extension']} extension")
+
+    def complete(self, upload_id, commit):
+        """
+        Hand the finished data file to commit(path, extension), e.g. FileStore.commit_file,
+        and delete the upload. Returns (upload, commit's result).
+        """
+        upload, f = self._locked_data(upload_id)
+        with f:
+            received = os.fstat(f.fileno()).st_size
+            if received != upload["size"]:
+                raise UploadConflict(f"Upload is incomplete: {received} of {upload['size']} bytes received", received)
+            self._check_type(upload)
+            result = commit(os.path.join(self._dir(upload_id), "data"), upload["extension"])
+        self.discard(upload_id)
+        return upload, result
+
+    def discard(self, upload_id):
+        directory = self._dir(upload_id)
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def cleanup(self):
+        """Delete partial uploads that haven't been written to within the TTL"""
+        if not os.path.isdir(self.root):
+            return
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not UPLOAD_ID_PATTERN.match(entry.name):
+                continue
+            try:
+                modified = os.path.getmtime(os.path.join(entry.path, "data"))
+            except FileNotFoundError:
+                modified = entry.stat().st_mtime  # Still being created, or left half-deleted
+            if modified < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def count(self):
+        if not os.path.isdir(self.root):
+            return 0
+        return sum(1 for entry in os.scandir(self.root) if entry.is_dir() and UPLOAD_ID_PATTERN.match(entry.name))
+
+def create_chunked_upload_store(upload_folder, max_content_length):
+    """Build the store configured by MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE and UPLOAD_PARTIAL_TTL"""
+    # Each chunk is one request body, so it must fit under Flask's MAX_CONTENT_LENGTH
+    chunk_size = min(int(os.getenv("UPLOAD_CHUNK_SIZE", 5 * 1024 * 1024)), max_content_length)
+    return ChunkedUploadStore(
+        os.path.join(upload_folder, "partial"),
+        max_size=int(os.getenv("MAX_UPLOAD_SIZE", 100 * 1024 * 1024)),
+        chunk_size=chunk_size,
+        ttl=float(os.getenv("UPLOAD_PARTIAL_TTL", 86400))
+    )
@@ -0,0 +1,109 @@
+"""
+Role-tagged chat history with token-budgeted trimming
+"""
+import math
+import os
+
+# Calibrated estimate for English text with OpenAI tokenizers (~4 characters per token)
+CHARS_PER_TOKEN = 4
+# Per-message framing tokens (role, separators) added by the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+# Conservative cost of one attached image (high detail, single 512px tile plus base)
+IMAGE_TOKENS = 255
+# Longest excerpt of each dropped user turn kept in the summary note
+SUMMARY_EXCERPT_CHARS = 80
+
+_encoding = None
+_encoding_loaded = False
+
+def get_encoding():
+    """Return a tiktoken encoding if the optional package is installed, else None"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = None
+    return _encoding
+
+def count_tokens(text):
+    """Count tokens in text with tiktoken when available, otherwise estimate"""
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def message_tokens(message):
+    """Tokens one chat message contributes to the prompt"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + count_tokens(content)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content or []:
+        if part.get("type") == "image_url":
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += count_tokens(part.get("text", ""))
+    return tokens
+
+def context_to_messages(context):
+    """Convert the client's [{'text', 'sender'}] history into role-tagged messages"""
+    return [
+        {"role": "user" if message.get("sender") == "user" else "assistant", "content": message.get("text", "")}
+        for message in context
+    ]
+
+def input_token_budget(max_length):
+    """Prompt budget: the configured context budget minus room reserved for the completion"""
+    total = int(os.getenv("CONTEXT_TOKEN_BUDGET", 8192))
+    return max(total - int(max_length or 0), 0)
+
+def summarize_dropped(messages, budget):
+    """Cheap extractive summary of dropped turns that fits in budget tokens"""
+    excerpts = []
+    used = count_tokens("Earlier in this conversation the user asked about: ")
+    for message in messages:
+        if message["role"] != "user" or not isinstance(message["content"], str):
+            continue
+        excerpt = " ".join(message["content"].split())[:SUMMARY_EXCERPT_CHARS]
+        cost = count_tokens(excerpt) + 1
+        if not excerpt or used + cost > budget:
+            break
+        excerpts.append(excerpt)
+        used += cost
+    if not excerpts:
+        return None
+    return "Earlier in this conversation the user asked about: " + "; ".join(excerpts)
+
+def trim_messages(messages, budget, summary_role="system"):
+    """
+    Drop the oldest turns until messages fit within budget tokens.
+    The last message (the current prompt) is always kept; dropped turns are
+    replaced by a short summary note when there is room for one.
+    """
+    costs = [message_tokens(message) for message in messages]
+    if sum(costs) <= budget:
+        return messages
+
+    # Keep the newest messages that fit, always including the current prompt
+    kept_from = len(messages) - 1
+    used = costs[-1]
+    summary_budget = max(budget // 10, 0)
+    while kept_from > 0 and used + costs[kept_from - 1] <= budget - summary_budget:
+        kept_from -= 1
+        used += costs[kept_from]
+
+    # A history must not open with an orphaned assistant reply
+    while kept_from < len(messages) - 1 and messages[kept_from]["role"] == "assistant":
+        used -= costs[kept_from]
+        kept_from += 1
+
+    trimmed = messages[kept_from:]
+    summary = summarize_dropped(messages[:kept_from], min(summary_budget, budget - used) - MESSAGE_OVERHEAD_TOKENS)
+    if summary:
+        trimmed = [{"role": summary_role, "content": summary}] + trimmed
+    return trimmed
@@ -0,0 +1,155 @@
+"""
+Server-side conversation storage so clients only send the newest message
+"""
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+from sqlite_store import SQLiteStore
+
+class ConversationStore(ABC):
+    """Interface every conversation backend implements"""
+
+    @abstractmethod
+    def create_conversation(self, title="New Chat"):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_conversation(self, conversation_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_conversations(self, limit=20, cursor=None):
+        """Return (conversations, next_cursor), most recently updated first"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_title(self, conversation_id, title):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_conversation(self, conversation_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_message(self, conversation_id, role, content):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_messages(self, conversation_id, limit=100, before=None):
+        """Return up to limit messages older than message id before, oldest first"""
+        raise NotImplementedError
+
+    def get_context(self, conversation_id, limit=100):
+        """Recent history in the {'text', 'sender'} shape /generate accepts as context"""
+        return [
+            {"text": message["content"], "sender": "user" if message["role"] == "user" else "bot"}
+            for message in self.get_messages(conversation_id, limit=limit)
+        ]
+
+class SQLiteConversationStore(SQLiteStore, ConversationStore):
+    """SQLite backend with one connection per thread"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at, id);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id);
+    """
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def create_conversation(self, title="New Chat"):
+        now = time.time()
+        conversation = {"id": uuid.uuid4().hex, "title": title, "created_at": now, "updated_at": now}
+        self._conn().execute(
+            "INSERT INTO conversations (id, title, created_at, updated_at) VALUES (:id, :title, :created_at, :updated_at)",
+            conversation
+        )
+        return conversation
+
+    def get_conversation(self, conversation_id):
+        row = self._conn().execute(
+            "SELECT id, title, created_at, updated_at FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_conversations(self, limit=20, cursor=None):
+        # Keyset pagination on (updated_at, id): the cursor is the last row of the previous page
+        if cursor:
+            updated_at, last_id = cursor.split(":", 1)
+            rows = self._conn().execute(
+                "SELECT id, title, created_at, updated_at FROM conversations "
+                "WHERE (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (float(updated_at), last_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = self._conn().execute(
+                "SELECT id, title, created_at, updated_at FROM conversations "
+                "ORDER BY updated_at DESC, id DESC LIMIT ?",
+                (limit + 1,)
+            ).fetchall()
+
+        conversations = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = conversations[-1]
+            next_cursor = f"{last['updated_at']!r}:{last['id']}"
+        return conversations, next_cursor
+
+    def update_title(self, conversation_id, title):
+        cursor = self._conn().execute(
+            "UPDATE conversations SET title = ?, updated_at = ? WHERE id = ?", (title, time.time(), conversation_id)
+        )
+        return cursor.rowcount > 0
+
+    def delete_conversation(self, conversation_id):
+        cursor = self._conn().execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        return cursor.rowcount > 0
+
+    def add_message(self, conversation_id, role, content):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            cursor = conn.execute(
+                "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                (conversation_id, role, content, now)
+            )
+            conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, conversation_id))
+        return {"id": cursor.lastrowid, "role": role, "content": content, "created_at": now}
+
+    def get_messages(self, conversation_id, limit=100, before=None):
+        if before:
+            rows = self._conn().execute(
+                "SELECT id, role, content, created_at FROM messages "
+                "WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, int(before), limit)
+            ).fetchall()
+        else:
+            rows = self._conn().execute(
+                "SELECT id, role, content, created_at FROM messages "
+                "WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+def create_conversation_store():
+    """Build the store configured by CONVERSATION_DB_PATH"""
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "conversations.sqlite3")
+    return SQLiteConversationStore(os.getenv("CONVERSATION_DB_PATH", default_path))
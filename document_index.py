@@ -0,0 +1,256 @@
+"""
+Text extraction and BM25 retrieval for uploaded documents
+
+At upload time a document's text is extracted once, split into overlapping
+chunks and indexed (term frequencies per chunk, document frequencies per
+term). /generate then only scores the prompt against that index and sends
+the best chunks that fit its token budget, so generation cost does not grow
+with the size of the document.
+"""
+import csv
+import io
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from collections import Counter, OrderedDict
+from xml.etree import ElementTree
+
+from context_window import count_tokens
+from file_store import SNIFF_BYTES, TEXT_EXTENSIONS, text_encoding
+
+DOCUMENT_EXTENSIONS = {"txt", "md", "csv", "json", "docx", "xlsx", "pdf"}
+# Stop extracting past this many characters; retrieval quality on huge files isn't worth the memory
+MAX_DOCUMENT_CHARS = 2_000_000
+TOKEN_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+STOPWORDS = set(
+    "a an and are as at be by for from has have how i in is it its of on or that the this to was "
+    "what when where which who why will with you your me my do does can about into than then there".split()
+)
+# BM25 parameters (standard defaults)
+K1 = 1.5
+B = 0.75
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+SHEET_NAMESPACE = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+
+class UnsupportedDocument(Exception):
+    """Raised when text cannot be extracted from a file"""
+
+def tokenize(text):
+    """Lowercased word tokens without stopwords, as indexed and queried"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS and len(token) > 1]
+
+def extract_docx(path):
+    """Paragraph text from word/document.xml"""
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{WORD_NAMESPACE}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{WORD_NAMESPACE}t"))
+        if text.strip():
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+def extract_xlsx(path):
+    """One line per row, cells separated by commas, one section per sheet"""
+    with zipfile.ZipFile(path) as archive:
+        shared = []
+        if "xl/sharedStrings.xml" in archive.namelist():
+            for item in ElementTree.fromstring(archive.read("xl/sharedStrings.xml")).iter(f"{SHEET_NAMESPACE}si"):
+                shared.append("".join(node.text or "" for node in item.iter(f"{SHEET_NAMESPACE}t")))
+        sheets = sorted(name for name in archive.namelist() if re.match(r"xl/worksheets/sheet\d+\.xml$", name))
+        sections = []
+        for name in sheets:
+            rows = []
+            for row in ElementTree.fromstring(archive.read(name)).iter(f"{SHEET_NAMESPACE}row"):
+                values = []
+                for cell in row.iter(f"{SHEET_NAMESPACE}c"):
+                    value = cell.find(f"{SHEET_NAMESPACE}v")
+                    inline = cell.find(f"{SHEET_NAMESPACE}is")
+                    if cell.get("t") == "s" and value is not None:
+                        values.append(shared[int(value.text)])
+                    elif inline is not None:
+                        values.append("".join(node.text or "" for node in inline.iter(f"{SHEET_NAMESPACE}t")))
+                    elif value is not None:
+                        values.append(value.text or "")
+                if any(values):
+                    rows.append(", ".join(values))
+            if rows:
+                sections.append("\n".join(rows))
+    return "\n\n".join(sections)
+
+def extract_pdf(path):
+    """Page text via the optional pypdf package"""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedDocument("PDF text extraction needs the pypdf package (pip install pypdf)")
+    reader = PdfReader(path)
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+
+def extract_text(path, extension):
+    """Plain text of a document, or UnsupportedDocument"""
+    extension = extension.lower()
+    try:
+        if extension in TEXT_EXTENSIONS:
+            # Saved by whatever editor the user has: UTF-8, UTF-16 with a BOM or a legacy code page
+            with open(path, "rb") as f:
+                encoding = text_encoding(f.read(SNIFF_BYTES))
+            with open(path, encoding=encoding, errors="replace", newline="" if extension == "csv" else None) as f:
+                if extension == "json":
+                    return json.dumps(json.load(f), indent=1, ensure_ascii=False)[:MAX_DOCUMENT_CHARS]
+                text = f.read(MAX_DOCUMENT_CHARS)
+            if extension == "csv":
+                return "\n".join(", ".join(row) for row in csv.reader(io.StringIO(text)))
+            return text
+        if extension == "docx":
+            return extract_docx(path)[:MAX_DOCUMENT_CHARS]
+        if extension == "xlsx":
+            return extract_xlsx(path)[:MAX_DOCUMENT_CHARS]
+        if extension == "pdf":
+            return extract_pdf(path)[:MAX_DOCUMENT_CHARS]
+    except (UnsupportedDocument, OSError):
+        raise
+    except Exception as e:
+        # A malformed file can fail anywhere in a parser (e.g. IndexError for a bad shared-string
+        # reference, pypdf's PdfReadError); it is just a document we can't index
+        raise UnsupportedDocument(f"Could not read {extension} file: {str(e) or type(e).__name__}")
+    raise UnsupportedDocument(f"Text extraction is not supported for .{extension} files")
+
+def chunk_text(text, max_tokens=200, overlap_tokens=40):
+    """
+    Split text into chunks of about max_tokens, keeping paragraphs together where
+    they fit and carrying overlap_tokens of words into the next chunk.
+    """
+    words_per_token = 0.75  # ~4 characters per token, ~5.3 per word
+    max_words = max(int(max_tokens * words_per_token), 1)
+    # Each chunk must take at least one new word, or a long paragraph would never be consumed
+    overlap_words = min(max(int(overlap_tokens * words_per_token), 0), max_words - 1)
+    chunks = []
+    current = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        words = paragraph.split()
+        if current and len(current) + len(words) > max_words:
+            chunks.append(" ".join(current))
+            current = current[-overlap_words:] if overlap_words else []
+        while len(words) > max_words:
+            take = max_words - len(current)
+            current += words[:take]
+            words = words[take:]
+            chunks.append(" ".join(current))
+            current = current[-overlap_words:] if overlap_words else []
+        current += words
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+class DocumentIndex:
+    """BM25 index over one document's chunks"""
+
+    def __init__(self, chunks, term_frequencies=None):
+        self.chunks = chunks
+        self.term_frequencies = term_frequencies or [dict(Counter(tokenize(chunk))) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_frequencies]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.document_frequency = Counter(term for tf in self.term_frequencies for term in tf)
+
+    def scores(self, query):
+        terms = set(tokenize(query))
+        count = len(self.chunks)
+        scores = []
+        for tf, length in zip(self.term_frequencies, self.lengths):
+            score = 0.0
+            for term in terms:
+                frequency = tf.get(term)
+                if not frequency:
+                    continue
+                idf = math.log(1 + (count - self.document_frequency[term] + 0.5) / (self.document_frequency[term] + 0.5))
+                score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / (self.average_length or 1)))
+            scores.append(score)
+        return scores
+
+    def retrieve(self, query, token_budget, top_k=8):
+        """
+        Best-matching chunks that fit in token_budget, in document order. When nothing
+        matches (e.g. "summarize this"), the opening chunks are used instead.
+        """
+        scores = self.scores(query)
+        ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])
+        if not ranked:
+            ranked = list(range(len(self.chunks)))
+        chosen = []
+        used = 0
+        for i in ranked:
+            if len(chosen) >= top_k:
+                break
+            cost = count_tokens(self.chunks[i])
+            if used + cost > token_budget:
+                continue
+            chosen.append(i)
+            used += cost
+        return [self.chunks[i] for i in sorted(chosen)]
+
+    def to_dict(self):
+        return {"chunks": self.chunks, "term_frequencies": self.term_frequencies}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["chunks"], data["term_frequencies"])
+
+class DocumentIndexStore:
+    """Indexes saved as <root>/<file_id>.json, keyed like the content-addressed file store"""
+
+    def __init__(self, root, max_cached=32, chunk_tokens=200, overlap_tokens=40):
+        self.root = root
+        self.max_cached = max_cached
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        # Recently used indexes stay parsed in memory
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path_for(self, file_id):
+        return os.path.join(self.root, f"{file_id}.json")
+
+    def ingest(self, file_id, path, extension):
+        """Extract, chunk and index a file once; returns a summary of the index"""
+        index_path = self.path_for(file_id)
+        if os.path.exists(index_path):
+            index = self.load(file_id)
+        else:
+            text = extract_text(path, extension)
+            index = DocumentIndex(chunk_text(text, self.chunk_tokens, self.overlap_tokens))
+            os.makedirs(self.root, exist_ok=True)
+            # Write then rename so concurrent readers never see a partial index
+            fd, tmp_path = tempfile.mkstemp(dir=self.root)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(index.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, index_path)
+            self._remember(file_id, index)
+        return {"chunks": len(index.chunks), "tokens": sum(count_tokens(chunk) for chunk in index.chunks)}
+
+    def load(self, file_id):
+        """The index for file_id, or None if it was never built"""
+        with self.lock:
+            index = self.cache.get(file_id)
+            if index is not None:
+                self.cache.move_to_end(file_id)
+                return index
+        try:
+            with open(self.path_for(file_id), encoding="utf-8") as f:
+                index = DocumentIndex.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        self._remember(file_id, index)
+        return index
+
+    def _remember(self, file_id, index):
+        with self.lock:
+            self.cache[file_id] = index
+            self.cache.move_to_end(file_id)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
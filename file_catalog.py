@@ -0,0 +1,139 @@
+"""
+SQLite metadata catalog for uploaded files
+
+Populated at upload time so /files can page, sort and filter from an index
+instead of listing and stat-ing the upload folder on every request.
+"""
+import base64
+import json
+import os
+import time
+
+from sqlite_store import SQLiteStore
+
+# Sortable columns exposed to /files, mapped to their SQL expressions
+SORT_COLUMNS = {
+    "uploaded_at": "uploaded_at",
+    "size": "size",
+    "name": "original_name"
+}
+
+class FileCatalog(SQLiteStore):
+    """Upload metadata keyed by (file_id, original_name), with one connection per thread"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id TEXT NOT NULL,
+        sha256 TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        extension TEXT NOT NULL,
+        mime_type TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        uploaded_at REAL NOT NULL,
+        UNIQUE (file_id, original_name)
+    );
+    CREATE INDEX IF NOT EXISTS idx_files_uploaded ON files (uploaded_at, id);
+    CREATE INDEX IF NOT EXISTS idx_files_size ON files (size, id);
+    CREATE INDEX IF NOT EXISTS idx_files_name ON files (original_name, id);
+    CREATE INDEX IF NOT EXISTS idx_files_mime ON files (mime_type, uploaded_at, id);
+    CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files (sha256);
+    """
+
+    def add(self, file_id, original_name, mime_type, size, uploaded_at=None):
+        """Record an upload; re-uploading the same content under the same name refreshes it"""
+        uploaded_at = uploaded_at or time.time()
+        sha256, extension = file_id.split(".", 1)
+        self._conn().execute(
+            "INSERT INTO files (file_id, sha256, original_name, extension, mime_type, size, uploaded_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (file_id, original_name) DO UPDATE SET uploaded_at = excluded.uploaded_at",
+            (file_id, sha256, original_name, extension, mime_type, size, uploaded_at)
+        )
+
+    def get(self, file_id):
+        """Most recent catalog entry for a stored file, or None"""
+        row = self._conn().execute(
+            "SELECT * FROM files WHERE file_id = ? ORDER BY uploaded_at DESC LIMIT 1", (file_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def is_empty(self):
+        return self._conn().execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def backfill(self, stored_files, guess_mime_type):
+        """Index files already in the store (e.g. before the catalog existed)"""
+        for file_id, path in stored_files:
+            stat = os.stat(path)
+            self.add(file_id, file_id, guess_mime_type(file_id), stat.st_size, stat.st_mtime)
+
+    def list(self, limit=50, cursor=None, sort="uploaded_at", order="desc",
+             mime_type=None, extension=None, since=None, until=None):
+        """
+        Return (files, next_cursor) for one page. The cursor encodes the sort
+        key and id of the last row, so each page is an index range scan.
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort: {sort}")
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Unsupported order: {order}")
+        column = SORT_COLUMNS[sort]
+
+        where = []
+        params = []
+        if mime_type:
+            # "image" or "image/" match a family, "image/png" matches exactly
+            if "/" in mime_type.rstrip("/"):
+                where.append("mime_type = ?")
+                params.append(mime_type)
+            else:
+                where.append("mime_type LIKE ?")
+                params.append(mime_type.rstrip("/") + "/%")
+        if extension:
+            where.append("extension = ?")
+            params.append(extension.lower().lstrip("."))
+        if since is not None:
+            where.append("uploaded_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("uploaded_at < ?")
+            params.append(until)
+        if cursor:
+            last_value, last_id = decode_cursor(cursor, sort, order)
+            comparison = "<" if order == "desc" else ">"
+            where.append(f"({column}, id) {comparison} (?, ?)")
+            params.extend([last_value, last_id])
+
+        sql = "SELECT * FROM files"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {column} {order.upper()}, id {order.upper()} LIMIT ?"
+        params.append(limit + 1)
+
+        rows = [dict(row) for row in self._conn().execute(sql, params).fetchall()]
+        files = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            last = files[-1]
+            next_cursor = encode_cursor(last[column], last["id"], sort, order)
+        return files, next_cursor
+
+def encode_cursor(value, row_id, sort, order):
+    payload = json.dumps([value, row_id, sort, order], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort, order):
+    """Return (last sort value, last id); a cursor is only valid for the sort it was made with"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, row_id, cursor_sort, cursor_order = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise ValueError("Cursor does not match the requested sort order")
+    return value, row_id
+
+def create_file_catalog():
+    """Build the catalog configured by FILE_CATALOG_DB_PATH"""
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "files.sqlite3")
+    return FileCatalog(os.getenv("FILE_CATALOG_DB_PATH", default_path))
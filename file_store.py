@@ -0,0 +1,231 @@
+"""
+Content-addressed storage for uploaded files
+
+Files are named by the SHA-256 of their contents, so an identical upload is
+stored once and its ID can be referenced by later requests.
+"""
+import codecs
+import hashlib
+import os
+import re
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+FILE_ID_PATTERN = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+# Bytes read from the start of an upload to check that its content matches its extension
+SNIFF_BYTES = 512
+# Leading bytes of each binary format (docx/xlsx are zip archives, doc an OLE container)
+MAGIC_NUMBERS = {
+    "png": (b"\x89PNG\r\n\x1a\n",),
+    "jpg": (b"\xff\xd8\xff",),
+    "jpeg": (b"\xff\xd8\xff",),
+    "gif": (b"GIF87a", b"GIF89a"),
+    "pdf": (b"%PDF-",),
+    "docx": (b"PK\x03\x04",),
+    "xlsx": (b"PK\x03\x04",),
+    "doc": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",)
+}
+TEXT_EXTENSIONS = {"txt", "md", "csv", "json"}
+# Byte-order marks of the Unicode encodings text files are saved in (UTF-32 before UTF-16, which it starts with)
+TEXT_BOMS = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16")
+)
+# Formats that are never text, whatever the extension says
+BINARY_MAGIC_NUMBERS = tuple({magic for magics in MAGIC_NUMBERS.values() for magic in magics}) + (
+    b"\x1f\x8b", b"\x7fELF", b"7z\xbc\xaf\x27\x1c", b"Rar!\x1a\x07"
+)
+
+def text_encoding(head):
+    """Encoding a text file's first bytes point to: its BOM's, else UTF-8 if valid, else cp1252"""
+    for bom, encoding in TEXT_BOMS:
+        if head.startswith(bom):
+            return encoding
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the end of the sample is still UTF-8
+        if e.reason != "unexpected end of data":
+            return "cp1252"
+    return "utf-8"
+
+def content_matches(head, extension):
+    """Whether the first bytes of a file look like the type its extension claims"""
+    extension = extension.lower().lstrip(".")
+    if extension == "webp":
+        return head[:4] == b"RIFF" and head[8:12] == b"WEBP"
+    if extension in MAGIC_NUMBERS:
+        return head.startswith(MAGIC_NUMBERS[extension])
+    if extension in TEXT_EXTENSIONS:
+        if any(head.startswith(bom) for bom, _ in TEXT_BOMS):
+            return True
+        if head.startswith(BINARY_MAGIC_NUMBERS):
+            return False
+        # Any byte sequence is valid in some legacy single-byte encoding, so only
+        # binary data (mostly NUL bytes) is rejected; UTF-16 without a BOM is half NULs
+        return head.count(b"\x00") <= len(head) // 2
+    return False
+
+class HashingTempFile:
+    """
+    Temp file inside the store that hashes bytes as they are written.
+    Closing it without committing deletes it.
+    """
+
+    def __init__(self, tmp_dir):
+        fd, self.path = tempfile.mkstemp(dir=tmp_dir)
+        self.file = os.fdopen(fd, "w+b")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # read/seek/tell/flush etc. go straight to the underlying file
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class FileStore:
+    """Stores files as <root>/<first two hex digits>/<sha256>.<ext>"""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+
+    def ensure_dirs(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path_for(self, file_id):
+        """Absolute path for a file ID, or None if the ID is malformed"""
+        if not FILE_ID_PATTERN.match(file_id or ""):
+            return None
+        return os.path.join(self.root, file_id[:2], file_id)
+
+    def exists(self, file_id):
+        path = self.path_for(file_id)
+        return path is not None and os.path.isfile(path)
+
+    def open_temp(self):
+        """Temp file that request parsing can write an upload straight into"""
+        self.ensure_dirs()
+        return HashingTempFile(self.tmp_dir)
+
+    def commit_temp(self, temp, extension):
+        """
+        Move a HashingTempFile into place under its content hash without copying.
+        Returns (file_id, size, created) where created is False for a duplicate.
+        """
+        temp.file.close()
+        temp.committed = True
+        return self._commit(temp.path, temp.digest.hexdigest(), extension, temp.size)
+
+    def commit_file(self, path, extension):
+        """
+        Hash a fully written file in the store's filesystem and move it into place.
+        Returns (file_id, size, created) where created is False for a duplicate.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+        return self._commit(path, digest.hexdigest(), extension, size)
+
+    def save_stream(self, stream, extension):
+        """
+        Copy a readable stream into the store, hashing while writing.
+        Returns (file_id, size, created) where created is False for a duplicate.
+        """
+        self.ensure_dirs()
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            return self._commit(tmp_path, digest.hexdigest(), extension, size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _commit(self, tmp_path, digest, extension, size):
+        """Move a fully written temp file into place, or drop it if the content already exists"""
+        file_id = f"{digest}.{extension.lower().lstrip('.')}"
+        path = self.path_for(file_id)
+        if path is None:
+            os.remove(tmp_path)
+            raise ValueError(f"Unsupported file extension: {extension}")
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return file_id, size, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return file_id, size, True
+
+    def iter_files(self):
+        """Yield (file_id, path) for every stored file"""
+        if not os.path.isdir(self.root):
+            return
+        for shard in os.scandir(self.root):
+            if not shard.is_dir() or len(shard.name) != 2:
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.is_file() and FILE_ID_PATTERN.match(entry.name):
+                    yield entry.name, entry.path
+
+    def adopt_legacy_files(self, folder, allowed):
+        """
+        Move files saved directly in folder (the upload layout before this store) into the store.
+        Yields (file_id, name, size, modified time) for each file whose name allowed(name) accepts.
+        """
+        if not os.path.isdir(folder):
+            return
+        for entry in list(os.scandir(folder)):
+            extension = os.path.splitext(entry.name)[1].lower().lstrip(".")
+            if not entry.is_file() or not allowed(entry.name) or self.path_for(f"{'0' * 64}.{extension}") is None:
+                continue
+            try:
+                modified = entry.stat().st_mtime
+                file_id, size, _ = self.commit_file(entry.path, extension)
+            except FileNotFoundError:
+                continue  # Another worker starting at the same time moved it first
+            yield file_id, entry.name, size, modified
+
+    def read_bytes(self, file_id):
+        path = self.path_for(file_id)
+        if path is None or not os.path.isfile(path):
+            raise FileNotFoundError(file_id)
+        with open(path, "rb") as f:
+            return f.read()
@@ -0,0 +1,48 @@
+"""
+Gunicorn settings for the GPT Clone app (gunicorn -c gunicorn.conf.py wsgi:application)
+
+Values come from the same .env file as the app. Send SIGHUP to the master for
+a graceful reload: this file and .env are read again, new workers import the
+current code, and old workers finish their requests first. With
+GUNICORN_PRELOAD=1 workers fork from a master that already imported the app,
+so HUP only applies the gunicorn settings here; deploy code or app settings
+with a full restart (or a USR2 + WINCH binary upgrade) instead.
+"""
+import multiprocessing
+import os
+from dotenv import load_dotenv
+
+# Override, so a SIGHUP reload picks up edited values rather than the ones already in the environment
+load_dotenv(override=True)
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+
+# Generations spend most of their time waiting on the upstream API, so each
+# process runs a thread pool; processes are sized to the available cores
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Workers split the UPSTREAM_* limits between them (rate_limiter.py), so they need the count;
+# set it with WEB_CONCURRENCY rather than --workers, which the app can't see
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Importing the app once in the master shares its memory and speeds up worker boot,
+# but HUP reloads then keep the old code and settings (see above)
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+# Recycle workers after a number of requests (jittered so they do not all restart together)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+# Must exceed HTTP_READ_TIMEOUT so a slow generation is not killed mid-request
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 150))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+def worker_exit(server, worker):
+    """Write out queued interaction logs before a recycled worker exits"""
+    from app import interaction_logger
+    interaction_logger.close()
@@ -0,0 +1,256 @@
+"""
+Shared, pooled HTTP client for all calls to the OpenAI API
+"""
+import asyncio
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import metrics
+
+# Upstream statuses worth retrying: rate limits and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+# Per-thread timings of the current upstream call, filled in by the timed connections
+_timings = threading.local()
+
+class TimedConnectionMixin:
+    """Records connect time and time to response headers for the calling thread"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            _timings.connect = getattr(_timings, "connect", 0.0) + time.perf_counter() - start
+
+    def request(self, *args, **kwargs):
+        self.request_started = time.perf_counter()
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        # Overwritten on every attempt, so retries report the final attempt's TTFB
+        _timings.ttfb = time.perf_counter() - self.request_started
+        return response
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools use the timed connection classes"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool
+        }
+
+class CappedRetry(Retry):
+    """Retry policy that honors Retry-After but never sleeps longer than max_retry_after"""
+    max_retry_after = 30.0
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.max_retry_after = self.max_retry_after
+        return retry
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_retry_after)
+
+def default_timeout():
+    """Return the (connect, read) timeout tuple applied to every upstream call"""
+    return (
+        float(os.getenv("HTTP_CONNECT_TIMEOUT", 5)),
+        float(os.getenv("HTTP_READ_TIMEOUT", 120))
+    )
+
+def create_session():
+    """Build a keep-alive session with a bounded connection pool and retry-with-backoff"""
+    retries = CappedRetry(
+        total=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+        connect=int(os.getenv("HTTP_MAX_RETRIES", 3)),
+        read=0,  # Never replay a request whose body the upstream may already be processing
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "POST"]),
+        backoff_factor=float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5)),
+        respect_retry_after_header=True,
+        raise_on_status=False  # Hand the final error response back so callers can classify it
+    )
+    retries.max_retry_after = float(os.getenv("HTTP_MAX_RETRY_AFTER", 30))
+
+    adapter = TimedHTTPAdapter(
+        pool_connections=int(os.getenv("HTTP_POOL_CONNECTIONS", 4)),
+        pool_maxsize=int(os.getenv("HTTP_POOL_MAXSIZE", 32)),
+        pool_block=True,  # Wait for a free connection instead of opening unbounded extras
+        max_retries=retries
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    """Return the process-wide session, creating it on first use"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+def endpoint_label(url):
+    """URL path for metric labels, with object IDs (e.g. /files/file-abc123) collapsed"""
+    return "/".join(
+        "{id}" if len(segment) >= 8 and any(char.isdigit() for char in segment) else segment
+        for segment in urlsplit(url).path.split("/")
+    )
+
+def timed_request(method, url, **kwargs):
+    """Send a request through the shared session, recording upstream latency and size metrics"""
+    endpoint = endpoint_label(url)
+    kwargs.setdefault("timeout", default_timeout())
+    _timings.connect = 0.0
+    _timings.ttfb = None
+    start = time.perf_counter()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except requests.RequestException:
+        metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, status="error")
+        raise
+
+    metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    metrics.UPSTREAM_CONNECT.observe(_timings.connect, endpoint=endpoint)
+    if _timings.ttfb is not None:
+        metrics.UPSTREAM_TTFB.observe(_timings.ttfb, endpoint=endpoint)
+    if response.request.body:
+        metrics.UPSTREAM_REQUEST_SIZE.observe(len(response.request.body), endpoint=endpoint)
+    if kwargs.get("stream"):
+        # The body is still unread; the caller reports the total via finish_stream()
+        response.upstream_endpoint = endpoint
+        response.upstream_started = start
+    else:
+        metrics.UPSTREAM_TOTAL.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.UPSTREAM_RESPONSE_SIZE.observe(len(response.content), endpoint=endpoint)
+    return response
+
+def finish_stream(response):
+    """Record the total upstream time of a streamed response once it has been drained"""
+    started = getattr(response, "upstream_started", None)
+    if started is not None:
+        metrics.UPSTREAM_TOTAL.observe(time.perf_counter() - started, endpoint=response.upstream_endpoint)
+
+def post(url, **kwargs):
+    """POST through the shared session with default timeouts"""
+    return timed_request("POST", url, **kwargs)
+
+def get(url, **kwargs):
+    """GET through the shared session with default timeouts"""
+    return timed_request("GET", url, **kwargs)
+
+# Async variant for the ASGI entry point; httpx is only imported when it is used
+_async_client = None
+
+def retry_delay(retry_after, attempt):
+    """Seconds to wait before retry number attempt, preferring the upstream's Retry-After"""
+    max_delay = float(os.getenv("HTTP_MAX_RETRY_AFTER", 30))
+    try:
+        if retry_after is not None:
+            return min(max(float(retry_after), 0), max_delay)
+    except ValueError:
+        pass
+    return min(float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5)) * (2 ** attempt), max_delay)
+
+def get_async_client():
+    """Return the process-wide httpx.AsyncClient, creating it on first use"""
+    global _async_client
+    if _async_client is None:
+        import httpx
+        connect_timeout, read_timeout = default_timeout()
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("HTTP_ASYNC_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("HTTP_POOL_MAXSIZE", 32))
+        )
+        transport = httpx.AsyncHTTPTransport(
+            limits=limits,
+            retries=int(os.getenv("HTTP_MAX_RETRIES", 3))  # Connection failures only
+        )
+        _async_client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+    return _async_client
+
+async def close_async_client():
+    """Close the shared async client, if one was created"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+async def async_post(url, stream=False, **kwargs):
+    """POST through the shared async client, retrying 429/5xx with backoff"""
+    client = get_async_client()
+    endpoint = endpoint_label(url)
+    max_retries = int(os.getenv("HTTP_MAX_RETRIES", 3))
+    timings = {"connect": 0.0}
+
+    async def trace(event, info):
+        # httpcore connection events give the same connect / TTFB split as the sync client
+        now = time.perf_counter()
+        if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            timings["connect_started"] = now
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            timings["connect"] += now - timings.pop("connect_started", now)
+        elif event.endswith("send_request_headers.started"):
+            timings["sent"] = now
+        elif event.endswith("receive_response_headers.complete"):
+            timings["ttfb"] = now - timings.get("sent", now)
+
+    start = time.perf_counter()
+    for attempt in range(max_retries + 1):
+        request = client.build_request("POST", url, extensions={"trace": trace}, **kwargs)
+        try:
+            response = await client.send(request, stream=stream)
+        except Exception:
+            metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, status="error")
+            raise
+        if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+            break
+        await response.aclose()
+        await asyncio.sleep(retry_delay(response.headers.get("Retry-After"), attempt))
+
+    metrics.UPSTREAM_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    metrics.UPSTREAM_CONNECT.observe(timings["connect"], endpoint=endpoint)
+    if "ttfb" in timings:
+        metrics.UPSTREAM_TTFB.observe(timings["ttfb"], endpoint=endpoint)
+    metrics.UPSTREAM_REQUEST_SIZE.observe(len(request.content), endpoint=endpoint)
+    if stream:
+        response.upstream_endpoint = endpoint
+        response.upstream_started = start
+    else:
+        metrics.UPSTREAM_TOTAL.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.UPSTREAM_RESPONSE_SIZE.observe(len(response.content), endpoint=endpoint)
+    return response
@@ -0,0 +1,162 @@
+"""
+Background image generation jobs
+
+/generate-image records a job and returns its ID; a worker thread calls the
+upstream, downloads the short-lived image URL into the file store and records
+the local file ID. Jobs live in SQLite so any worker process can answer a
+status poll, and a stored image for the same (model, prompt, size) is reused
+instead of generating it again.
+"""
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from sqlite_store import SQLiteStore
+
+ACTIVE_STATUSES = ("queued", "running")
+
+def image_cache_key(payload):
+    """Identity of an image request: identical keys produce interchangeable images"""
+    identity = {"model": payload.get("model"), "prompt": payload.get("prompt", "").strip(), "size": payload.get("size")}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+class ImageJobStore(SQLiteStore):
+    """Job records keyed by ID, with one connection per thread"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS image_jobs (
+        id TEXT PRIMARY KEY,
+        cache_key TEXT NOT NULL,
+        model TEXT NOT NULL,
+        prompt TEXT NOT NULL,
+        size TEXT NOT NULL,
+        status TEXT NOT NULL,
+        file_id TEXT,
+        error TEXT,
+        error_status INTEGER,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_image_jobs_cache_key ON image_jobs (cache_key, updated_at);
+    CREATE INDEX IF NOT EXISTS idx_image_jobs_status ON image_jobs (status);
+    -- Older databases may hold duplicate active jobs; keep the newest of each
+    UPDATE image_jobs SET status = 'failed', error = 'Superseded by an identical job', error_status = 500
+    WHERE status IN ('queued', 'running') AND EXISTS (
+        SELECT 1 FROM image_jobs AS newer
+        WHERE newer.cache_key = image_jobs.cache_key AND newer.status IN ('queued', 'running')
+          AND newer.rowid > image_jobs.rowid
+    );
+    -- At most one active job per request, so identical requests share one upstream call
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_image_jobs_active ON image_jobs (cache_key)
+        WHERE status IN ('queued', 'running');
+    """
+
+    def __init__(self, path, job_timeout=300):
+        super().__init__(path)
+        # A queued or running job not updated for this long belonged to a worker that went away
+        self.job_timeout = job_timeout
+
+    def _expire(self, job):
+        """Mark an abandoned active job as failed; returns the (possibly updated) job"""
+        if job["status"] in ACTIVE_STATUSES and time.time() - job["updated_at"] > self.job_timeout:
+            self._finish(job["id"], "failed", error="Image generation was interrupted. Please try again.", error_status=500)
+            job = {**job, "status": "failed", "error": "Image generation was interrupted. Please try again.", "error_status": 500}
+        return job
+
+    def create(self, payload):
+        """
+        Record a queued job for the request; returns (job, created). created is False when an
+        identical job is already active, in which case that job is returned instead.
+        """
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "cache_key": image_cache_key(payload),
+            "model": payload["model"],
+            "prompt": payload["prompt"],
+            "size": payload["size"],
+            "status": "queued",
+            "file_id": None,
+            "error": None,
+            "error_status": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        conn = self._conn()
+        cursor = conn.execute(
+            """
+            INSERT INTO image_jobs (id, cache_key, model, prompt, size, status, created_at, updated_at)
+            VALUES (:id, :cache_key, :model, :prompt, :size, :status, :created_at, :updated_at)
+            ON CONFLICT DO NOTHING
+            """,
+            job
+        )
+        if cursor.rowcount == 1:
+            return job, True
+        # Another request (in any worker process) inserted the same job first
+        row = conn.execute(
+            "SELECT * FROM image_jobs WHERE cache_key = ? AND status IN ('queued', 'running')",
+            (job["cache_key"],)
+        ).fetchone()
+        if row is not None:
+            return dict(row), False
+        # It finished between the insert and the select
+        job = self.find_reusable(payload)
+        return (job, False) if job else self.create(payload)
+
+    def get(self, job_id):
+        row = self._conn().execute("SELECT * FROM image_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._expire(dict(row)) if row else None
+
+    def find_reusable(self, payload):
+        """Newest finished or still-active job for the same request, or None"""
+        rows = self._conn().execute(
+            """
+            SELECT * FROM image_jobs
+            WHERE cache_key = ? AND status != 'failed'
+            ORDER BY status = 'succeeded' DESC, updated_at DESC
+            LIMIT 2
+            """,
+            (image_cache_key(payload),)
+        ).fetchall()
+        for row in rows:
+            job = self._expire(dict(row))
+            if job["status"] != "failed":
+                return job
+        return None
+
+    def mark_running(self, job_id):
+        """Claim a queued job; False if it has already expired or finished"""
+        cursor = self._conn().execute(
+            "UPDATE image_jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        return cursor.rowcount == 1
+
+    def mark_succeeded(self, job_id, file_id):
+        self._finish(job_id, "succeeded", file_id=file_id)
+
+    def mark_failed(self, job_id, error, error_status=500):
+        self._finish(job_id, "failed", error=error, error_status=error_status)
+
+    def _finish(self, job_id, status, file_id=None, error=None, error_status=None):
+        self._conn().execute(
+            "UPDATE image_jobs SET status = ?, file_id = ?, error = ?, error_status = ?, updated_at = ? WHERE id = ?",
+            (status, file_id, error, error_status, time.time(), job_id)
+        )
+
+    def stats(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) AS count FROM image_jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in (*ACTIVE_STATUSES, "succeeded", "failed")}
+        counts.update({row["status"]: row["count"] for row in rows})
+        return counts
+
+def create_image_job_store():
+    """Build the store configured by IMAGE_JOB_DB_PATH and IMAGE_JOB_TIMEOUT"""
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "image_jobs.sqlite3")
+    return ImageJobStore(
+        os.getenv("IMAGE_JOB_DB_PATH", default_path),
+        job_timeout=float(os.getenv("IMAGE_JOB_TIMEOUT", 300))
+    )
@@ -0,0 +1,132 @@
+"""
+Downscale and recompress images before they are sent to the vision model
+
+The model tiles images at a fixed effective resolution, so anything larger
+only costs upload bytes and latency. Processed variants are cached on disk
+by the SHA-256 of the original bytes.
+"""
+import base64
+import hashlib
+import io
+import os
+import tempfile
+
+# Effective resolution tiers of the vision model
+LOW_DETAIL_MAX_SIDE = 512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+def target_size(width, height, detail):
+    """Largest size the model will actually use for an image of this size"""
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_MAX_SIDE / max(width, height))
+    else:
+        scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+        short_side = min(width, height) * scale
+        if short_side > HIGH_DETAIL_SHORT_SIDE:
+            scale *= HIGH_DETAIL_SHORT_SIDE / short_side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def parse_data_url(url):
+    """Split a base64 data URL into (mime type, raw bytes), or None for other URLs"""
+    if not url.startswith("data:") or ";base64," not in url:
+        return None
+    header, encoded = url.split(",", 1)
+    return header[len("data:"):].split(";", 1)[0], base64.b64decode(encoded)
+
+def to_data_url(mime_type, data):
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+class ImagePreprocessor:
+    """Resizes, strips metadata from and recompresses images, caching each variant"""
+
+    def __init__(self, cache_dir, jpeg_quality=85, webp_quality=80):
+        self.cache_dir = cache_dir
+        self.jpeg_quality = jpeg_quality
+        self.webp_quality = webp_quality
+
+    def process(self, data, detail="high"):
+        """Return (mime type, bytes) for the processed image, or None if Pillow cannot handle it"""
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return None
+
+        # Pillow can fail at any step for unusual images (e.g. an I;16 PNG cannot be
+        # converted to RGB); the original is then sent unchanged
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.seek(0)  # Animated images: the model only accepts a single frame
+            image = ImageOps.exif_transpose(image)
+
+            size = target_size(image.width, image.height, detail)
+            resized = size != (image.width, image.height)
+            if resized:
+                image = image.resize(size, Image.LANCZOS)
+
+            # Re-encoding without exif/icc info strips metadata
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                image.convert("RGBA").save(output, format="WEBP", quality=self.webp_quality, method=4)
+                mime_type = "image/webp"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=self.jpeg_quality, optimize=True, progressive=True)
+                mime_type = "image/jpeg"
+        except Exception as e:
+            print(f"Image preprocessing skipped: {str(e) or type(e).__name__}")
+            return None
+
+        processed = output.getvalue()
+        if not resized and len(processed) >= len(data):
+            return None  # Recompressing a small image made it bigger; keep the original
+        return mime_type, processed
+
+    def cached(self, digest, detail, load):
+        """Processed (mime type, bytes) for the original with this digest; load() reads it on a miss"""
+        base_path = os.path.join(self.cache_dir, f"{digest}-{detail}")
+        for mime_type, extension in (("image/jpeg", "jpg"), ("image/webp", "webp")):
+            if os.path.exists(f"{base_path}.{extension}"):
+                with open(f"{base_path}.{extension}", "rb") as f:
+                    return mime_type, f.read()
+        # Marker left when processing would not help, so the original is not re-decoded
+        if os.path.exists(f"{base_path}.original"):
+            return None
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        result = self.process(load(), detail)
+        if result is None:
+            open(f"{base_path}.original", "wb").close()
+            return None
+
+        mime_type, processed = result
+        extension = "webp" if mime_type == "image/webp" else "jpg"
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(processed)
+        os.replace(tmp_path, f"{base_path}.{extension}")
+        return result
+
+    def data_url_for_file(self, path, digest, mime_type, detail="high"):
+        """Data URL for a stored image, processed when that makes it smaller"""
+        def load():
+            with open(path, "rb") as f:
+                return f.read()
+
+        result = self.cached(digest, detail, load)
+        if result is None:
+            return to_data_url(mime_type, load())
+        return to_data_url(*result)
+
+    def process_data_url(self, url, detail="high"):
+        """Process an inline data URL; other URLs are passed through untouched"""
+        try:
+            parsed = parse_data_url(url)
+        except ValueError:
+            return url  # Not valid base64; the upstream reports it like any other bad image
+        if parsed is None:
+            return url
+        mime_type, data = parsed
+        result = self.cached(hashlib.sha256(data).hexdigest(), detail, lambda: data)
+        if result is None:
+            return url
+        return to_data_url(*result)
@@ -0,0 +1,163 @@
+"""
+Background, batched JSONL writer for interaction logs
+
+Requests only enqueue a record; a daemon thread batches records, appends them
+with one write per batch, and rotates (and optionally gzips) the file once it
+grows past a size limit.
+"""
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime
+
+class InteractionLogger:
+    """Bounded-queue logger; when the queue is full records are dropped or the caller waits briefly"""
+
+    def __init__(self, path, max_queue=10000, batch_size=200, flush_interval=1.0,
+                 max_bytes=50 * 1024 * 1024, backup_count=5, compress=True, block_timeout=0.0):
+        self.path = path
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.block_timeout = block_timeout
+        self.written = 0
+        self.dropped = 0
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each worker process starts its own writer
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.max_queue)
+            self.thread = threading.Thread(target=self._run, name="interaction-logger", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def log(self, record):
+        """Enqueue one record; returns False if it was dropped because the queue is full"""
+        self._ensure_started()
+        line = json.dumps(record) + "\n"
+        try:
+            if self.block_timeout > 0:
+                self.queue.put(line, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(line)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far has been written"""
+        if self.pid != os.getpid():
+            return
+        done = threading.Event()
+        self.queue.put(done, timeout=timeout)
+        done.wait(timeout)
+
+    def close(self):
+        """Write out remaining records and stop the writer thread"""
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=5.0)
+            self.thread.join(timeout=5.0)
+        except queue.Full:
+            pass
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                item = False
+
+            if isinstance(item, str):
+                batch.append(item)
+                if len(batch) < self.batch_size and time.monotonic() < deadline:
+                    continue
+            elif isinstance(item, threading.Event) or item is None:
+                self._write(batch)
+                batch = []
+                if item is None:
+                    return
+                item.set()
+                continue
+
+            self._write(batch)
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # Reopening per batch keeps working when another worker rotates the file
+            with open(self.path, "a") as f:
+                f.write("".join(batch))
+            self.written += len(batch)
+            if self.max_bytes and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+        except Exception as e:
+            print(f"Logging error: {str(e)}")
+
+    def _rotate(self):
+        rotated = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        try:
+            os.rename(self.path, rotated)
+        except FileNotFoundError:
+            return  # Another worker rotated it first
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        self._prune()
+
+    def _prune(self):
+        """Keep only the newest backup_count rotated files"""
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        backups = sorted(name for name in os.listdir(directory) if name.startswith(prefix))
+        for name in backups[:-self.backup_count] if self.backup_count else backups:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+def create_interaction_logger(log_dir):
+    """Build the logger configured by LOG_* environment variables"""
+    return InteractionLogger(
+        os.path.join(log_dir, "interactions.jsonl"),
+        max_queue=int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+        batch_size=int(os.getenv("LOG_BATCH_SIZE", 200)),
+        flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", 1.0)),
+        max_bytes=int(os.getenv("LOG_MAX_BYTES", 50 * 1024 * 1024)),
+        backup_count=int(os.getenv("LOG_BACKUP_COUNT", 5)),
+        compress=os.getenv("LOG_COMPRESS", "1") == "1",
+        block_timeout=float(os.getenv("LOG_BLOCK_TIMEOUT", 0))
+    )
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Interaction log analytics
+
+Compacts logs/interactions.jsonl (and its rotated backups) into a SQLite
+database with one table per month, then reports requests per model, latency
+and token percentiles, and the most repeated prompts.
+
+    python log_analytics.py ingest
+    python log_analytics.py report --since 2024-06-01 --top 20
+    python log_analytics.py report --json
+    python log_analytics.py prune --before 2024-01
+
+Ingestion is incremental: a checkpoint records which file was being read (by
+a hash of its first line, so it is recognised after rotation renames or gzips
+it) and the byte offset reached, so a rerun only reads new lines. Lines are
+streamed and committed in batches, and reports aggregate inside SQLite, so
+memory stays bounded however large the log is. Only metadata is kept: the
+prompt text is stored once per distinct prompt and replies are not copied.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_DIR = os.getenv("LOG_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+DEFAULT_LOG_PATH = os.path.join(LOG_DIR, "interactions.jsonl")
+DEFAULT_DB_PATH = os.getenv("LOG_ANALYTICS_DB_PATH") or os.path.join(LOG_DIR, "analytics.sqlite3")
+BATCH_SIZE = 5000
+PARTITION_PATTERN = re.compile(r"^interactions_(\d{4})_(\d{2})$")
+# Longest prompt text kept for the top-prompts report
+PROMPT_PREVIEW_CHARS = 500
+
+def normalize_prompt(prompt):
+    """Prompts differing only in case and spacing count as the same prompt"""
+    return " ".join(prompt.lower().split())
+
+def line_fingerprint(line):
+    return hashlib.sha256(line).hexdigest()
+
+def open_log(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+def first_line_fingerprint(path):
+    """Hash of a log file's first complete line, or None if it has none yet"""
+    try:
+        with open_log(path) as f:
+            line = f.readline()
+    except (FileNotFoundError, EOFError, OSError):
+        return None
+    return line_fingerprint(line) if line.endswith(b"\n") else None
+
+def log_sources(log_path):
+    """Rotated backups oldest first, then the live file"""
+    directory = os.path.dirname(log_path) or "."
+    prefix = os.path.basename(log_path) + "."
+    backups = {}
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if not name.startswith(prefix):
+                continue
+            stem = name[:-3] if name.endswith(".gz") else name
+            # While a backup is being gzipped both copies exist; the plain one is complete
+            if stem not in backups or not name.endswith(".gz"):
+                backups[stem] = os.path.join(directory, name)
+    return [backups[stem] for stem in sorted(backups)] + [log_path]
+
+class AnalyticsStore:
+    """SQLite store: a checkpoint, distinct prompts, and interactions_<YYYY>_<MM> partitions"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                fingerprint TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS prompts (
+                hash TEXT PRIMARY KEY,
+                prompt TEXT NOT NULL
+            );
+            """
+        )
+        self.partitions = set(self.list_partitions())
+
+    def list_partitions(self):
+        rows = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'interactions_%'")
+        return sorted(name for (name,) in rows if PARTITION_PATTERN.match(name))
+
+    def partition_for(self, timestamp):
+        name = f"interactions_{timestamp.year:04d}_{timestamp.month:02d}"
+        if name not in self.partitions:
+            self.conn.executescript(
+                f"""
+                CREATE TABLE IF NOT EXISTS {name} (
+                    ts REAL NOT NULL,
+                    kind TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    latency_ms REAL,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    prompt_hash TEXT NOT NULL,
+                    response_chars INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_{name}_ts ON {name} (ts);
+                """
+            )
+            self.partitions.add(name)
+        return name
+
+    def checkpoint(self):
+        row = self.conn.execute("SELECT fingerprint, offset FROM checkpoint WHERE id = 1").fetchone()
+        return row if row else (None, 0)
+
+    def save_checkpoint(self, fingerprint, offset):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO checkpoint (id, fingerprint, offset, updated_at) VALUES (1, ?, ?, ?)",
+            (fingerprint, offset, time.time())
+        )
+
+    def add_batch(self, rows, prompts):
+        by_partition = {}
+        for partition, row in rows:
+            by_partition.setdefault(partition, []).append(row)
+        for partition, partition_rows in by_partition.items():
+            self.conn.executemany(f"INSERT INTO {partition} VALUES (?, ?, ?, ?, ?, ?, ?, ?)", partition_rows)
+        self.conn.executemany("INSERT OR IGNORE INTO prompts (hash, prompt) VALUES (?, ?)", prompts.items())
+
+def parse_record(line, store):
+    """(partition, row, prompt hash, prompt) for one log line, or None if it can't be used"""
+    try:
+        record = json.loads(line)
+        timestamp = datetime.fromisoformat(record["timestamp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    prompt = record.get("prompt") or ""
+    # Records from before the log had these fields: no model, and images only marked by their prompt
+    kind = record.get("kind") or ("image" if prompt.startswith("Image generation: ") else "chat")
+    usage = record.get("usage") or {}
+    normalized = normalize_prompt(prompt)
+    prompt_hash = hashlib.sha1(normalized.encode()).hexdigest()
+    row = (
+        timestamp.timestamp(),
+        kind,
+        record.get("model") or f"unknown-{kind}",
+        record.get("latency_ms"),
+        usage.get("prompt_tokens"),
+        usage.get("completion_tokens"),
+        prompt_hash,
+        len(record.get("response") or "")
+    )
+    return store.partition_for(timestamp), row, prompt_hash, prompt[:PROMPT_PREVIEW_CHARS]
+
+def ingest(log_path, store, verbose=True):
+    """Read every log line added since the checkpoint; returns the number of records stored"""
+    fingerprint, offset = store.checkpoint()
+    sources = log_sources(log_path)
+    fingerprints = [first_line_fingerprint(path) for path in sources]
+
+    # Resume inside the file the checkpoint was taken on, wherever rotation moved it
+    start = 0
+    if fingerprint is not None:
+        if fingerprint in fingerprints:
+            start = fingerprints.index(fingerprint)
+        else:
+            print(f"Warning: the last ingested log file is gone (pruned by rotation?); reading all {len(sources)} remaining files")
+            offset = 0
+
+    stored = skipped = 0
+    for index in range(start, len(sources)):
+        path = sources[index]
+        if fingerprints[index] is None:
+            continue  # Missing, or no complete line yet
+        position = offset if index == start and fingerprints[index] == fingerprint else 0
+        live = index == len(sources) - 1
+        rows = []
+        prompts = {}
+        with open_log(path) as f:
+            f.seek(position)  # gzip files seek by decompressing forward, in bounded memory
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # A line the app is still writing; the next run picks it up
+                position += len(line)
+                parsed = parse_record(line, store)
+                if parsed is None:
+                    skipped += 1
+                    continue
+                partition, row, prompt_hash, prompt = parsed
+                rows.append((partition, row))
+                prompts[prompt_hash] = prompt
+                if len(rows) >= BATCH_SIZE:
+                    with store.conn:
+                        store.add_batch(rows, prompts)
+                        store.save_checkpoint(fingerprints[index], position)
+                    stored += len(rows)
+                    rows, prompts = [], {}
+        with store.conn:
+            store.add_batch(rows, prompts)
+            store.save_checkpoint(fingerprints[index], position)
+        stored += len(rows)
+        if verbose and (rows or not live):
+            print(f"Read {os.path.basename(path)} up to byte {position}")
+
+    if verbose:
+        print(f"Ingested {stored} records" + (f", skipped {skipped} unreadable lines" if skipped else ""))
+    return stored
+
+def percentile_from_counts(counts, fraction):
+    """Nearest-rank percentile of a sorted list of (value, count)"""
+    total = sum(count for _, count in counts)
+    if not total:
+        return None
+    rank = max(int(total * fraction + 0.5), 1)
+    seen = 0
+    for value, count in counts:
+        seen += count
+        if seen >= rank:
+            return value
+    return counts[-1][0]
+
+def partitions_between(store, since=None, until=None):
+    """Partitions overlapping [since, until), plus the matching WHERE clause"""
+    names = []
+    for name in store.list_partitions():
+        year, month = map(int, PARTITION_PATTERN.match(name).groups())
+        if since and (year, month) < (since.year, since.month):
+            continue
+        if until and (year, month) > (until.year, until.month):
+            continue
+        names.append(name)
+    conditions, params = [], []
+    if since:
+        conditions.append("ts >= ?")
+        params.append(since.timestamp())
+    if until:
+        conditions.append("ts < ?")
+        params.append(until.timestamp())
+    return names, (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+def report(store, since=None, until=None, top=20):
+    """Aggregates over the stored interactions; every query groups inside SQLite"""
+    names, where, params = partitions_between(store, since, until)
+    if not names:
+        return {"requests": 0, "models": {}, "top_prompts": []}
+    union = " UNION ALL ".join(f"SELECT * FROM {name}{where}" for name in names)
+    union_params = params * len(names)
+
+    models = {}
+    for model, kind, requests, prompt_tokens, completion_tokens in store.conn.execute(
+        f"SELECT model, MIN(kind), COUNT(*), SUM(prompt_tokens), SUM(completion_tokens) FROM ({union}) GROUP BY model",
+        union_params
+    ):
+        models[model] = {
+            "kind": kind,
+            "requests": requests,
+            "total_tokens": {"prompt": prompt_tokens or 0, "completion": completion_tokens or 0}
+        }
+
+    # Percentiles from per-value counts: bounded by the number of distinct values, not of rows
+    for column, expression in (
+        ("latency_ms", "CAST(ROUND(latency_ms) AS INTEGER)"),
+        ("prompt_tokens", "prompt_tokens"),
+        ("completion_tokens", "completion_tokens")
+    ):
+        counts_by_model = {}
+        for model, value, count in store.conn.execute(
+            f"SELECT model, {expression} AS value, COUNT(*) FROM ({union}) WHERE {column} IS NOT NULL "
+            f"GROUP BY model, value ORDER BY model, value",
+            union_params
+        ):
+            counts_by_model.setdefault(model, []).append((value, count))
+        for model, counts in counts_by_model.items():
+            models[model][column] = {
+                f"p{int(fraction * 100)}": percentile_from_counts(counts, fraction) for fraction in (0.5, 0.9, 0.95, 0.99)
+            }
+
+    total = sum(entry["requests"] for entry in models.values())
+    distinct = store.conn.execute(f"SELECT COUNT(DISTINCT prompt_hash) FROM ({union})", union_params).fetchone()[0]
+    top_prompts = [
+        {"prompt": prompt, "count": count, "models": model_count}
+        for prompt, count, model_count in store.conn.execute(
+            f"SELECT p.prompt, t.count, t.models FROM ("
+            f"SELECT prompt_hash, COUNT(*) AS count, COUNT(DISTINCT model) AS models FROM ({union}) "
+            f"WHERE kind = 'chat' GROUP BY prompt_hash HAVING count > 1 ORDER BY count DESC LIMIT ?"
+            f") t JOIN prompts p ON p.hash = t.prompt_hash ORDER BY t.count DESC",
+            union_params + [top]
+        )
+    ]
+    return {
+        "requests": total,
+        "distinct_prompts": distinct,
+        # Share of requests an unlimited exact-match cache could have answered
+        "repeat_rate": round(1 - distinct / total, 4) if total else 0.0,
+        "models": models,
+        "top_prompts": top_prompts
+    }
+
+def print_report(result):
+    print("\n=== REQUESTS ===\n")
+    print(f"Total: {result['requests']}")
+    if not result["requests"]:
+        return
+    print(f"Distinct prompts: {result['distinct_prompts']} (repeat rate {result['repeat_rate']:.1%})")
+    print(
+        f"\n{'model':<28}{'kind':<7}{'requests':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        f"{'prompt tok p50/p95':>20}{'compl tok p50/p95':>19}{'total tokens':>14}"
+    )
+    def pair(values):
+        return f"{values.get('p50', '-')}/{values.get('p95', '-')}" if values else "-"
+
+    for model, entry in sorted(result["models"].items(), key=lambda item: -item[1]["requests"]):
+        latency = entry.get("latency_ms", {})
+        print(
+            f"{model:<28}{entry['kind']:<7}{entry['requests']:>10}"
+            f"{latency.get('p50', '-')!s:>9}{latency.get('p95', '-')!s:>9}{latency.get('p99', '-')!s:>9}"
+            f"{pair(entry.get('prompt_tokens')):>20}{pair(entry.get('completion_tokens')):>19}"
+            f"{sum(entry['total_tokens'].values()):>14}"
+        )
+    if result["top_prompts"]:
+        print("\n=== TOP REPEATED PROMPTS ===\n")
+        for entry in result["top_prompts"]:
+            prompt = " ".join(entry["prompt"].split())
+            print(f"{entry['count']:>7}  {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
+
+def prune(store, before):
+    """Drop partitions for months before `before` (YYYY-MM)"""
+    year, month = map(int, before.split("-"))
+    dropped = []
+    for name in store.list_partitions():
+        if tuple(map(int, PARTITION_PATTERN.match(name).groups())) < (year, month):
+            store.conn.execute(f"DROP TABLE {name}")
+            dropped.append(name)
+    store.conn.commit()
+    store.conn.execute("VACUUM")
+    print(f"Dropped {len(dropped)} partitions" + (f": {', '.join(dropped)}" if dropped else ""))
+
+def parse_date(value):
+    return datetime.fromisoformat(value)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact and report on the interaction log")
+    parser.add_argument("--log", default=DEFAULT_LOG_PATH, help="path of the live interactions.jsonl")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="analytics database to create or update")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ingest", help="read new log lines into the database")
+    report_parser = commands.add_parser("report", help="ingest, then print aggregates")
+    report_parser.add_argument("--since", type=parse_date, help="only records at or after this date (YYYY-MM-DD)")
+    report_parser.add_argument("--until", type=parse_date, help="only records before this date (YYYY-MM-DD)")
+    report_parser.add_argument("--top", type=int, default=20, help="number of repeated prompts to list")
+    report_parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    report_parser.add_argument("--no-ingest", action="store_true", help="report on what is already stored")
+    prune_parser = commands.add_parser("prune", help="drop monthly partitions older than a month")
+    prune_parser.add_argument("--before", required=True, help="first month to keep (YYYY-MM)")
+    args = parser.parse_args()
+
+    store = AnalyticsStore(args.db)
+    if args.command == "ingest":
+        ingest(args.log, store)
+    elif args.command == "report":
+        if not args.no_ingest:
+            ingest(args.log, store, verbose=not args.json)
+        result = report(store, args.since, args.until, args.top)
+        if args.json:
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            print_report(result)
+    elif args.command == "prune":
+        prune(store, args.before)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Server-side Markdown rendering with Pygments highlighting
+
+Messages are split into top-level blocks (paragraph runs, lists, fenced code)
+and each block is rendered once and cached by content hash, so re-rendering
+a message that is still streaming only costs its trailing block, and chat
+history that was rendered before is served from the cache. Markdown output is
+passed through an allowlist sanitizer; code blocks are highlighted by
+Pygments, which escapes them itself.
+"""
+import hashlib
+import importlib.util
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import quote
+
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)")
+LIST_ITEM_PATTERN = re.compile(r"^ {0,3}([-*+]|\d{1,9}[.)])\s")
+
+ALLOWED_TAGS = {
+    "p", "br", "hr", "h1", "h2", "h3", "h4", "h5", "h6", "strong", "em", "b", "i", "del", "sup", "sub",
+    "code", "pre", "blockquote", "ul", "ol", "li", "a", "table", "thead", "tbody", "tr", "th", "td", "span", "div"
+}
+ALLOWED_ATTRIBUTES = {"a": {"href", "title"}, "ol": {"start"}, "th": {"align"}, "td": {"align"}, "code": {"class"}, "span": {"class"}}
+DROP_CONTENT_TAGS = {"script", "style", "iframe", "object", "embed", "template", "textarea", "title"}
+VOID_TAGS = {"br", "hr"}
+SAFE_URL_SCHEMES = {"http", "https", "mailto"}
+
+def split_blocks(text, final=True):
+    """
+    Split Markdown into (complete blocks, trailing block). A block only counts as
+    complete once the next one has started, so the trailing block may still grow.
+    With final=False the last line is treated as unfinished and never starts a block,
+    so the complete blocks of a growing text only ever get appended to.
+    """
+    blocks = []
+    current = []
+    fence = None
+    blank_before = False
+
+    def flush():
+        if current:
+            blocks.append("\n".join(current).strip("\n"))
+            current.clear()
+
+    lines = text.split("\n")
+    partial = None if final else lines.pop()
+    for line in lines:
+        if fence:
+            current.append(line)
+            if line.strip().startswith(fence) and set(line.strip()) == {fence[0]}:
+                fence = None
+                flush()
+            continue
+
+        opening = FENCE_PATTERN.match(line)
+        if opening:
+            flush()
+            fence = opening.group(1)
+            current.append(line)
+            continue
+
+        if not line.strip():
+            blank_before = bool(current)
+            if current:
+                current.append(line)
+            continue
+
+        # Indented lines and further list items after a blank line continue the same block
+        if blank_before and not line.startswith((" ", "\t")) and not LIST_ITEM_PATTERN.match(line):
+            flush()
+        blank_before = False
+        current.append(line)
+
+    if partial:
+        current.append(partial)
+    return blocks, "\n".join(current).strip("\n")
+
+def safe_url(url):
+    scheme = url.split(":", 1)[0].lower() if ":" in url.split("/", 1)[0] else None
+    return scheme is None or scheme in SAFE_URL_SCHEMES
+
+class HTMLSanitizer(HTMLParser):
+    """Re-serializes HTML keeping only allowlisted tags and attributes"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.output = []
+        self.open_tags = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        kept = []
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name == "href" and not safe_url(value.strip()):
+                continue
+            kept.append(f' {name}="{escape(value, quote=True)}"')
+        if tag == "a":
+            kept.append(' rel="nofollow noopener noreferrer"')
+        self.output.append(f"<{tag}{''.join(kept)}>")
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.open_tags and self.open_tags[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        # Close anything left open inside this tag so the output stays well formed
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.output.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.output.append(escape(data, quote=False))
+
+    def result(self):
+        self.close()
+        return "".join(self.output) + "".join(f"</{tag}>" for tag in reversed(self.open_tags))
+
+def sanitize_html(html):
+    sanitizer = HTMLSanitizer()
+    sanitizer.feed(html)
+    return sanitizer.result()
+
+class MarkdownRenderer:
+    """Renders Markdown to sanitized HTML with a per-block LRU cache"""
+
+    def __init__(self, max_entries=2048, style="monokai"):
+        self.max_entries = max_entries
+        self.style = style
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.modules = None
+
+    @staticmethod
+    def available():
+        """Whether the optional markdown and pygments packages are installed"""
+        return all(importlib.util.find_spec(name) is not None for name in ("markdown", "pygments"))
+
+    def _load(self):
+        # Imported on first use so startup doesn't pay for them when rendering stays client-side
+        if self.modules is None:
+            import markdown
+            from pygments import highlight
+            from pygments.formatters import HtmlFormatter
+            from pygments.lexers import TextLexer, get_lexer_by_name
+            from pygments.util import ClassNotFound
+            self.modules = {
+                "markdown": markdown, "highlight": highlight, "HtmlFormatter": HtmlFormatter,
+                "TextLexer": TextLexer, "get_lexer_by_name": get_lexer_by_name, "ClassNotFound": ClassNotFound
+            }
+        return self.modules
+
+    def render(self, text):
+        """Sanitized HTML for a whole message"""
+        blocks, trailing = split_blocks(text or "")
+        return "".join(self.render_block(block) for block in blocks + [trailing])
+
+    def render_block(self, block, cache=True):
+        """HTML for one block; pass cache=False for a block that is still changing"""
+        if not block.strip():
+            return ""
+        if not cache:
+            return self._render_uncached(block)
+        key = hashlib.sha256(block.encode()).hexdigest()
+        with self.lock:
+            html = self.cache.get(key)
+            if html is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        html = self._render_uncached(block)
+        with self.lock:
+            self.cache[key] = html
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return html
+
+    def _render_uncached(self, block):
+        opening = FENCE_PATTERN.match(block)
+        if opening:
+            lines = block.split("\n")[1:]
+            if lines and lines[-1].strip().startswith(opening.group(1)):
+                lines = lines[:-1]
+            return self.render_code("\n".join(lines), opening.group(2))
+        html = self._load()["markdown"].markdown(block, extensions=["tables", "sane_lists", "nl2br"])
+        return sanitize_html(html)
+
+    def render_code(self, code, language=""):
+        """Highlighted code block, with the same header and copy button markup as the client"""
+        modules = self._load()
+        language = re.sub(r"[^\w+#.-]", "", language or "") or "plaintext"
+        try:
+            lexer = modules["get_lexer_by_name"](language)
+        except modules["ClassNotFound"]:
+            lexer = modules["TextLexer"]()
+        highlighted = modules["highlight"](code, lexer, modules["HtmlFormatter"](nowrap=True))
+        return (
+            f'<div class="code-header"><span class="language-tag">{escape(language)}</span>'
+            f'<button class="copy-code-btn" data-code="{escape(quote(code.strip(), safe=""))}">'
+            f'<i class="fas fa-copy"></i> Copy code</button></div>'
+            f'<pre class="highlight"><code class="language-{escape(language)}">{highlighted}</code></pre>'
+        )
+
+    def stylesheet(self):
+        """Pygments token colors for the highlighted code blocks"""
+        rules = self._load()["HtmlFormatter"](style=self.style).get_style_defs(".highlight")
+        # Drop Pygments' unscoped rules (e.g. for every pre) so they don't restyle the rest of the page
+        return "\n".join(rule for rule in rules.splitlines() if rule.startswith(".highlight"))
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.cache),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+class StreamRender:
+    """
+    Tracks one streamed message. Each completed block is rendered once and sent
+    once; only the trailing block is re-rendered, at most every min_interval seconds.
+    """
+
+    def __init__(self, renderer, min_interval=0.1):
+        self.renderer = renderer
+        self.min_interval = min_interval
+        self.sent_blocks = 0
+        self.rendered_at = 0.0
+
+    def update(self, text, delta=""):
+        """Event fields to add for the text so far: html_blocks (new complete blocks) and html_tail"""
+        now = time.monotonic()
+        due = now - self.rendered_at >= self.min_interval
+        # Blocks can only complete at a line break; otherwise wait out the interval
+        if not due and "\n" not in delta:
+            return {}
+        blocks, trailing = split_blocks(text, final=False)
+        if not due and len(blocks) == self.sent_blocks:
+            return {}
+        new_blocks = blocks[self.sent_blocks:]
+        self.sent_blocks = len(blocks)
+        self.rendered_at = now
+        return {
+            "html_blocks": [self.renderer.render_block(block) for block in new_blocks],
+            "html_tail": self.renderer.render_block(trailing, cache=False)
+        }
+
+def create_markdown_renderer():
+    """Build the renderer configured by RENDER_CACHE_SIZE and RENDER_CODE_STYLE, or None if unavailable"""
+    if not MarkdownRenderer.available():
+        print("Server-side rendering disabled: install markdown and pygments to enable it")
+        return None
+    return MarkdownRenderer(
+        max_entries=int(os.getenv("RENDER_CACHE_SIZE", 2048)),
+        style=os.getenv("RENDER_CODE_STYLE", "monokai")
+    )
@@ -0,0 +1,152 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format
+
+Counters and histograms are kept per process; under gunicorn a scrape shows
+the worker that served it (see the pid label on process_start_time_seconds).
+"""
+import bisect
+import os
+import threading
+import time
+
+# Latency buckets (seconds) from a cache hit up to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Size buckets (bytes) from a small JSON body up to an inline image
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_metrics = []
+_collectors = []
+_lock = threading.Lock()
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    """Monotonic counter with optional labels"""
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        with _lock:
+            _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in items]
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+        with _lock:
+            _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.values.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+def register_collector(collect):
+    """Add a callable returning [(name, type, description, value)] read at scrape time"""
+    with _lock:
+        _collectors.append(collect)
+
+def render():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    with _lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    for collect in collectors:
+        try:
+            for name, kind, description, value in collect():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        except Exception as e:
+            print(f"Metrics collector error: {str(e)}")
+    lines.append("# HELP process_start_time_seconds Unix time the worker process started")
+    lines.append("# TYPE process_start_time_seconds gauge")
+    lines.append(f'process_start_time_seconds{{pid="{os.getpid()}"}} {START_TIME}')
+    return "\n".join(lines) + "\n"
+
+START_TIME = time.time()
+
+# Incoming requests
+REQUESTS = Counter("http_requests_total", "Requests handled, by route, method and status", ("route", "method", "status"))
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Time until the response headers are ready", ("route", "method"))
+REQUEST_SIZE = Histogram("http_request_size_bytes", "Request body size", ("route",), SIZE_BUCKETS)
+RESPONSE_SIZE = Histogram("http_response_size_bytes", "Response body size (non-streaming responses)", ("route",), SIZE_BUCKETS)
+ERRORS = Counter("api_errors_total", "Error responses returned for upstream failures, by status and kind", ("status", "kind"))
+
+# Upstream API calls
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Upstream API calls, by endpoint and final status", ("endpoint", "status"))
+UPSTREAM_CONNECT = Histogram("upstream_connect_seconds", "TCP and TLS setup time (0 when a pooled connection is reused)", ("endpoint",))
+UPSTREAM_TTFB = Histogram("upstream_ttfb_seconds", "Time from sending the request to the upstream response headers", ("endpoint",))
+UPSTREAM_TOTAL = Histogram("upstream_total_seconds", "Time until the upstream response body is fully read, retries included", ("endpoint",))
+UPSTREAM_REQUEST_SIZE = Histogram("upstream_request_size_bytes", "Upstream request body size", ("endpoint",), SIZE_BUCKETS)
+UPSTREAM_RESPONSE_SIZE = Histogram("upstream_response_size_bytes", "Upstream response body size (non-streaming calls)", ("endpoint",), SIZE_BUCKETS)
+UPSTREAM_QUEUE_WAIT = Histogram("upstream_queue_wait_seconds", "Time requests waited for an upstream slot")
+UPSTREAM_REJECTED = Counter("upstream_rejected_total", "Requests shed by the upstream scheduler, by returned status", ("status",))
+TOKENS = Counter("upstream_tokens_total", "Tokens reported in the upstream usage field", ("model", "type"))
+MODEL_FAILOVERS = Counter("model_failovers_total", "Chat calls retried on another model after a timeout or 5xx", ("model", "fallback"))
+
+def record_request(route, method, status, seconds, request_size=None, response_size=None):
+    """Record one handled request"""
+    REQUESTS.inc(route=route, method=method, status=status)
+    REQUEST_LATENCY.observe(seconds, route=route, method=method)
+    if request_size:
+        REQUEST_SIZE.observe(request_size, route=route)
+    if response_size is not None:
+        RESPONSE_SIZE.observe(response_size, route=route)
+
+def observe_usage(model, usage):
+    """Count prompt/completion tokens from an upstream usage object"""
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            TOKENS.inc(usage[kind], model=model, type=kind[:-len("_tokens")])
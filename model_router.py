@@ -0,0 +1,260 @@
+"""
+Model registry and router
+
+Knows which models are enabled (AVAILABLE_MODELS / DEFAULT_MODEL) and what each
+one supports, adapts chat payloads to a model's parameter rules, and keeps
+rolling latency and error stats per model so a request can fail over to a
+healthy alternative when its model times out or returns 5xx.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# What each known model accepts. Unknown chat models get DEFAULT_CAPABILITIES.
+MODEL_CAPABILITIES = {
+    "gpt-4o-mini": {"kind": "chat", "vision": True, "max_output_tokens": 16384},
+    "gpt-4o": {"kind": "chat", "vision": True, "max_output_tokens": 16384},
+    "gpt-4-turbo": {"kind": "chat", "vision": True, "max_output_tokens": 4096},
+    "gpt-3.5-turbo": {"kind": "chat", "vision": False, "max_output_tokens": 4096},
+    # Reasoning models: no temperature/top_p, no system messages, max_completion_tokens
+    "o1-mini": {"kind": "chat", "vision": False, "max_output_tokens": 65536, "temperature": False,
+                "system_messages": False, "max_tokens_param": "max_completion_tokens"},
+    "o1": {"kind": "chat", "vision": True, "max_output_tokens": 100000, "temperature": False,
+           "system_messages": False, "max_tokens_param": "max_completion_tokens"},
+    "dall-e-2": {"kind": "image"},
+    "dall-e-3": {"kind": "image"}
+}
+DEFAULT_CAPABILITIES = {
+    "kind": "chat",
+    "vision": False,
+    "max_output_tokens": 4096,
+    "temperature": True,
+    "system_messages": True,
+    "max_tokens_param": "max_tokens"
+}
+
+class ModelUnavailable(Exception):
+    """Raised when no enabled model can serve a request (e.g. it has an image and none has vision)"""
+
+def capabilities_for(model):
+    """Capabilities of a model, matching dated snapshots (e.g. gpt-4o-mini-2024-07-18) to their family"""
+    known = MODEL_CAPABILITIES.get(model)
+    if known is None:
+        family = max((name for name in MODEL_CAPABILITIES if model.startswith(name + "-")), key=len, default=None)
+        known = MODEL_CAPABILITIES.get(family, {})
+    return {**DEFAULT_CAPABILITIES, **known}
+
+def needs_vision(payload):
+    """Whether a chat payload carries image content"""
+    return any(
+        isinstance(message.get("content"), list)
+        and any(part.get("type") == "image_url" for part in message["content"])
+        for message in payload.get("messages", [])
+    )
+
+class ModelStats:
+    """Rolling latency and outcome window for one model, plus a failure cooldown"""
+
+    def __init__(self, window=50):
+        self.samples = deque(maxlen=window)  # (latency seconds or None, ok)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def latency(self, fraction):
+        latencies = sorted(latency for latency, ok in self.samples if ok and latency is not None)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+class ModelRouter:
+    """Validates requested models and orders fail-over candidates by health and latency"""
+
+    def __init__(self, models, default_model, window=50, error_threshold=0.5, failure_threshold=3,
+                 cooldown=30.0, max_failovers=1):
+        self.default_model = default_model
+        # An empty AVAILABLE_MODELS list means any requested model is passed through
+        self.restricted = bool(models)
+        self.models = list(dict.fromkeys([default_model] + list(models)))
+        self.window = window
+        self.error_threshold = error_threshold
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_failovers = max_failovers
+        self.stats_by_model = {}
+        self.lock = threading.Lock()
+
+    def chat_models(self):
+        return [model for model in self.models if capabilities_for(model)["kind"] == "chat"]
+
+    def capabilities(self, model):
+        return capabilities_for(model)
+
+    def resolve(self, requested, vision=False):
+        """
+        The chat model to use: the requested one if enabled and capable, else the best fit.
+        Responses report the model used, since it can differ from the one requested.
+        """
+        model = requested or self.default_model
+        if self.restricted and model not in self.models:
+            model = self.default_model
+        if capabilities_for(model)["kind"] != "chat":
+            model = self.default_model
+        if vision and not capabilities_for(model)["vision"]:
+            # Only ever an enabled model: the operator may have left vision models out on purpose
+            vision_models = [m for m in self.chat_models() if capabilities_for(m)["vision"]]
+            if not vision_models:
+                raise ModelUnavailable("None of the enabled models accepts images")
+            model = vision_models[0]
+        return model
+
+    def _stats(self, model):
+        stats = self.stats_by_model.get(model)
+        if stats is None:
+            stats = self.stats_by_model[model] = ModelStats(self.window)
+        return stats
+
+    def healthy(self, model, now=None):
+        """False while a model is cooling down or failing more than error_threshold of recent calls"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            stats = self._stats(model)
+            if now < stats.cooldown_until:
+                return False
+            return len(stats.samples) < 10 or stats.error_rate() < self.error_threshold
+
+    def candidates(self, model, payload=None):
+        """
+        Models to try in order: the chosen model first unless it is unhealthy, then
+        healthy capable alternatives by rolling median latency, up to max_failovers of them.
+        """
+        vision = needs_vision(payload) if payload else False
+        alternatives = [
+            m for m in self.chat_models()
+            if m != model and (not vision or capabilities_for(m)["vision"]) and self.healthy(m)
+        ]
+        with self.lock:
+            alternatives.sort(key=lambda m: self._stats(m).latency(0.5) or float("inf"))
+        alternatives = alternatives[:self.max_failovers]
+        if self.healthy(model) or not alternatives:
+            return [model] + alternatives
+        return alternatives + [model]
+
+    def record(self, model, latency, ok):
+        """Record one upstream call (latency None if not comparable); repeated failures put the model in cooldown"""
+        with self.lock:
+            stats = self._stats(model)
+            stats.samples.append((latency, ok))
+            if ok:
+                stats.consecutive_failures = 0
+                return
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.failure_threshold:
+                stats.cooldown_until = time.monotonic() + self.cooldown
+                stats.consecutive_failures = 0
+                print(f"Model {model} failed {self.failure_threshold} times in a row; avoiding it for {self.cooldown:g}s")
+
+    def _attempts(self, payload):
+        candidates = self.candidates(payload["model"], payload)
+        for attempt, model in enumerate(candidates):
+            attempt_payload = payload if model == payload["model"] else self.adapt_payload(payload, model)
+            next_model = candidates[attempt + 1] if attempt + 1 < len(candidates) else None
+            yield model, attempt_payload, next_model
+
+    def _failed(self, model, next_model, error, should_fail_over):
+        """Record a failed attempt; True if the caller should move on to next_model"""
+        if not should_fail_over(error):
+            return False  # Client errors and shed requests say nothing about the model's health
+        self.record(model, None, ok=False)
+        if next_model:
+            print(f"Model {model} failed ({error}); failing over to {next_model}")
+            metrics.MODEL_FAILOVERS.inc(model=model, fallback=next_model)
+            return True
+        return False
+
+    def call(self, payload, send, should_fail_over, timed=True):
+        """
+        Run send(payload) for each candidate model until one succeeds. Errors for which
+        should_fail_over(error) is true move on to the next model; others are raised.
+        Pass timed=False when send returns before the call finishes (streams).
+        """
+        for model, attempt_payload, next_model in self._attempts(payload):
+            started = time.perf_counter()
+            try:
+                result = send(attempt_payload)
+            except Exception as e:
+                if self._failed(model, next_model, e, should_fail_over):
+                    continue
+                raise
+            self.record(model, time.perf_counter() - started if timed else None, ok=True)
+            return result
+
+    async def call_async(self, payload, send, should_fail_over, timed=True):
+        """Async twin of call() for a coroutine function send"""
+        for model, attempt_payload, next_model in self._attempts(payload):
+            started = time.perf_counter()
+            try:
+                result = await send(attempt_payload)
+            except Exception as e:
+                if self._failed(model, next_model, e, should_fail_over):
+                    continue
+                raise
+            self.record(model, time.perf_counter() - started if timed else None, ok=True)
+            return result
+
+    def adapt_payload(self, payload, model):
+        """Copy of a chat payload rewritten for model's parameter rules"""
+        capabilities = capabilities_for(model)
+        adapted = {**payload, "model": model}
+        if not capabilities["temperature"]:
+            adapted.pop("temperature", None)
+            adapted.pop("top_p", None)
+        if not capabilities["system_messages"]:
+            adapted["messages"] = [
+                {**message, "role": "user"} if message.get("role") == "system" else message
+                for message in adapted.get("messages", [])
+            ]
+        max_tokens = adapted.pop("max_tokens", None) or adapted.pop("max_completion_tokens", None)
+        if max_tokens:
+            adapted[capabilities["max_tokens_param"]] = min(max_tokens, capabilities["max_output_tokens"])
+        return adapted
+
+    def stats(self):
+        now = time.monotonic()
+        report = {}
+        for model in self.models:
+            capabilities = capabilities_for(model)
+            entry = {"capabilities": capabilities, "default": model == self.default_model}
+            if capabilities["kind"] == "chat":
+                healthy = self.healthy(model, now)
+                with self.lock:
+                    stats = self._stats(model)
+                    entry.update({
+                        "healthy": healthy,
+                        "samples": len(stats.samples),
+                        "error_rate": round(stats.error_rate(), 4),
+                        "p50_seconds": stats.latency(0.5),
+                        "p95_seconds": stats.latency(0.95),
+                        "cooldown_seconds": round(max(stats.cooldown_until - now, 0), 1)
+                    })
+            report[model] = entry
+        return report
+
+def create_model_router():
+    """Build the router configured by DEFAULT_MODEL, AVAILABLE_MODELS and ROUTER_* variables"""
+    return ModelRouter(
+        models=[m.strip() for m in os.getenv("AVAILABLE_MODELS", "").split(",") if m.strip()],
+        default_model=os.getenv("DEFAULT_MODEL", "gpt-4o-mini"),
+        window=int(os.getenv("ROUTER_WINDOW", 50)),
+        error_threshold=float(os.getenv("ROUTER_ERROR_THRESHOLD", 0.5)),
+        failure_threshold=int(os.getenv("ROUTER_FAILURE_THRESHOLD", 3)),
+        cooldown=float(os.getenv("ROUTER_COOLDOWN", 30)),
+        max_failovers=int(os.getenv("ROUTER_MAX_FAILOVERS", 1))
+    )
@@ -0,0 +1,106 @@
+"""
+Client for the provider's asynchronous Batch API
+
+Large offline jobs are uploaded as one JSONL file of chat completion
+requests and processed by the provider within its completion window, at a
+lower price and without holding any of our workers while they run.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+import http_client
+
+COMPLETION_WINDOW = "24h"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+class ProviderBatchClient:
+    """Submits batch jobs and reads their status and results"""
+
+    def __init__(self, base_url, api_key, max_cached_results=32):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_cached_results = max_cached_results
+        # Results of completed batches never change, so keep a few instead of re-downloading
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _auth(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def submit(self, payloads, metadata=None):
+        """Upload one request per payload and start a batch; returns the provider's batch object"""
+        lines = [
+            json.dumps({
+                "custom_id": str(index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": payload
+            })
+            for index, payload in enumerate(payloads)
+        ]
+        upload = http_client.post(
+            f"{self.base_url}/files",
+            headers=self._auth(),
+            data={"purpose": "batch"},
+            files={"file": ("batch.jsonl", ("\n".join(lines) + "\n").encode(), "application/jsonl")}
+        )
+        upload.raise_for_status()
+
+        response = http_client.post(
+            f"{self.base_url}/batches",
+            headers={**self._auth(), "Content-Type": "application/json"},
+            json={
+                "input_file_id": upload.json()["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": COMPLETION_WINDOW,
+                "metadata": metadata or {}
+            }
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def status(self, batch_id):
+        response = http_client.get(f"{self.base_url}/batches/{batch_id}", headers=self._auth())
+        response.raise_for_status()
+        return response.json()
+
+    def results_for(self, batch):
+        """Per-item results of a completed batch, ordered like the submitted payloads"""
+        with self.lock:
+            if batch["id"] in self.results:
+                self.results.move_to_end(batch["id"])
+                return self.results[batch["id"]]
+
+        items = {}
+        for file_id, is_error_file in ((batch.get("output_file_id"), False), (batch.get("error_file_id"), True)):
+            if not file_id:
+                continue
+            response = http_client.get(f"{self.base_url}/files/{file_id}/content", headers=self._auth())
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                if line.strip():
+                    record = json.loads(line)
+                    items[int(record["custom_id"])] = parse_result(record, is_error_file)
+        results = [items[index] for index in sorted(items)]
+
+        with self.lock:
+            self.results[batch["id"]] = results
+            while len(self.results) > self.max_cached_results:
+                self.results.popitem(last=False)
+        return results
+
+def parse_result(record, is_error_file=False):
+    """Turn one output-file line into the same item shape /generate/batch returns"""
+    index = int(record["custom_id"])
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if record.get("error") or is_error_file or response.get("status_code", 200) >= 400:
+        error = record.get("error") or body.get("error") or {}
+        return {"index": index, "status": response.get("status_code", 500), "error": error.get("message", "Batch request failed")}
+    return {
+        "index": index,
+        "status": 200,
+        "response": body["choices"][0]["message"]["content"],
+        "usage": body.get("usage")
+    }
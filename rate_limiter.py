@@ -0,0 +1,331 @@
+"""
+Client-side scheduler in front of upstream API calls
+
+Caps concurrent calls, tracks the account's per-model request and token
+budgets (seeded from the x-ratelimit-* response headers), and queues excess
+work per user, serving users round-robin. A request is only rejected when it
+could not start before its queue deadline: 429 when the rate budget is the
+bottleneck, 503 when the queue or concurrency cap is.
+
+Each server process runs its own scheduler, so the configured concurrency cap
+and RPM/TPM budgets (and the account-wide limits the headers report) are split
+evenly across the processes to keep their sum under the provider's quotas.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from context_window import message_tokens
+import metrics
+
+def estimate_tokens(payload):
+    """Tokens the upstream counts against the TPM limit: the prompt plus max_tokens"""
+    max_tokens = payload.get("max_tokens") or payload.get("max_completion_tokens") or 0
+    return sum(message_tokens(message) for message in payload.get("messages", [])) + max_tokens
+
+class SchedulerRejected(Exception):
+    """Raised when a request cannot get an upstream slot before its deadline"""
+
+    def __init__(self, status_code, message, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class RateBudget:
+    """Allowance for one per-minute limit that refills continuously, as the upstream's does"""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.available = float(limit or 0)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.limit:
+            self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available (0 when the limit is unknown)"""
+        if not self.limit:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.limit)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.limit
+
+    def consume(self, amount, now):
+        if self.limit:
+            self._refill(now)
+            self.available -= amount
+
+    def sync(self, limit, remaining, now):
+        """Adopt the upstream's view of the limit and what is left of it"""
+        if limit:
+            self.limit = limit
+        if remaining is not None and self.limit:
+            self.available = float(remaining)
+            self.updated = now
+
+class Ticket:
+    """One request waiting for, or holding, an upstream slot"""
+
+    def __init__(self, user, model, cost, deadline, notify=None):
+        self.user = user
+        self.model = model
+        self.cost = cost
+        self.deadline = deadline
+        self.notify = notify
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+
+class UpstreamScheduler:
+    """Concurrency cap plus per-model RPM/TPM budgets with a fair per-user queue"""
+
+    def __init__(self, max_concurrency=16, max_queue=256, queue_timeout=30.0, rpm=None, tpm=None, processes=1):
+        # Limits are for the whole deployment; this process gets a 1/processes share of each
+        self.processes = max(1, processes)
+        self.max_concurrency = self._share(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.default_rpm = self._share(rpm)
+        self.default_tpm = self._share(tpm)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.queues = OrderedDict()  # user -> deque of tickets, rotated for round-robin service
+        self.budgets = {}  # model -> (request budget, token budget)
+        self.wake_timer = None
+        self.wake_at = None
+
+    def _share(self, value):
+        """This process's part of a deployment-wide limit (at least 1), or None if unset"""
+        if value is None:
+            return None
+        return max(1, value // self.processes)
+
+    def _budgets(self, model):
+        budgets = self.budgets.get(model)
+        if budgets is None:
+            budgets = self.budgets[model] = (RateBudget(self.default_rpm), RateBudget(self.default_tpm))
+        return budgets
+
+    def _budget_wait(self, model, requests, tokens, now):
+        request_budget, token_budget = self._budgets(model)
+        return max(request_budget.wait_time(requests, now), token_budget.wait_time(tokens, now))
+
+    def _grant(self, ticket, now):
+        request_budget, token_budget = self._budgets(ticket.model)
+        request_budget.consume(1, now)
+        token_budget.consume(ticket.cost, now)
+        ticket.granted = True
+        self.active += 1
+        metrics.UPSTREAM_QUEUE_WAIT.observe(now - ticket.enqueued_at)
+        if ticket.notify:
+            ticket.notify()
+
+    def _enqueue(self, user, model, cost, timeout, notify):
+        """Grant a ticket now, queue it, or raise SchedulerRejected; call with the lock held"""
+        now = time.monotonic()
+        timeout = self.queue_timeout if timeout is None else timeout
+        ticket = Ticket(user, model, cost, now + timeout, notify)
+
+        if not self.queues and self.active < self.max_concurrency and self._budget_wait(model, 1, cost, now) == 0:
+            ticket.notify = None
+            self._grant(ticket, now)
+            return ticket
+
+        if self.queued >= self.max_queue:
+            metrics.UPSTREAM_REJECTED.inc(status=503)
+            raise SchedulerRejected(503, "Server is busy. Please try again shortly.", 1)
+
+        # Shed now if the rate budget cannot cover the work already queued for this model in time
+        queued_same_model = [t for queue in self.queues.values() for t in queue if t.model == model]
+        budget_wait = self._budget_wait(
+            model, len(queued_same_model) + 1, sum(t.cost for t in queued_same_model) + cost, now
+        )
+        if budget_wait > timeout:
+            metrics.UPSTREAM_REJECTED.inc(status=429)
+            raise SchedulerRejected(429, "Rate limit budget exhausted. Please try again later.", budget_wait)
+
+        self.queues.setdefault(user, deque()).append(ticket)
+        self.queued += 1
+        self._dispatch()
+        return ticket
+
+    def _cancel(self, ticket):
+        """Remove a ticket that timed out; returns False if it was granted meanwhile"""
+        with self.lock:
+            if ticket.granted:
+                return False
+            queue = self.queues.get(ticket.user)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                self.queued -= 1
+                if not queue:
+                    del self.queues[ticket.user]
+            metrics.UPSTREAM_REJECTED.inc(status=503)
+            return True
+
+    def _dispatch(self):
+        """Grant queued tickets, one user at a time, while capacity allows; call with the lock held"""
+        now = time.monotonic()
+        next_wake = None
+        blocked = 0
+        while self.queues and self.active < self.max_concurrency and blocked < len(self.queues):
+            user = next(iter(self.queues))
+            queue = self.queues[user]
+            self.queues.move_to_end(user)
+            ticket = queue[0]
+            wait = self._budget_wait(ticket.model, 1, ticket.cost, now)
+            if wait > 0:
+                # This user's head is waiting on its model's budget; others may still proceed
+                blocked += 1
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+                continue
+            blocked = 0
+            queue.popleft()
+            self.queued -= 1
+            if not queue:
+                del self.queues[user]
+            self._grant(ticket, now)
+
+        if next_wake is not None and self.active < self.max_concurrency:
+            self._schedule_wake(now + next_wake)
+
+    def _schedule_wake(self, wake_at):
+        if self.wake_timer is not None and self.wake_at <= wake_at:
+            return
+        if self.wake_timer is not None:
+            self.wake_timer.cancel()
+        self.wake_at = wake_at
+        self.wake_timer = threading.Timer(max(wake_at - time.monotonic(), 0.001), self._wake)
+        self.wake_timer.daemon = True
+        self.wake_timer.start()
+
+    def _wake(self):
+        with self.lock:
+            self.wake_timer = None
+            self.wake_at = None
+            self._dispatch()
+
+    def acquire(self, user, model, cost, timeout=None):
+        """Block until a slot is granted; raises SchedulerRejected instead of missing the deadline"""
+        granted = threading.Event()
+        with self.lock:
+            ticket = self._enqueue(user, model, cost, timeout, granted.set)
+        if not ticket.granted and not granted.wait(max(ticket.deadline - time.monotonic(), 0)):
+            if self._cancel(ticket):
+                raise SchedulerRejected(503, "Timed out waiting for an upstream slot. Please try again.", 1)
+        return ticket
+
+    async def acquire_async(self, user, model, cost, timeout=None):
+        """Await a slot without blocking the event loop; same rejection rules as acquire()"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        with self.lock:
+            ticket = self._enqueue(user, model, cost, timeout, notify)
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), max(ticket.deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                if self._cancel(ticket):
+                    raise SchedulerRejected(503, "Timed out waiting for an upstream slot. Please try again.", 1)
+            except asyncio.CancelledError:
+                if not self._cancel(ticket):
+                    self.release(ticket)
+                raise
+        return ticket
+
+    @contextmanager
+    def slot(self, user, model, cost, timeout=None):
+        """Hold an upstream slot for the duration of a with block"""
+        ticket = self.acquire(user, model, cost, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def async_slot(self, user, model, cost, timeout=None):
+        """Async twin of slot()"""
+        ticket = await self.acquire_async(user, model, cost, timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def release(self, ticket):
+        """Return a granted slot; safe to call more than once"""
+        with self.lock:
+            if not ticket.granted or ticket.released:
+                return
+            ticket.released = True
+            self.active -= 1
+            self._dispatch()
+
+    def update(self, model, headers):
+        """Sync a model's budgets from x-ratelimit-* response headers"""
+        def header_int(name):
+            try:
+                return int(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        request_limit = header_int("x-ratelimit-limit-requests")
+        request_remaining = header_int("x-ratelimit-remaining-requests")
+        token_limit = header_int("x-ratelimit-limit-tokens")
+        token_remaining = header_int("x-ratelimit-remaining-tokens")
+        if request_limit is None and token_limit is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            request_budget, token_budget = self._budgets(model)
+            # The headers describe the whole account, which every process draws from
+            request_budget.sync(self._share(request_limit), self._share(request_remaining), now)
+            token_budget.sync(self._share(token_limit), self._share(token_remaining), now)
+            self._dispatch()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "max_concurrency": self.max_concurrency,
+                "processes": self.processes,
+                "budgets": {
+                    model: {
+                        "rpm": requests.limit,
+                        "requests_available": int(requests.available) if requests.limit else None,
+                        "tpm": tokens.limit,
+                        "tokens_available": int(tokens.available) if tokens.limit else None
+                    }
+                    for model, (requests, tokens) in self.budgets.items()
+                }
+            }
+
+def create_upstream_scheduler():
+    """
+    Build the scheduler configured by UPSTREAM_* environment variables. The limits are
+    for the whole deployment and are divided among WEB_CONCURRENCY worker processes
+    (set by gunicorn.conf.py, and read by uvicorn --workers too).
+    """
+    rpm = os.getenv("UPSTREAM_RPM")
+    tpm = os.getenv("UPSTREAM_TPM")
+    return UpstreamScheduler(
+        max_concurrency=int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 16)),
+        max_queue=int(os.getenv("UPSTREAM_MAX_QUEUE", 256)),
+        queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 30)),
+        rpm=int(rpm) if rpm else None,
+        tpm=int(tpm) if tpm else None,
+        processes=int(os.getenv("WEB_CONCURRENCY", 1))
+    )
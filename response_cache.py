@@ -0,0 +1,227 @@
+"""
+Exact-match response cache for deterministic /generate requests
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlite_store import SQLiteStore
+
+# Payload fields that determine the completion; everything else (e.g. stream) is ignored.
+# Reasoning models carry the output limit as max_completion_tokens instead of max_tokens.
+KEY_FIELDS = ("model", "max_tokens", "max_completion_tokens", "temperature", "top_p", "n")
+
+def normalize_content(content):
+    """Normalize message content, replacing inline image data with its digest"""
+    if isinstance(content, str):
+        return content.strip()
+    parts = []
+    for part in content or []:
+        if part.get("type") == "image_url":
+            url = part.get("image_url", {}).get("url", "")
+            parts.append({"type": "image_url", "digest": hashlib.sha256(url.encode()).hexdigest()})
+        else:
+            parts.append({"type": part.get("type"), "text": (part.get("text") or "").strip()})
+    return parts
+
+def make_cache_key(payload):
+    """Hash the parts of an upstream chat payload that determine its completion"""
+    key_data = {field: payload.get(field) for field in KEY_FIELDS}
+    key_data["messages"] = [
+        {"role": message.get("role"), "content": normalize_content(message.get("content"))}
+        for message in payload.get("messages", [])
+    ]
+    encoded = json.dumps(key_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+def should_cache(data):
+    """Only deterministic (temperature 0) or explicitly opted-in requests are cached"""
+    if data.get("cache") is not None:
+        return bool(data.get("cache"))
+    try:
+        return float(data.get("temperature", 0.7)) == 0
+    except (TypeError, ValueError):
+        return False
+
+class MemoryCacheBackend:
+    """In-process LRU cache with a TTL and a cap on the total size of stored values"""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value, size)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def size(self):
+        with self.lock:
+            return len(self.entries), self.total_bytes
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+class SQLiteCacheBackend(SQLiteStore):
+    """On-disk LRU cache shared by every worker process that points at the same file"""
+
+    # cache_size holds the running total of size, kept exact by triggers so no write has to
+    # re-sum the table; it is seeded from the rows of a cache file created before it existed
+    SCHEMA = """
+    BEGIN IMMEDIATE;
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires_at REAL NOT NULL,
+        accessed_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache (accessed_at);
+    CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at);
+    CREATE TABLE IF NOT EXISTS cache_size (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        total INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM response_cache;
+    CREATE TRIGGER IF NOT EXISTS response_cache_added AFTER INSERT ON response_cache
+    BEGIN UPDATE cache_size SET total = total + new.size WHERE id = 0; END;
+    CREATE TRIGGER IF NOT EXISTS response_cache_removed AFTER DELETE ON response_cache
+    BEGIN UPDATE cache_size SET total = total - old.size WHERE id = 0; END;
+    CREATE TRIGGER IF NOT EXISTS response_cache_resized AFTER UPDATE OF size ON response_cache
+    BEGIN UPDATE cache_size SET total = total + new.size - old.size WHERE id = 0; END;
+    COMMIT;
+    """
+
+    def __init__(self, path, max_bytes, ttl, touch_interval=60.0):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Recency is only recorded once per touch_interval per entry, so most hits don't write
+        self.touch_interval = min(touch_interval, ttl / 10)
+        # Serializes read-modify-write sequences (touch on read, evict after write) within a process
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self._conn().execute(
+                "SELECT value, expires_at, accessed_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn().execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            if now - row[2] >= self.touch_interval:
+                self._conn().execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key, value):
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete would skip the size trigger
+            self._conn().execute(
+                "INSERT INTO response_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                "expires_at = excluded.expires_at, accessed_at = excluded.accessed_at",
+                (key, value, size, now + self.ttl, now)
+            )
+            self._evict(now)
+
+    def size(self):
+        with self.lock:
+            count, total = self._conn().execute(
+                "SELECT COUNT(*), (SELECT total FROM cache_size WHERE id = 0) FROM response_cache"
+            ).fetchone()
+            return count, total or 0
+
+    def _evict(self, now):
+        """Drop expired rows, then least recently used rows until under the byte cap"""
+        self._conn().execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+        total = self._conn().execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in self._conn().execute("SELECT key, size FROM response_cache ORDER BY accessed_at"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn().executemany("DELETE FROM response_cache WHERE key = ?", stale)
+
+class ResponseCache:
+    """Counts hits and misses in front of a pluggable backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def stats(self):
+        entries, size_bytes = self.backend.size()
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_bytes": size_bytes
+        }
+
+def create_response_cache():
+    """Build the cache configured by RESPONSE_CACHE_* environment variables, or None if disabled"""
+    backend_name = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+    max_bytes = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+
+    if backend_name == "memory":
+        return ResponseCache(MemoryCacheBackend(max_bytes, ttl))
+    if backend_name == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "responses.sqlite3")
+        path = os.getenv("RESPONSE_CACHE_PATH", default_path)
+        return ResponseCache(SQLiteCacheBackend(path, max_bytes, ttl))
+    return None
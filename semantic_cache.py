@@ -0,0 +1,240 @@
+"""
+Semantic response cache for near-duplicate prompts
+
+Prompts are embedded as hashed character n-gram vectors (no model download,
+a few hundred microseconds on CPU) and kept in a NumPy matrix, so a lookup is
+one matrix-vector product over every cached prompt for the same model and
+generation settings. A reply is reused when the cosine similarity of the
+prompts reaches the threshold and the prompts share their numbers and content
+words: n-grams score "2+2" vs "2+3", "is 7 prime" vs "is 7 not prime" or
+JavaScript vs TypeScript as near-duplicates, but they are different questions.
+The index is warmed from the interaction log and grows as new replies are
+generated.
+"""
+import importlib.util
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+# Optional, and imported only once a cache is built: NumPy alone costs more startup time than the rest of the app
+np = None
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+WORD_PATTERN = re.compile(r"[^\W_]+", re.UNICODE)
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+# Words a rewording may add or drop without changing the question. Negations
+# ("not", "no", the "t" of "isn't") are deliberately absent.
+FILLER_WORDS = frozenset("""
+a an the is are was were be been am do does did s can could would will please
+i me my you your tell us we it its this that
+""".split())
+# Generation settings a cached reply is scoped by, besides the model
+SCOPE_FIELDS = ("max_tokens", "temperature")
+
+def normalize_prompt(prompt):
+    """Lowercase words separated by single spaces; punctuation and spacing don't change the meaning"""
+    return " ".join(WORD_PATTERN.findall(prompt.lower()))
+
+def prompt_signature(prompt):
+    """What two prompts must share to be the same question: their numbers, in order, and their content words"""
+    words = frozenset(normalize_prompt(prompt).split()) - FILLER_WORDS
+    return NUMBER_PATTERN.findall(prompt), words
+
+def cache_scope(model, settings):
+    """Index key for replies from model under settings (see SCOPE_FIELDS)"""
+    settings = settings or {}
+    return (model,) + tuple(settings.get(field) for field in SCOPE_FIELDS)
+
+class HashedNgramEmbedder:
+    """Signed feature hashing of character n-grams and words into a fixed-size unit vector"""
+
+    def __init__(self, dim=512, ngram_sizes=(3, 4, 5)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def features(self, text):
+        padded = f" {text} "
+        for size in self.ngram_sizes:
+            for i in range(len(padded) - size + 1):
+                yield padded[i:i + size]
+        # Whole words weigh in too, so word order matters less than spelling
+        for word in text.split():
+            yield "w:" + word
+
+    def embed(self, prompt):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(normalize_prompt(prompt)):
+            # crc32 is stable across processes, unlike hash(), so vectors match between workers
+            digest = zlib.crc32(feature.encode())
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+class SemanticCache:
+    """Fixed-capacity nearest-neighbour index of prompt -> reply, scoped per model and settings"""
+
+    def __init__(self, embedder, threshold=0.95, max_entries=5000, ttl=86400, log_path=None, default_model=None):
+        load_numpy()
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.vectors = np.zeros((max_entries, embedder.dim), dtype=np.float32)
+        self.scope_ids = np.full(max_entries, -1, dtype=np.int32)
+        self.stored_at = np.zeros(max_entries, dtype=np.float64)
+        self.used_at = np.zeros(max_entries, dtype=np.float64)
+        # Per slot: (prompt, reply, prompt_signature(prompt), seconds the reply took to generate)
+        self.entries = [None] * max_entries
+        self.count = 0
+        self.scopes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        # Interaction log to warm the index from; records without a model field count as default_model's
+        self.log_path = log_path
+        self.default_model = default_model
+        self.warm_pid = None
+        self.warm_lock = threading.Lock()
+
+    def _scope_id(self, scope):
+        return self.scopes.setdefault(scope, len(self.scopes))
+
+    def lookup(self, prompt, model, settings=None):
+        """
+        (reply, similarity) for the closest cached prompt of the same model and settings,
+        or None below the threshold or when the prompts differ in numbers or content words
+        """
+        self._ensure_warm()
+        vector = self.embedder.embed(prompt)
+        signature = prompt_signature(prompt)
+        now = time.time()
+        with self.lock:
+            scope_id = self.scopes.get(cache_scope(model, settings))
+            match = None
+            if scope_id is not None and self.count:
+                scores = self.vectors[:self.count] @ vector
+                valid = (self.scope_ids[:self.count] == scope_id) & (self.stored_at[:self.count] >= now - self.ttl)
+                scores = np.where(valid, scores, -1.0)
+                # Check the few best candidates, since the best one may ask a different question
+                best = np.argpartition(scores, -min(5, self.count))[-5:]
+                for slot in best[np.argsort(scores[best])[::-1]]:
+                    if scores[slot] < self.threshold:
+                        break
+                    if self.entries[slot][2] == signature:
+                        match = int(slot), float(scores[slot])
+                        break
+            if match is None:
+                self.misses += 1
+                return None
+            slot, similarity = match
+            self.used_at[slot] = now
+            self.hits += 1
+            self.saved_seconds += self.entries[slot][3] or 0.0
+            return self.entries[slot][1], similarity
+
+    def add(self, prompt, model, reply, latency=None, stored_at=None, settings=None):
+        """Cache a reply, replacing the least recently used entry once full"""
+        if not prompt.strip() or not reply:
+            return
+        vector = self.embedder.embed(prompt)
+        stored_at = stored_at or time.time()
+        with self.lock:
+            if self.count < self.max_entries:
+                slot = self.count
+                self.count += 1
+            else:
+                slot = int(np.argmin(self.used_at))
+            self.vectors[slot] = vector
+            self.scope_ids[slot] = self._scope_id(cache_scope(model, settings))
+            self.stored_at[slot] = stored_at
+            self.used_at[slot] = stored_at
+            self.entries[slot] = (prompt, reply, prompt_signature(prompt), latency)
+
+    def _ensure_warm(self):
+        """
+        Load the newest max_entries semantic-eligible replies from the interaction log in a background
+        thread, once per process. Started on first use rather than at import, since threads
+        don't survive the fork into gunicorn workers.
+        """
+        if self.log_path is None or self.warm_pid == os.getpid():
+            return
+        with self.warm_lock:
+            if self.warm_pid == os.getpid():
+                return
+            self.warm_pid = os.getpid()
+        log_path = self.log_path
+
+        def load():
+            started = time.perf_counter()
+            recent = deque(maxlen=self.max_entries)
+            try:
+                with open(log_path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        # Only replies to a lone prompt carry their settings; the log keeps just the prompt,
+                        # not the history, image or document excerpts other replies depended on
+                        if not isinstance(record.get("semantic"), dict):
+                            continue
+                        recent.append(record)
+            except FileNotFoundError:
+                return
+            cutoff = time.time() - self.ttl
+            loaded = 0
+            for record in recent:
+                try:
+                    stored_at = datetime.fromisoformat(record["timestamp"]).timestamp()
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if stored_at < cutoff:
+                    continue
+                latency = record.get("latency_ms")
+                self.add(record.get("prompt", ""), record.get("model") or self.default_model, record.get("response"),
+                         latency / 1000 if latency else None, stored_at, record["semantic"])
+                loaded += 1
+            print(f"Semantic cache loaded {loaded} replies from {log_path} in {time.perf_counter() - started:.2f}s")
+
+        threading.Thread(target=load, name="semantic-cache-warm", daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.count,
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3)
+            }
+
+def create_semantic_cache(log_path=None, default_model=None):
+    """Build the cache configured by SEMANTIC_CACHE_* variables, or None if disabled or NumPy is missing"""
+    if os.getenv("SEMANTIC_CACHE", "0") != "1":
+        return None
+    if importlib.util.find_spec("numpy") is None:
+        print("Semantic cache disabled: install numpy to enable it")
+        return None
+    return SemanticCache(
+        HashedNgramEmbedder(dim=int(os.getenv("SEMANTIC_CACHE_DIM", 512))),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000)),
+        ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 86400)),
+        log_path=log_path,
+        default_model=default_model
+    )
@@ -0,0 +1,86 @@
+"""
+Request coalescing: concurrent identical upstream calls share one in-flight result
+"""
+import asyncio
+import hashlib
+import json
+import threading
+
+def request_key(kind, payload):
+    """Key identical upstream requests of the same kind by their exact payload"""
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{kind}:{encoded}".encode()).hexdigest()
+
+class _Call:
+    """One in-flight call that followers wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Thread-based coalescing for the Flask (threaded) server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run fn once per key at a time; callers arriving meanwhile get its result or error"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+class AsyncSingleFlight:
+    """Coroutine-based coalescing for the ASGI entry point (one event loop)"""
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        """Await fn() once per key at a time; callers arriving meanwhile get its result or error"""
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # Shield so one follower disconnecting does not cancel the shared call
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved so a call without followers does not warn
+            raise
+        finally:
+            del self.calls[key]
@@ -0,0 +1,49 @@
+"""
+Shared connection handling for the app's SQLite-backed stores
+"""
+import os
+import sqlite3
+import threading
+
+class SQLiteStore:
+    """
+    Base for a store kept in one SQLite file: a connection per thread and process,
+    and SCHEMA created on first use, so constructing a store touches no files.
+    """
+
+    SCHEMA = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.schema_ready = False
+        self.schema_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        # Connections opened before a fork (e.g. gunicorn preload) are not reused by the worker
+        if conn is None or self.local.pid != os.getpid():
+            self._ensure_schema()
+            conn = self._connect()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _connect(self):
+        """A new connection; subclasses add per-connection pragmas"""
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _ensure_schema(self):
+        with self.schema_lock:
+            if self.schema_ready:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(self.SCHEMA)
+            finally:
+                conn.close()
+            self.schema_ready = True
@@ -1,22 +1,13 @@
 #!/bin/bash
+# Start the app with gunicorn (settings in gunicorn.conf.py, PORT etc. from .env).
+# Pass --dev to run the Flask development server with the reloader instead.
 
-echo "Checking if port 5000 is in use..."
-pid=$(lsof -t -i:5000 2>/dev/null)
+cd "$(dirname "$0")"
 
-if [ -n "$pid" ]; then
-  echo "Port 5000 is being used by process $pid. Attempting to terminate..."
-  kill $pid
-  sleep 1
-  
-  # Check if process was terminated successfully
-  if lsof -t -i:5000 &>/dev/null; then
-    echo "Warning: Process $pid is still running. Will try a different port."
-    python app.py --port 5001
-  else
-    echo "Process terminated successfully. Starting Flask app on default port."
-    python app.py
-  fi
-else
-  echo "Port 5000 is available. Starting Flask app."
-  python app.py
+if [ "$1" == "--dev" ]; then
+  echo "Starting Flask development server..."
+  exec python app.py
 fi
+
+echo "Starting gunicorn..."
+exec gunicorn -c gunicorn.conf.py wsgi:application
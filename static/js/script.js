@@ -17,6 +17,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const fileInput = document.getElementById('file-input');
     const attachmentPreview = document.getElementById('attachment-preview');
     const attachBtn = document.getElementById('attach-btn');
+    // Upload limits (match MAX_CONTENT_LENGTH / MAX_UPLOAD_SIZE on the server)
+    const MAX_IMAGE_SIZE = 10 * 1024 * 1024;
+    const MAX_DOCUMENT_SIZE = 100 * 1024 * 1024;
+    const CHUNKED_UPLOAD_THRESHOLD = 5 * 1024 * 1024;
     
     // Model selection elements
     const modelSelect = document.getElementById('model-select');
@@ -212,17 +216,34 @@ document.addEventListener('DOMContentLoaded', () => {
             prompt: finalPrompt,
             context: context.map(msg => ({ text: msg.text, sender: msg.sender })),
             max_length: parseInt(maxLengthInput.value),
-            temperature: parseFloat(temperatureInput.value)
+            temperature: parseFloat(temperatureInput.value),
+            // Ask for token streaming when the browser can read response bodies incrementally
+            stream: !!(window.ReadableStream && window.TextDecoder),
+            // Ask the server for rendered Markdown so formatting doesn't happen on this device
+            render: true
         };
         
+        // Let the server assemble history from its copy of the conversation
+        const conversationId = await ensureServerConversation(currentChatId);
+        if (conversationId) {
+            payload.conversation_id = conversationId;
+        }
+        
         // Add attachment if present
         if (currentAttachment) {
             if (currentAttachment.type === 'image') {
-                payload.image = currentAttachment.data;
+                // Reference the uploaded copy when available instead of inlining base64
+                if (currentAttachment.image_id) {
+                    payload.image_id = currentAttachment.image_id;
+                } else {
+                    payload.image = currentAttachment.data;
+                }
                 // Create the message with the image in a more visually appealing way
                 addMessageWithImage(finalPrompt, currentAttachment.data, currentAttachment.name, 'user');
             } else if (currentAttachment.type === 'file') {
+                // The server answers from the document's indexed text, found by this ID
                 payload.file = {
+                    id: currentAttachment.file_id,
                     name: currentAttachment.name,
                     url: currentAttachment.url,
                     path: currentAttachment.filepath,
@@ -261,7 +282,11 @@ document.addEventListener('DOMContentLoaded', () => {
             
             clearTimeout(timeoutId);
             
-            const data = await response.json();
+            // Streaming responses arrive as SSE; errors and non-streaming replies stay JSON
+            const contentType = response.headers.get('Content-Type') || '';
+            const data = contentType.includes('text/event-stream')
+                ? await readGenerationStream(response)
+                : await response.json();
             
             if (data.error) {
                 let errorMessage = `Error: ${data.error}`;
@@ -278,6 +303,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 addMessageToUI(errorMessage, 'bot');
                 saveMessageToChat(currentChatId, errorMessage, 'bot');
                 
+                if (response.status === 404 && data.conversation_id && chats[currentChatId]) {
+                    // The server no longer has this conversation; start a fresh one next time
+                    delete chats[currentChatId].conversationId;
+                }
+                
                 if (response.status === 402) {
                     // Billing error - show special UI indicator
                     updateApiStatus('billing-limit');
@@ -286,7 +316,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     updateApiStatus('offline');
                 }
             } else {
-                addMessageToUI(data.response, 'bot');
+                addMessageToUI(data.response, 'bot', data.html);
                 saveMessageToChat(currentChatId, data.response, 'bot');
                 updateApiStatus('online');
                 
@@ -321,6 +351,101 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    // Get (or create) the server-side conversation backing a local chat
+    async function ensureServerConversation(chatId) {
+        const chat = chats[chatId];
+        if (!chat) return null;
+        if (chat.conversationId) return chat.conversationId;
+        
+        try {
+            const response = await fetch('/conversations', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ title: chat.title })
+            });
+            if (!response.ok) return null;
+            
+            const conversation = await response.json();
+            chat.conversationId = conversation.id;
+            saveChatToStorage();
+            return chat.conversationId;
+        } catch (error) {
+            console.error('Failed to create server conversation:', error);
+            return null;
+        }
+    }
+    
+    // Read a Server-Sent Events stream from /generate, showing text as it arrives
+    async function readGenerationStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let renderedBlocks = '';
+        let result = null;
+        
+        // Temporary message that shows raw text until the full reply is formatted
+        const streamingDiv = document.createElement('div');
+        streamingDiv.className = 'message bot-message';
+        const streamingContent = document.createElement('div');
+        streamingContent.className = 'message-content';
+        streamingContent.style.whiteSpace = 'pre-wrap';
+        streamingDiv.appendChild(streamingContent);
+        
+        try {
+            while (!result) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                // Events are separated by a blank line
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    
+                    let eventName = 'message';
+                    let eventData = '';
+                    rawEvent.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        else if (line.startsWith('data:')) eventData += line.slice(5).trim();
+                    });
+                    if (!eventData) continue;
+                    
+                    const parsed = JSON.parse(eventData);
+                    if (eventName === 'done') {
+                        result = { response: parsed.response, html: parsed.html };
+                        break;
+                    } else if (eventName === 'error') {
+                        result = { error: parsed.error };
+                        break;
+                    } else if (parsed.delta) {
+                        if (!streamingDiv.parentNode) {
+                            showTypingIndicator(false);
+                            chatContainer.appendChild(streamingDiv);
+                        }
+                        text += parsed.delta;
+                        if (parsed.html_tail !== undefined) {
+                            // Completed blocks arrive once; only the trailing block is replaced
+                            renderedBlocks += (parsed.html_blocks || []).join('');
+                            streamingContent.style.whiteSpace = 'normal';
+                            streamingContent.innerHTML = renderedBlocks + parsed.html_tail;
+                        } else if (!renderedBlocks) {
+                            streamingContent.textContent = text;
+                        }
+                        chatContainer.scrollTop = chatContainer.scrollHeight;
+                    }
+                }
+            }
+        } finally {
+            streamingDiv.remove();
+        }
+        
+        return result || { response: text };
+    }
+    
     // New function to handle image generation with DALL-E
     async function handleImageGeneration(prompt) {
         if (!prompt) return;
@@ -345,7 +470,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         try {
             // Send request to generate image
-            const response = await fetch('/generate-image', {
+            let response = await fetch('/generate-image', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -357,7 +482,10 @@ document.addEventListener('DOMContentLoaded', () => {
                 })
             });
             
-            const data = await response.json();
+            let data = await response.json();
+            
+            // The image is generated in the background; poll until it is stored
+            ({ response, data } = await waitForImageJob(response, data));
             
             if (data.error) {
                 let errorMessage = `Error: ${data.error}`;
@@ -405,6 +533,22 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    // Poll an image job's status URL while it is queued or running
+    async function waitForImageJob(response, data) {
+        let delay = 1000;
+        const deadline = Date.now() + 5 * 60 * 1000;
+        while (response.status === 202 && data.status_url && Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 1.5, 5000);
+            response = await fetch(data.status_url);
+            data = await response.json();
+        }
+        if (response.status === 202) {
+            data = { error: 'Image generation is taking too long. Please try again later.' };
+        }
+        return { response, data };
+    }
+    
     // Function to add a generated image to the UI
     function addImageToUI(imageUrl, promptText, sender) {
         const messageDiv = document.createElement('div');
@@ -467,7 +611,7 @@ document.addEventListener('DOMContentLoaded', () => {
         chatContainer.scrollTop = chatContainer.scrollHeight;
     }
     
-    function addMessageToUI(text, sender) {
+    function addMessageToUI(text, sender, html = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}-message`;
         messageDiv.setAttribute('data-message-id', Date.now().toString());
@@ -476,7 +620,11 @@ document.addEventListener('DOMContentLoaded', () => {
         contentDiv.className = 'message-content';
         
         // Process message content - format code blocks if present
-        if (sender === 'bot') {
+        if (sender === 'bot' && html) {
+            // Already sanitized and highlighted by the server
+            contentDiv.innerHTML = html;
+            setupCodeBlockCopyButtons(contentDiv);
+        } else if (sender === 'bot') {
             contentDiv.innerHTML = formatMessageWithCodeBlocks(text);
             
             // Initialize syntax highlighting for code blocks
@@ -819,7 +967,26 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
-    function loadChat(chatId) {
+    // Render a list of bot messages on the server in one request; null if unavailable
+    async function renderOnServer(texts) {
+        if (!texts.length) return [];
+        try {
+            const response = await fetch('/render', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ texts: texts })
+            });
+            if (!response.ok) return null;
+            return (await response.json()).html;
+        } catch (error) {
+            console.error('Server-side rendering failed, formatting locally:', error);
+            return null;
+        }
+    }
+    
+    async function loadChat(chatId) {
         if (!chats[chatId]) return;
         
         // Set current chat ID
@@ -840,8 +1007,15 @@ document.addEventListener('DOMContentLoaded', () => {
         
         // Display messages for this chat
         if (chats[chatId].messages && chats[chatId].messages.length > 0) {
-            chats[chatId].messages.forEach(msg => {
-                addMessageToUI(msg.text, msg.sender);
+            const messages = chats[chatId].messages;
+            const botTexts = messages.filter(msg => msg.sender === 'bot' && !msg.isImage).map(msg => msg.text);
+            const rendered = await renderOnServer(botTexts);
+            if (currentChatId !== chatId) return;  // Another chat was opened meanwhile
+            
+            let renderedIndex = 0;
+            messages.forEach(msg => {
+                const html = rendered && msg.sender === 'bot' && !msg.isImage ? rendered[renderedIndex++] : null;
+                addMessageToUI(msg.text, msg.sender, html);
             });
             
             // Show chat view
@@ -879,8 +1053,8 @@ document.addEventListener('DOMContentLoaded', () => {
         
         console.log(`File selected: ${file.name} (${formatFileSize(file.size)})`);
         
-        // Check file size (increased to 10MB)
-        const maxSize = 10 * 1024 * 1024; // 10MB
+        // Images are sent in one request; documents above CHUNKED_UPLOAD_THRESHOLD go up in resumable chunks
+        const maxSize = file.type.startsWith('image/') ? MAX_IMAGE_SIZE : MAX_DOCUMENT_SIZE;
         if (file.size > maxSize) {
             alert(`File is too large. Maximum file size is ${formatFileSize(maxSize)}.`);
             fileInput.value = '';
@@ -917,7 +1091,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     file_type: file.type
                 };
                 showAttachmentPreview(file.name, e.target.result, file.type, null, file.size);
-                showUploadProgress(false);
+                
+                // Store the image on the server once so /generate can reference it by ID
+                uploadFile(file)
+                    .catch(error => console.error('Image upload failed, sending inline instead:', error))
+                    .finally(() => showUploadProgress(false));
             };
             reader.readAsDataURL(file);
         } else {
@@ -1080,8 +1258,84 @@ document.addEventListener('DOMContentLoaded', () => {
         attachmentPreview.appendChild(previewContainer);
     }
     
+    // Remember the stored file on the current attachment
+    function applyUploadResult(file, result) {
+        if (result.image_id) {
+            // Keep the local preview data; just remember the server's ID
+            if (currentAttachment && currentAttachment.type === 'image' && currentAttachment.name === file.name) {
+                currentAttachment.image_id = result.image_id;
+            }
+        } else if (result.url) {
+            currentAttachment = {
+                type: 'file',
+                name: file.name,
+                original_filename: file.name,
+                url: result.url,
+                filepath: result.filepath,
+                file_id: result.filename,
+                size: result.size || file.size,
+                file_type: result.type || file.type,
+                timestamp: result.timestamp || new Date().toISOString()
+            };
+        } else {
+            throw new Error('Server response missing URL');
+        }
+        return result;
+    }
+    
+    // Upload a large file in chunks; after a failed chunk, ask the server how much arrived and resume from there
+    async function uploadFileChunked(file) {
+        const jsonOrError = async (response) => {
+            const body = await response.json().catch(() => ({}));
+            if (!response.ok) {
+                const error = new Error(body.error || `Server error (${response.status})`);
+                error.status = response.status;
+                throw error;
+            }
+            return body;
+        };
+        
+        const upload = await jsonOrError(await fetch('/upload/chunked', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, type: file.type })
+        }));
+        
+        let offset = upload.received;
+        let failures = 0;
+        const maxFailures = 5;
+        while (offset < file.size) {
+            try {
+                const chunk = file.slice(offset, offset + upload.chunk_size);
+                const result = await jsonOrError(await fetch(upload.upload_url, {
+                    method: 'PUT',
+                    headers: { 'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset) },
+                    body: chunk
+                }));
+                offset = result.received;
+                failures = 0;
+                showUploadProgress(true, Math.round((offset / file.size) * 100));
+            } catch (error) {
+                // Client errors (wrong type, too large, unknown upload) won't succeed on retry
+                if (error.status && error.status < 500 && error.status !== 409) throw error;
+                if (++failures > maxFailures) throw error;
+                console.log(`Chunk upload failed (${error.message}); resuming (${failures}/${maxFailures})...`);
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                const status = await jsonOrError(await fetch(upload.upload_url)).catch(() => null);
+                if (status) offset = status.received;
+            }
+        }
+        
+        const result = await jsonOrError(await fetch(upload.complete_url, { method: 'POST' }));
+        console.log("Upload successful:", result);
+        return applyUploadResult(file, result);
+    }
+    
     // Upload file with improved error handling and retry logic
     async function uploadFile(file) {
+        if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+            return uploadFileChunked(file);
+        }
         return new Promise((resolve, reject) => {
             const formData = new FormData();
             formData.append('file', file);
@@ -1109,22 +1363,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         try {
                             const result = JSON.parse(xhr.responseText);
                             console.log("Upload successful:", result);
-                            
-                            if (result.url) {
-                                currentAttachment = {
-                                    type: 'file',
-                                    name: file.name,
-                                    original_filename: file.name,
-                                    url: result.url,
-                                    filepath: result.filepath,
-                                    size: result.size || file.size,
-                                    file_type: result.type || file.type,
-                                    timestamp: result.timestamp || new Date().toISOString()
-                                };
-                                resolve(result);
-                            } else {
-                                reject(new Error('Server response missing URL'));
-                            }
+                            resolve(applyUploadResult(file, result));
                         } catch (error) {
                             console.error("Error parsing server response:", error);
                             reject(new Error('Invalid server response'));
@@ -0,0 +1,8 @@
+"""
+WSGI entry point for production servers
+
+Run with: gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from app import create_app
+
+application = create_app()